@@ -1,7 +1,101 @@
+var messagesVersion = null;
+var messageElements = {};
+// whether the server holds requests until something changes; if not (or if it fails), poll
+var longPolling = true;
+
+function typesetAndScheduleFetch(elements)
+{
+    var delay = longPolling ? 0 : 3000;
+    if (typeof MathJax === 'undefined')
+    {
+        window.setTimeout('fetchMessages()', delay);
+        return;
+    }
+    for (var i = 0; i < elements.length; ++i)
+    {
+        MathJax.Hub.Queue(["Typeset", MathJax.Hub, elements[i]]);
+    }
+    MathJax.Hub.Queue([window.setTimeout, 'fetchMessages()', delay]);
+}
+
+function applyMessageUpdate(update)
+{
+    var container = document.getElementById('messages');
+    if (!update.partial)
+    {
+        container.innerHTML = '';
+        messageElements = {};
+    }
+
+    // replace the edited messages and create the new ones
+    var changed = [];
+    for (var id in update.posts)
+    {
+        var element = messageElements[id];
+        if (element === undefined)
+        {
+            element = document.createElement('div');
+            element.className = 'postcontainer';
+            messageElements[id] = element;
+        }
+        element.innerHTML = update.posts[id];
+        changed.push(element);
+    }
+
+    // drop the messages that have fallen out of the backlog
+    var current = {};
+    for (var i = 0; i < update.ids.length; ++i)
+    {
+        current[update.ids[i]] = true;
+    }
+    for (var oldId in messageElements)
+    {
+        if (!current[oldId])
+        {
+            container.removeChild(messageElements[oldId]);
+            delete messageElements[oldId];
+        }
+    }
+
+    // put everything in order, only moving what isn't in place yet
+    var cursor = container.firstChild;
+    for (var j = 0; j < update.ids.length; ++j)
+    {
+        var wanted = messageElements[update.ids[j]];
+        if (wanted === cursor)
+        {
+            cursor = cursor.nextSibling;
+        }
+        else
+        {
+            container.insertBefore(wanted, cursor);
+        }
+    }
+
+    messagesVersion = update.version;
+    return changed;
+}
+
 function messagesFetched()
 {
-    document.getElementById('messages').innerHTML = this.responseText;
-    MathJax.Hub.Queue(["Typeset",MathJax.Hub], [window.setTimeout, 'fetchMessages()', 3000]);
+    var changed = [];
+    longPolling = (this.getResponseHeader('X-Long-Poll') == '1');
+    if (this.status == 200)
+    {
+        changed = applyMessageUpdate(JSON.parse(this.responseText));
+    }
+    else if (this.status != 304)
+    {
+        longPolling = false;
+    }
+    typesetAndScheduleFetch(changed);
+}
+
+function messagesFailed()
+{
+    // fall back to polling; a successful response turns long polling back on
+    longPolling = false;
+    window.setTimeout('fetchMessages()', 3000);
 }
 
 function smiliesFetched()
@@ -31,7 +125,13 @@ function fetchMessages()
 {
     var req = new XMLHttpRequest();
     req.onload = messagesFetched;
-    req.open('GET', '/messages', true);
+    req.onerror = messagesFailed;
+    var url = '/messages?since=' + encodeURIComponent(messagesVersion === null ? '' : messagesVersion);
+    if (longPolling && messagesVersion !== null)
+    {
+        url += '&wait=1';
+    }
+    req.open('GET', url, true);
     req.send();
 }
 
@@ -0,0 +1,195 @@
+import re
+
+__author__ = 'ondra'
+
+right_arrows_to_left_arrows = {
+    "->": "<-",
+    "=>": "<=",
+    "\u2192": "\u2190",
+    "\u219d": "\u219c",
+    "\u21a0": "\u219e",
+    "\u21a3": "\u21a2",
+    "\u21a6": "\u21a4",
+    "\u21aa": "\u21a9",
+    "\u21ac": "\u21ab",
+    "\u21b1": "\u21b0",
+    "\u21b3": "\u21b2",
+    "\u21b7": "\u21b6",
+    "\u21c0": "\u21bc",
+    "\u21c1": "\u21bd",
+    "\u21c9": "\u21c7",
+    "\u21d2": "\u21d0",
+    "\u21db": "\u21da",
+    "\u21dd": "\u21dc",
+    "\u21e2": "\u21e0",
+    "\u21e5": "\u21e4",
+    "\u21e8": "\u21e6",
+    "\u21f4": "\u2b30",
+    "\u21f6": "\u2b31",
+    "\u21f8": "\u21f7",
+    "\u21fb": "\u21fa",
+    "\u21fe": "\u21fd",
+    "\u27f4": "\u2b32",
+    "\u27f6": "\u27f5",
+    "\u27f9": "\u27f8",
+    "\u27fc": "\u27fb",
+    "\u27fe": "\u27fd",
+    "\u27ff": "\u2b33",
+    "\u2900": "\u2b34",
+    "\u2901": "\u2b35",
+    "\u2903": "\u2902",
+    "\u2905": "\u2b36",
+    "\u2907": "\u2906",
+    "\u290d": "\u290c",
+    "\u290f": "\u290e",
+    "\u2910": "\u2b37",
+    "\u2911": "\u2b38",
+    "\u2914": "\u2b39",
+    "\u2915": "\u2b3a",
+    "\u2916": "\u2b3b",
+    "\u2917": "\u2b3c",
+    "\u2918": "\u2b3d",
+    "\u291a": "\u2919",
+    "\u291c": "\u291b",
+    "\u291e": "\u291d",
+    "\u2920": "\u291f",
+    "\u2933": "\u2b3f",
+    "\u2937": "\u2936",
+    "\u2939": "\u2938",
+    "\u293f": "\u293e",
+    "\u2942": "\u2943",
+    "\u2945": "\u2946",
+    "\u2953": "\u2952",
+    "\u2957": "\u2956",
+    "\u295b": "\u295a",
+    "\u295f": "\u295e",
+    "\u2964": "\u2962",
+    "\u296c": "\u296a",
+    "\u296d": "\u296b",
+    "\u2971": "\u2b40",
+    "\u2972": "\u2b49",
+    "\u2974": "\u2973",
+    "\u2975": "\u2b4a",
+    "\u2978": "\u2976",
+    "\u2b43": "\u2977",
+    "\u2979": "\u297b",
+    "\u2b44": "\u297a",
+    "\u297c": "\u297d",
+    "\u27a1": "\u2b05",
+    "\u2b0e": "\u2b10",
+    "\u2b0f": "\u2b11",
+    "\u2b46": "\u2b45",
+    "\u2b47": "\u2b41",
+    "\u2b48": "\u2b42",
+    "\u2b4c": "\u2b4b",
+}
+
+special_right_arrows = "".join(k for k in right_arrows_to_left_arrows.keys() if len(k) == 1)
+
+# characters that may be part of an arrow, and those of them that make it point somewhere
+arrow_shaft_characters = frozenset("-=~>" + special_right_arrows)
+arrow_head_characters = frozenset(">" + special_right_arrows)
+
+# single-character arrows are reversed by translation, digraphs by substitution; a reversed
+# digraph's shaft forms a new digraph with any following arrowhead ("->>" becomes "<<-")
+reverse_arrow_table = str.maketrans({
+    right: left for (right, left) in right_arrows_to_left_arrows.items() if len(right) == 1
+})
+digraph_shafts = "".join(right[0] for right in right_arrows_to_left_arrows.keys() if len(right) > 1)
+digraph_arrow_re = re.compile("([{0}])(>+)".format(re.escape(digraph_shafts)))
+any_arrow_re = re.compile("[{0}]>|[{1}]".format(re.escape(digraph_shafts), special_right_arrows))
+waste_bin_re = re.compile("[tT][oO][nN][nN][eE]")
+
+# longer texts are not scanned at all (the chatbox doesn't allow messages this long anyway)
+maximum_scan_length = 4096
+
+
+def arrow_runs(text):
+    """
+    Find all runs of arrow characters that contain at least one arrowhead. Runs in linear time.
+    :param text: The text to scan.
+    :type text: str
+    :return: A list of (start, end, last_head) triples: the run spans text[start:end] and the last
+    arrowhead within the run is at text[last_head].
+    :rtype: list[(int, int, int)]
+    """
+    ret = []
+    start = None
+    last_head = None
+    for (i, c) in enumerate(text):
+        if c in arrow_shaft_characters:
+            if start is None:
+                start = i
+            if c in arrow_head_characters:
+                last_head = i
+        elif start is not None:
+            if last_head is not None:
+                ret.append((start, i, last_head))
+            start = None
+            last_head = None
+    if start is not None and last_head is not None:
+        ret.append((start, len(text), last_head))
+    return ret
+
+
+def contains_arrow(text):
+    """
+    Return whether the text contains an arrow (a run of arrow characters with an arrowhead).
+    :type text: str
+    :rtype: bool
+    """
+    for c in text:
+        if c in arrow_head_characters:
+            return True
+    return False
+
+
+def contains_right_arrow(text):
+    """
+    Return whether the text contains one of the right arrows that can be reversed.
+    :type text: str
+    :rtype: bool
+    """
+    return any_arrow_re.search(text) is not None
+
+
+def reverse_arrows(text):
+    """
+    Replace all right arrows in the text with their left counterparts.
+    :type text: str
+    :rtype: str
+    """
+    ret = text.translate(reverse_arrow_table)
+    return digraph_arrow_re.sub(lambda m: "<" * len(m.group(2)) + m.group(1), ret)
+
+
+def split_waste_bin_toss(text):
+    """
+    Split a "something -> somethingTonneSomething" message into its parts.
+    :param text: The text of the message.
+    :type text: str
+    :return: A tuple consisting of what is being thrown, the arrow, and where it is being thrown;
+    or None if the text isn't a waste bin toss.
+    :rtype: (str, str, str)|None
+    """
+    if len(text) > maximum_scan_length:
+        return None
+
+    # the whole message must be a single line
+    line = text[:-1] if text.endswith("\n") else text
+    if "\n" in line:
+        return None
+
+    # the arrow starts at the earliest possible position after the first character
+    for (start, end, last_head) in arrow_runs(line):
+        arrow_start = max(start, 1)
+        if arrow_start > last_head:
+            continue
+
+        where = line[end:]
+        if waste_bin_re.search(where) is None:
+            # no bin after this arrow means no bin after any later arrow either
+            return None
+        return line[:arrow_start], line[arrow_start:end], where
+
+    return None
@@ -175,6 +175,55 @@ class TransferError(Exception):
     pass
 
 
+class MessageIndex:
+    """The image sources and link targets of a message body, collected in a single pass."""
+    def __init__(self, body_lxml):
+        """
+        Index a message body.
+        :param body_lxml: The parsed body of the message, or None if it is empty.
+        """
+        self.image_sources = []
+        """:type: list[str]"""
+        self.link_targets = []
+        """:type: list[str]"""
+
+        if body_lxml is not None:
+            for element in body_lxml.iter("img", "a"):
+                if element.tag == "img":
+                    src = element.get("src")
+                    if src is not None:
+                        self.image_sources.append(src)
+                else:
+                    href = element.get("href")
+                    if href is not None:
+                        self.link_targets.append(href)
+
+        self.image_source_set = frozenset(self.image_sources)
+
+    def has_image(self, url):
+        """
+        Return whether the message contains an image with the given source.
+        :rtype: bool
+        """
+        return url in self.image_source_set
+
+    def images_in(self, urls):
+        """
+        Return the sources of the images in the message (in order, including repetitions) which are
+        contained in the given collection.
+        :type urls: set[str]|frozenset[str]|dict[str, object]
+        :rtype: list[str]
+        """
+        return [src for src in self.image_sources if src in urls]
+
+    def has_links(self):
+        """
+        Return whether the message contains any links.
+        :rtype: bool
+        """
+        return len(self.link_targets) > 0
+
+
 class ChatboxMessage:
     """A message posted into the chatbox."""
     def __init__(self, message_id, user_id, user_name_body, body, timestamp=None,
@@ -199,6 +248,7 @@ class ChatboxMessage:
             self.html_decompiler = HtmlDecompiler()
         else:
             self.html_decompiler = html_decompiler
+        self.cached_body_index = None
 
     def user_name_io(self):
         """
@@ -259,6 +309,16 @@ class ChatboxMessage:
             return None
         return etree.HTML(self.body)
 
+    def body_index(self):
+        """
+        Return the index of the images and links in the body of the message. It is only built once
+        and shared by all the modules looking at this message.
+        :rtype: MessageIndex
+        """
+        if self.cached_body_index is None:
+            self.cached_body_index = MessageIndex(self.body_lxml())
+        return self.cached_body_index
+
     def decompiled_body_dom(self):
         """
         Return the Document Object Model of the message body decompiled using HtmlDecompiler.
@@ -326,10 +386,14 @@ class ChatboxConnector:
         self.forum_smiley_urls_to_codes = {}
         self.custom_smiley_codes_to_urls = {}
         self.custom_smiley_urls_to_codes = {}
+        # incremented whenever the set of forum smileys changes
+        self.smiley_version = 0
         self.initial_salvo = True
         self.security_token = None
         self.last_message_received = -1
         self.stop_reading = False
+        # set to wake the reading thread early, e.g. when stopping
+        self.reading_wakeup = threading.Event()
         self.stfu_deadline = None
         """:type: int|None"""
         self.last_dst_update_hour_utc = -1
@@ -352,6 +416,11 @@ class ChatboxConnector:
         self.login()
         self.reading_thread.start()
 
+    def stop(self):
+        """Make the reading thread finish once it is done with the current fetch."""
+        self.stop_reading = True
+        self.reading_wakeup.set()
+
     def login(self):
         """
         Login to the vBulletin chatbox using the credentials contained in this object.
@@ -431,6 +500,8 @@ class ChatboxConnector:
             url_to_code[url] = code
 
         if len(code_to_url) > 0 and len(url_to_code) > 0:
+            if code_to_url != self.forum_smiley_codes_to_urls:
+                self.smiley_version += 1
             self.forum_smiley_codes_to_urls = code_to_url
             self.forum_smiley_urls_to_codes = url_to_code
 
@@ -506,6 +577,11 @@ class ChatboxConnector:
         return func(*pos_args, retry=retry_count+1, **kw_args)
 
     def should_stfu(self):
+        """
+        Whether the bot has been told to shut up. The deadline is lifted by the expiry timer of the
+        module that set it; the comparison with the clock only covers a late-firing timer.
+        :rtype: bool
+        """
         if self.stfu_deadline is None:
             return False
         if time.time() < self.stfu_deadline:
@@ -760,7 +836,7 @@ class ChatboxConnector:
             except:
                 logger.exception("potential DST fixing failed")
             penalty_coefficient += 1
-            time.sleep(self.time_between_reads * penalty_coefficient)
+            self.reading_wakeup.wait(self.time_between_reads * penalty_coefficient)
 
     def get_user_id_for_name(self, username):
         """
@@ -0,0 +1,117 @@
+import http.client as hcl
+import socket
+import ssl
+import threading
+import urllib.parse as up
+
+__author__ = 'ondra'
+
+default_ports = {"http": 80, "https": 443}
+redirect_statuses = (301, 302, 303, 307, 308)
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive HTTP and HTTPS connections, separately for each host (and address, if
+    connections are made to an address that has already been resolved and vetted).
+    """
+
+    def __init__(self, timeout, max_idle_per_host=2):
+        """
+        Create a new connection pool.
+        :param timeout: The socket timeout for new connections, in seconds.
+        :param max_idle_per_host: How many idle connections to keep for each host.
+        """
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.hosts_to_idle_connections = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, scheme, host, port, address=None):
+        """
+        Return an idle connection to the given host, or a new one if none is idle.
+        :param address: The IP address to connect to, or None to resolve the host name.
+        :return: The connection and whether it has been reused.
+        :rtype: (http.client.HTTPConnection, bool)
+        """
+        key = (scheme, host, port, address)
+        with self.lock:
+            idle_connections = self.hosts_to_idle_connections.get(key, None)
+            if idle_connections:
+                return idle_connections.pop(), True
+
+        if scheme == "https":
+            # the host name is still used for SNI and certificate verification
+            connection = hcl.HTTPSConnection(host, port, timeout=self.timeout, context=ssl.create_default_context())
+        else:
+            connection = hcl.HTTPConnection(host, port, timeout=self.timeout)
+        if address is not None:
+            connection._create_connection = \
+                lambda host_port, *args, **kwargs: socket.create_connection((address, host_port[1]), *args, **kwargs)
+        return connection, False
+
+    def release(self, scheme, host, port, connection, address=None):
+        """
+        Return a connection whose last response has been read completely to the pool.
+        """
+        key = (scheme, host, port, address)
+        with self.lock:
+            idle_connections = self.hosts_to_idle_connections.setdefault(key, [])
+            if len(idle_connections) < self.max_idle_per_host:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, url, method="GET", headers=None, address=None):
+        """
+        Perform a single request (without following redirects) on a pooled connection.
+        :return: The connection (to be passed to finish by the caller) and the response.
+        :rtype: (http.client.HTTPConnection, http.client.HTTPResponse)
+        """
+        url_parts = up.urlsplit(url)
+        scheme = url_parts.scheme.lower()
+        port = url_parts.port or default_ports.get(scheme, 80)
+        path = url_parts.path or "/"
+        if url_parts.query:
+            path += "?" + url_parts.query
+        if headers is None:
+            headers = {}
+
+        (connection, reused) = self.acquire(scheme, url_parts.hostname, port, address)
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+        except (hcl.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                # a fresh connection failing won't go any better the second time
+                raise
+
+            # perhaps the server has closed the kept-alive connection; try once more (the
+            # connection reconnects on its own)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except:
+                connection.close()
+                raise
+        return connection, response
+
+    def finish(self, url, connection, response, read_completely, address=None):
+        """Release the connection to the pool if possible; close it otherwise."""
+        url_parts = up.urlsplit(url)
+        scheme = url_parts.scheme.lower()
+        port = url_parts.port or default_ports.get(scheme, 80)
+        if read_completely and not response.will_close:
+            self.release(scheme, url_parts.hostname, port, connection, address)
+        else:
+            connection.close()
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self.lock:
+            all_idle = self.hosts_to_idle_connections
+            self.hosts_to_idle_connections = {}
+        for idle_connections in all_idle.values():
+            for connection in idle_connections:
+                connection.close()
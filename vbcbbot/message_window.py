@@ -0,0 +1,93 @@
+__author__ = 'ondra'
+
+
+class MessageWindow:
+    """
+    The most recent values (usually messages) added under unique keys (usually message IDs), up to
+    a fixed number. Stored in a ring buffer with an index from key to slot, so that adding (and
+    evicting the oldest), replacing and looking up a value all take constant time.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: How many values to keep at most.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        """:type: list[(object, object)|None]"""
+        self.keys_to_slots = {}
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return key in self.keys_to_slots
+
+    def add(self, key, value):
+        """
+        Add a value as the newest one. If the key is already present, its value is replaced instead
+        (without changing its position).
+        :return: The (key, value) pair that has been evicted to make room, or None.
+        :rtype: (object, object)|None
+        """
+        if key in self.keys_to_slots:
+            self.slots[self.keys_to_slots[key]] = (key, value)
+            return None
+
+        evicted = None
+        if self.count == self.capacity:
+            slot = self.start
+            evicted = self.slots[slot]
+            del self.keys_to_slots[evicted[0]]
+            self.start = (self.start + 1) % self.capacity
+        else:
+            slot = (self.start + self.count) % self.capacity
+            self.count += 1
+
+        self.slots[slot] = (key, value)
+        self.keys_to_slots[key] = slot
+        return evicted
+
+    def get(self, key, default=None):
+        """Return the value stored under the given key, or the default if there is none."""
+        slot = self.keys_to_slots.get(key, None)
+        if slot is None:
+            return default
+        return self.slots[slot][1]
+
+    def replace(self, key, value):
+        """
+        Replace the value stored under the given key.
+        :return: Whether the key is present (otherwise, nothing is stored).
+        :rtype: bool
+        """
+        slot = self.keys_to_slots.get(key, None)
+        if slot is None:
+            return False
+        self.slots[slot] = (key, value)
+        return True
+
+    def clear(self):
+        self.slots = [None] * self.capacity
+        self.keys_to_slots = {}
+        self.start = 0
+        self.count = 0
+
+    def oldest_first(self):
+        """Iterate over the values from the oldest to the newest."""
+        for i in range(self.count):
+            yield self.slots[(self.start + i) % self.capacity][1]
+
+    def newest_first(self):
+        """Iterate over the values from the newest to the oldest."""
+        for i in range(self.count - 1, -1, -1):
+            yield self.slots[(self.start + i) % self.capacity][1]
+
+    def keys_newest_first(self):
+        """Iterate over the keys from the newest to the oldest."""
+        for i in range(self.count - 1, -1, -1):
+            yield self.slots[(self.start + i) % self.capacity][0]
@@ -1,3 +1,5 @@
+from vbcbbot.scheduler import default_scheduler
+
 __author__ = 'ondra'
 
 
@@ -65,6 +67,9 @@ class Module:
         self.connector = connector
         self.connector.subscribe_to_message_updates(self.process_message)
 
+        # runs delayed actions; shared between all modules
+        self.scheduler = default_scheduler()
+
     def start(self):
         """
         Starts background processing if the module requires it. Does nothing by default.
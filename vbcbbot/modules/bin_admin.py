@@ -1,29 +1,13 @@
+from vbcbbot.arrows import contains_arrow, split_waste_bin_toss
 from vbcbbot.modules import Module
 
 import logging
-import re
 import sqlite3
 import time
 
 __author__ = 'ondra'
 
 logger = logging.getLogger("vbcbbot.modules.bin_admin")
-special_right_arrows = "\u2192\u219d\u21a0\u21a3\u21a6\u21aa\u21ac\u21b1\u21b3\u21b7\u21c0" + \
-    "\u21c1\u21c9\u21d2\u21db\u21dd\u21e2\u21e5\u21e8\u21f4\u21f6\u21f8\u21fb\u21fe\u27f4" + \
-    "\u27f6\u27f9\u27fc\u27fe\u27ff\u2900\u2901\u2903\u2905\u2907\u290d\u290f\u2910\u2911" + \
-    "\u2914\u2915\u2916\u2917\u2918\u291a\u291c\u291e\u2920\u2933\u2937\u2939\u293f\u2942" + \
-    "\u2945\u2953\u2957\u295b\u295f\u2964\u296c\u296d\u2971\u2972\u2974\u2975\u2978\u2b43" + \
-    "\u2979\u2b44\u297c\u27a1\u2b0e\u2b0f\u2b46\u2b47\u2b48\u2b4c"
-
-arrow_re_string = "((?:[-=~>]*[>{sra}]+[-=~>]*)+)".format(sra=special_right_arrows)
-arrow_re = re.compile(arrow_re_string)
-arrow_waste_bin_re = re.compile(
-    "^" +  # beginning of the line
-    "(.+?)" +  # what to throw out
-    arrow_re_string +  # arrows
-    "(.*[tT][oO][nN][nN][eE].*)" +  # where to throw it out
-    "$"  # end of the line
-)
 
 
 class BinItem:
@@ -54,14 +38,14 @@ class BinAdmin(Module):
             #logger.debug("ignoring bot trigger {0}".format(repr(trigger)))
             return
 
-        match = arrow_waste_bin_re.match(body)
-        if match is not None:
+        toss = split_waste_bin_toss(body)
+        if toss is not None:
             # a waste bin toss has been found
-            what = match.group(1).strip()
-            arrow = match.group(2)
-            where = match.group(3).strip().lower()
+            (what, arrow, where) = toss
+            what = what.strip()
+            where = where.strip().lower()
 
-            if arrow_re.search(what) is not None or arrow_re.search(where) is not None:
+            if contains_arrow(what) or contains_arrow(where):
                 # this might get recursive...
                 logger.debug("{0} is trying to trick us by throwing {1} into {2}".format(
                     message.user_name, repr(what), repr(where))
@@ -83,6 +67,14 @@ class BinAdmin(Module):
                 """,
                 (where, what, arrow, message.user_name, timestamp)
             )
+            if cur.rowcount > 0:
+                cur.execute(
+                    """
+                    INSERT INTO bin_item_counts (bin, item_count) VALUES (?, 1)
+                    ON CONFLICT (bin) DO UPDATE SET item_count=item_count+1
+                    """,
+                    (where,)
+                )
             self.database.commit()
 
     def bin_exists(self, bin_name):
@@ -91,6 +83,111 @@ class BinAdmin(Module):
         bin_row = cur.fetchone()
         return bin_row is not None
 
+    def bin_item_count(self, bin_name):
+        cur = self.database.cursor()
+        cur.execute("SELECT item_count FROM bin_item_counts WHERE bin=?", (bin_name,))
+        count_row = cur.fetchone()
+        return count_row[0] if count_row is not None else 0
+
+    def send_bins_page(self, user_name, after_bin=None):
+        """
+        Output a page of known bins (ordered by name) and remember where to continue.
+        :param user_name: The name of the user who requested the listing.
+        :param after_bin: The name of the last bin already output, or None to start from the top.
+        """
+        cur = self.database.cursor()
+        if after_bin is None:
+            cur.execute("SELECT bin FROM bins ORDER BY bin LIMIT ?", (self.page_size,))
+        else:
+            cur.execute("SELECT bin FROM bins WHERE bin > ? ORDER BY bin LIMIT ?", (after_bin, self.page_size))
+        bins = [bin_row[0] for bin_row in cur]
+
+        if len(bins) == 0:
+            self.continuations.pop(user_name, None)
+            if after_bin is None:
+                self.connector.send_message("Ich kenne keine Tonnen.")
+            else:
+                self.connector.send_message("Mehr Tonnen kenne ich nicht.")
+            return
+
+        cur.execute("SELECT COUNT(*) FROM bins WHERE bin > ?", (bins[-1],))
+        remaining = cur.fetchone()[0]
+
+        if after_bin is not None:
+            msg = "Weitere Tonnen: "
+        elif len(bins) == 1:
+            msg = "Ich kenne folgende Tonne: "
+        else:
+            msg = "Ich kenne folgende Tonnen: "
+        msg += ", ".join(repr(waste_bin) for waste_bin in bins)
+        msg += self.continuation_hint(user_name, remaining, ("bins", bins[-1]))
+        self.connector.send_message(msg)
+
+    def send_bin_contents_page(self, user_name, bin_name, after=None):
+        """
+        Output a page of the contents of a bin (newest first) and remember where to continue.
+        :param user_name: The name of the user who requested the listing.
+        :param bin_name: The name of the bin whose contents to output.
+        :param after: The (timestamp, item) pair of the last item already output, or None to start
+        with the newest item.
+        """
+        cur = self.database.cursor()
+        if after is None:
+            cur.execute(
+                "SELECT item, timestamp FROM bin_items WHERE bin=? "
+                "ORDER BY timestamp DESC, item DESC LIMIT ?",
+                (bin_name, self.page_size)
+            )
+        else:
+            (after_timestamp, after_item) = after
+            cur.execute(
+                "SELECT item, timestamp FROM bin_items "
+                "WHERE bin=? AND (timestamp < ? OR (timestamp = ? AND item < ?)) "
+                "ORDER BY timestamp DESC, item DESC LIMIT ?",
+                (bin_name, after_timestamp, after_timestamp, after_item, self.page_size)
+            )
+        rows = cur.fetchall()
+
+        if len(rows) == 0:
+            self.continuations.pop(user_name, None)
+            if after is None:
+                self.connector.send_message("In dieser Tonne befindet sich nichts.")
+            else:
+                self.connector.send_message("Mehr befindet sich nicht in dieser Tonne.")
+            return
+
+        (last_item, last_timestamp) = rows[-1]
+        if after is None:
+            remaining = max(self.bin_item_count(bin_name) - len(rows), 0)
+        else:
+            # the bin may have changed since the listing started; count what is actually left
+            cur.execute(
+                "SELECT COUNT(*) FROM bin_items "
+                "WHERE bin=? AND (timestamp < ? OR (timestamp = ? AND item < ?))",
+                (bin_name, last_timestamp, last_timestamp, last_item)
+            )
+            remaining = cur.fetchone()[0]
+
+        if after is not None:
+            msg = "Au\u00dferdem befindet sich in dieser Tonne: "
+        elif len(rows) == 1:
+            msg = "In dieser Tonne befindet sich: "
+        else:
+            msg = "In dieser Tonne befinden sich: "
+        msg += ", ".join(item_row[0] for item_row in rows)
+        msg += self.continuation_hint(user_name, remaining, ("contents", bin_name, (last_timestamp, last_item)))
+        self.connector.send_message(msg)
+
+    def continuation_hint(self, user_name, remaining, continuation):
+        """
+        Remember (or forget) where the user's listing continues and return the hint to append.
+        """
+        if remaining <= 0:
+            self.continuations.pop(user_name, None)
+            return ""
+        self.continuations[user_name] = continuation
+        return " (noch {0} \u2013 !weiter)".format(remaining)
+
     def message_received(self, message):
         """Called by the communicator when a new message has been received."""
 
@@ -102,22 +199,7 @@ class BinAdmin(Module):
 
         if body == "!tonnen":
             logger.debug("bin overview request from " + message.user_name)
-
-            cur = self.database.cursor()
-            cur.execute("SELECT bin FROM bins")
-            bins = set()
-            for bin_row in cur:
-                bins.add(bin_row[0])
-
-            if len(bins) == 0:
-                self.connector.send_message("Ich kenne keine Tonnen.")
-                return
-            elif len(bins) == 1:
-                msg = "Ich kenne folgende Tonne: "
-            else:
-                msg = "Ich kenne folgende Tonnen: "
-            msg += ", ".join(repr(waste_bin) for waste_bin in bins)
-            self.connector.send_message(msg)
+            self.send_bins_page(message.user_name)
             return
 
         elif body.startswith("!tonneninhalt "):
@@ -129,21 +211,19 @@ class BinAdmin(Module):
                 self.connector.send_message("Diese Tonne kenne ich nicht.")
                 return
 
-            cur = self.database.cursor()
-            cur.execute("SELECT item FROM bin_items WHERE bin=?", (waste_bin_name,))
-            items = set()
-            for item_row in cur:
-                items.add(item_row[0])
+            self.send_bin_contents_page(message.user_name, waste_bin_name)
+            return
 
-            if len(items) == 0:
-                self.connector.send_message("In dieser Tonne befindet sich nichts.")
+        elif body == "!weiter":
+            continuation = self.continuations.get(message.user_name, None)
+            if continuation is None:
                 return
-            elif len(items) == 1:
-                msg = "In dieser Tonne befindet sich: "
+
+            if continuation[0] == "bins":
+                self.send_bins_page(message.user_name, continuation[1])
             else:
-                msg = "In dieser Tonne befinden sich: "
-            msg += ", ".join(items)
-            self.connector.send_message(msg)
+                (_, waste_bin_name, after) = continuation
+                self.send_bin_contents_page(message.user_name, waste_bin_name, after)
             return
 
         elif body.startswith("!entleere "):
@@ -157,6 +237,13 @@ class BinAdmin(Module):
 
             cur = self.database.cursor()
             cur.execute("DELETE FROM bin_items WHERE bin=?", (waste_bin_name,))
+            cur.execute("DELETE FROM bin_item_counts WHERE bin=?", (waste_bin_name,))
+            self.database.commit()
+
+            # listings of this bin have nothing left to continue with
+            for (user_name, continuation) in list(self.continuations.items()):
+                if continuation[0] == "contents" and continuation[1] == waste_bin_name:
+                    del self.continuations[user_name]
 
             self.connector.send_message("Tonne entleert.")
 
@@ -165,8 +252,10 @@ class BinAdmin(Module):
 
             cur = self.database.cursor()
             cur.execute("DELETE FROM bin_items")
+            cur.execute("DELETE FROM bin_item_counts")
             cur.execute("DELETE FROM bins")
             self.database.commit()
+            self.continuations.clear()
 
             self.connector.send_message("Tonnen abgesammelt.")
             return
@@ -197,6 +286,13 @@ class BinAdmin(Module):
                 nick = nick_line.strip()
                 self.banned.add(nick)
 
+        self.page_size = 20
+        if "page size" in config_section:
+            self.page_size = int(config_section["page size"])
+
+        # user name -> where their last listing continues
+        self.continuations = {}
+
         cursor = self.database.cursor()
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS bins (
@@ -214,4 +310,22 @@ class BinAdmin(Module):
             PRIMARY KEY (bin, item)
         )
         """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bin_item_counts (
+            bin TEXT NOT NULL REFERENCES bins (bin),
+            item_count INTEGER NOT NULL,
+            PRIMARY KEY (bin)
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_bin_items_recency ON bin_items (bin, timestamp, item)")
         self.database.commit()
+
+        # backfill the counts from older databases
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM bin_item_counts)")
+        have_counts = cursor.fetchone()[0]
+        if not have_counts:
+            cursor.execute("""
+            INSERT INTO bin_item_counts (bin, item_count)
+            SELECT bin, COUNT(*) FROM bin_items GROUP BY bin
+            """)
+            self.database.commit()
@@ -1,9 +1,12 @@
 from vbcbbot.modules import Module
 from vbcbbot.utils import remove_control_characters_and_strip
 
+import collections
 import logging
 import re
 import sqlite3
+import threading
+import time
 
 __author__ = 'ondra'
 
@@ -12,14 +15,71 @@ spy_trigger = re.compile("^!(echelon trigger) ([^;]+)[;](.+)$")
 stats_trigger = re.compile("^!(echelon incidents) (.+)$")
 
 
+def bucket_start(timestamp, bucket_seconds):
+    """
+    Return the start of the time bucket containing the given timestamp.
+    :param timestamp: The Unix timestamp to classify.
+    :param bucket_seconds: The size of each bucket in seconds.
+    :rtype: int
+    """
+    return (int(timestamp) // bucket_seconds) * bucket_seconds
+
+
+def describe_duration(seconds):
+    """
+    Return a short human-readable description of a duration.
+    :param seconds: The duration in seconds.
+    :rtype: str
+    """
+    for (unit_seconds, singular, plural) in ((60*60*24, "day", "days"), (60*60, "hour", "hours"),
+                                             (60, "minute", "minutes")):
+        if seconds % unit_seconds == 0:
+            count = seconds // unit_seconds
+            return "{0} {1}".format(count, singular if count == 1 else plural)
+    return "{0} seconds".format(seconds)
+
+
+class PatternCache:
+    """Caches compiled regular expressions keyed by their pattern string."""
+
+    def __init__(self):
+        self.pattern_strings_to_patterns = {}
+
+    def compile(self, pattern_string):
+        """
+        Return the compiled version of the pattern, compiling it only if it isn't cached yet.
+        :param pattern_string: The regular expression to compile.
+        :type pattern_string: str
+        :rtype: re.Pattern
+        """
+        pattern = self.pattern_strings_to_patterns.get(pattern_string, None)
+        if pattern is None:
+            pattern = re.compile(pattern_string)
+            self.pattern_strings_to_patterns[pattern_string] = pattern
+        return pattern
+
+    def retain_only(self, pattern_strings):
+        """
+        Drop all cached patterns except the given ones.
+        :param pattern_strings: The pattern strings whose compiled patterns to keep.
+        """
+        keep = set(pattern_strings)
+        self.pattern_strings_to_patterns = {
+            ps: pat for (ps, pat) in self.pattern_strings_to_patterns.items() if ps in keep
+        }
+
+
 class Trigger:
     """A trigger describing a username/pattern pair."""
 
-    def __init__(self, trigger_id, user_name, pattern_string):
+    def __init__(self, trigger_id, user_name, pattern_string, pattern_cache=None):
         self.trigger_id = trigger_id
         self.user_name_lower = user_name.lower()
         self.pattern_string = pattern_string
-        self.pattern = re.compile(pattern_string)
+        if pattern_cache is None:
+            self.pattern = re.compile(pattern_string)
+        else:
+            self.pattern = pattern_cache.compile(pattern_string)
 
     def __repr__(self):
         return "Trigger({0}, {1}, {2})".format(
@@ -28,6 +88,77 @@ class Trigger:
             repr(self.pattern_string)
         )
 
+    def is_combinable(self):
+        """
+        Whether this trigger's pattern can be merged into a combined alternation. Patterns with
+        capturing groups (which might be referenced by backreferences) or global inline flags
+        would change meaning when embedded and are matched on their own instead.
+        :rtype: bool
+        """
+        if self.pattern.groups > 0:
+            return False
+        try:
+            re.compile("(?:{0})".format(self.pattern_string))
+        except re.error:
+            return False
+        return True
+
+
+class TriggerMatcher:
+    """
+    Matches all the triggers of a single user against a message body. A combined alternation of
+    the triggers is used as a one-pass prefilter; only if it matches is each trigger run on its own,
+    so that every trigger's matches are counted exactly as if it were the only one.
+    """
+
+    def __init__(self, triggers):
+        """
+        Compile the combined prefilter for the triggers.
+        :param triggers: The triggers to match.
+        :type triggers: list[Trigger]
+        """
+        self.triggers = list(triggers)
+        self.standalone_triggers = []
+
+        alternatives = []
+        for trigger in self.triggers:
+            if not trigger.is_combinable():
+                self.standalone_triggers.append(trigger)
+                continue
+            alternatives.append("(?:{0})".format(trigger.pattern_string))
+
+        # not cached: it changes with every change to the user's triggers
+        self.combined_pattern = None
+        if len(alternatives) > 0:
+            self.combined_pattern = re.compile("|".join(alternatives))
+
+    def pattern_strings(self):
+        """
+        Return the pattern strings of the triggers used by this matcher.
+        :rtype: list[str]
+        """
+        return [trigger.pattern_string for trigger in self.triggers]
+
+    def find_trigger_ids(self, body):
+        """
+        Find all trigger matches within the body.
+        :param body: The message body to scan.
+        :type body: str
+        :return: The ID of the matching trigger for each match found.
+        :rtype: list[int]
+        """
+        if self.combined_pattern is not None and self.combined_pattern.search(body) is not None:
+            # at least one of them matches; count each one's matches separately
+            triggers = self.triggers
+        else:
+            triggers = self.standalone_triggers
+
+        ret = []
+        for trigger in triggers:
+            for _ in trigger.pattern.finditer(body):
+                ret.append(trigger.trigger_id)
+        return ret
+
 
 class Echelon(Module):
     """Not a part of the NSA's ECHELON program."""
@@ -37,35 +168,72 @@ class Echelon(Module):
         if stats_match is None:
             return
 
+        target_name_lower = stats_match.group(2).lower()
+
         cursor = self.database.cursor()
         cursor.execute(
-            "SELECT COUNT(*) FROM incidents WHERE trigger_id IN ("
-            "SELECT trigger_id FROM triggers WHERE target_name_lower=?"
-            ")",
-            (stats_match.group(2).lower(),)
+            "SELECT incident_count FROM incident_counts_by_target WHERE target_name_lower=?",
+            (target_name_lower,)
         )
-        the_count = None
+        the_count = 0
         for row in cursor:
             the_count = row[0]
 
         salutation = "Spymaster" if message.user_name in self.spymasters else "Agent"
 
-        if the_count is None:
-            self.connector.send_message(
-                "{2} {0}: Subject {1} may or may not have caused any incident.".format(
-                    message.user_name, stats_match.group(2), salutation
-                )
+        rate_string = ""
+        if self.bucket_seconds is not None and self.rate_buckets > 0:
+            recent_count = self.recent_incident_count(target_name_lower)
+            rate_string = " ({0} during the last {1})".format(
+                recent_count, describe_duration(self.bucket_seconds * self.rate_buckets)
             )
-        else:
-            self.connector.send_message(
-                "{4} {0}: Subject {1} may or may not have caused {2} {3}.".format(
-                    message.user_name,
-                    stats_match.group(2),
-                    the_count,
-                    "incident" if the_count == 1 else "incidents",
-                    salutation
-                )
+
+        self.connector.send_message(
+            "{4} {0}: Subject {1} may or may not have caused {2} {3}{5}.".format(
+                message.user_name,
+                stats_match.group(2),
+                the_count,
+                "incident" if the_count == 1 else "incidents",
+                salutation,
+                rate_string
             )
+        )
+
+    def recent_incident_count(self, target_name_lower):
+        """
+        Return the number of incidents caused by the given target within the rate window.
+        :param target_name_lower: The lowercase name of the target.
+        :type target_name_lower: str
+        :rtype: int
+        """
+        cursor = self.database.cursor()
+        cursor.execute(
+            "SELECT COALESCE(SUM(incident_count), 0) FROM incident_counts_by_bucket "
+            "WHERE target_name_lower=? AND bucket_start >= ?",
+            (target_name_lower, self.rate_window_start())
+        )
+        ret = cursor.fetchone()[0]
+        cursor.close()
+        return ret
+
+    def rate_window_start(self):
+        """
+        Return the start of the oldest bucket within the rate window.
+        :rtype: int
+        """
+        current_bucket = bucket_start(time.time(), self.bucket_seconds)
+        return current_bucket - (self.rate_buckets - 1) * self.bucket_seconds
+
+    def prune_buckets(self, cursor):
+        """
+        Delete the buckets which have left the rate window. Only does so once per bucket.
+        :type cursor: sqlite3.Cursor
+        """
+        window_start = self.rate_window_start()
+        if window_start == self.buckets_pruned_before:
+            return
+        cursor.execute("DELETE FROM incident_counts_by_bucket WHERE bucket_start < ?", (window_start,))
+        self.buckets_pruned_before = window_start
 
     def potential_spy(self, message, body):
         spy_match = spy_trigger.match(body)
@@ -83,14 +251,13 @@ class Echelon(Module):
         username = spy_match.group(2).strip()
         regex = spy_match.group(3).strip()
 
-        cursor = self.database.cursor()
-        cursor.execute(
-            "INSERT INTO triggers (target_name_lower, regex, spymaster_name) VALUES (?, ?, ?)",
-            (username.lower(), regex, message.user_name)
-        )
-        self.database.commit()
-
-        self.reload_triggers()
+        try:
+            self.add_trigger(username, regex, message.user_name)
+        except re.error as err:
+            self.connector.send_message("Spymaster {0}: Invalid pattern ({1}).".format(
+                message.user_name, err
+            ))
+            return
 
         self.connector.send_message("Spymaster {0}: Done.".format(message.user_name))
 
@@ -113,29 +280,263 @@ class Echelon(Module):
 
         # spy on messages from banned users too
 
-        if lower_sender_name in self.lowercase_user_names_to_triggers:
-            for trigger in self.lowercase_user_names_to_triggers[lower_sender_name]:
-                cursor = self.database.cursor()
-                for match in trigger.pattern.finditer(body):
-                    # trigger matched. log this.
-                    cursor.execute(
-                        "INSERT INTO incidents (trigger_id, message_id, timestamp) VALUES (?, ?, ?)",
-                        (trigger.trigger_id, message.id, message.timestamp)
-                    )
-                self.database.commit()
+        matcher = self.lowercase_user_names_to_matchers.get(lower_sender_name, None)
+        if matcher is None:
+            return
 
-    def reload_triggers(self):
+        trigger_ids = matcher.find_trigger_ids(body)
+        if len(trigger_ids) == 0:
+            return
+
+        # trigger(s) matched. log this.
         cursor = self.database.cursor()
+        cursor.executemany(
+            "INSERT INTO incidents (trigger_id, message_id, timestamp) VALUES (?, ?, ?)",
+            ((trigger_id, message.id, message.timestamp) for trigger_id in trigger_ids)
+        )
 
-        self.lowercase_user_names_to_triggers = {}
-        cursor.execute("SELECT trigger_id, target_name_lower, regex FROM triggers")
-        for row in cursor:
-            trig = Trigger(row[0], row[1], row[2])
-            if trig.user_name_lower not in self.lowercase_user_names_to_triggers:
-                self.lowercase_user_names_to_triggers[trig.user_name_lower] = [trig]
+        # keep the counters in sync (same transaction)
+        cursor.executemany(
+            "INSERT INTO incident_counts_by_trigger (trigger_id, incident_count) VALUES (?, ?) "
+            "ON CONFLICT (trigger_id) DO UPDATE SET incident_count=incident_count+excluded.incident_count",
+            collections.Counter(trigger_ids).items()
+        )
+        cursor.execute(
+            "INSERT INTO incident_counts_by_target (target_name_lower, incident_count) VALUES (?, ?) "
+            "ON CONFLICT (target_name_lower) DO UPDATE SET incident_count=incident_count+excluded.incident_count",
+            (lower_sender_name, len(trigger_ids))
+        )
+        if self.bucket_seconds is not None:
+            cursor.execute(
+                "INSERT INTO incident_counts_by_bucket (target_name_lower, bucket_start, incident_count) "
+                "VALUES (?, ?, ?) "
+                "ON CONFLICT (target_name_lower, bucket_start) "
+                "DO UPDATE SET incident_count=incident_count+excluded.incident_count",
+                (lower_sender_name, bucket_start(message.timestamp, self.bucket_seconds), len(trigger_ids))
+            )
+            self.prune_buckets(cursor)
+        self.database.commit()
+
+    def swap_in_triggers(self, changed_user_names_to_triggers):
+        """
+        Rebuild the matchers of the given users and atomically replace the user-to-matcher map.
+        Must be called with trigger_lock held.
+        :param changed_user_names_to_triggers: The complete new list of triggers for each user
+        whose triggers have changed. An empty list removes the user's matcher.
+        :type changed_user_names_to_triggers: dict[str, list[Trigger]]
+        """
+        # copy-on-write: readers keep using the old map until the new one is complete
+        new_matchers = dict(self.lowercase_user_names_to_matchers)
+        for (user_name_lower, triggers) in changed_user_names_to_triggers.items():
+            if len(triggers) == 0:
+                new_matchers.pop(user_name_lower, None)
             else:
-                self.lowercase_user_names_to_triggers[trig.user_name_lower].append(trig)
+                new_matchers[user_name_lower] = TriggerMatcher(triggers)
+        self.lowercase_user_names_to_matchers = new_matchers
+
+        # forget the patterns of replaced and removed triggers
+        used_pattern_strings = []
+        for matcher in new_matchers.values():
+            used_pattern_strings.extend(matcher.pattern_strings())
+        self.pattern_cache.retain_only(used_pattern_strings)
+
+    def triggers_for_user(self, user_name_lower):
+        """
+        Return a copy of the list of triggers currently active for the given user.
+        :rtype: list[Trigger]
+        """
+        matcher = self.lowercase_user_names_to_matchers.get(user_name_lower, None)
+        if matcher is None:
+            return []
+        return list(matcher.triggers)
+
+    def find_trigger(self, trigger_id):
+        """
+        Return the currently active trigger with the given ID, or None.
+        :rtype: Trigger|None
+        """
+        for matcher in self.lowercase_user_names_to_matchers.values():
+            for trigger in matcher.triggers:
+                if trigger.trigger_id == trigger_id:
+                    return trigger
+        return None
+
+    def add_trigger(self, user_name, pattern_string, spymaster_name):
+        """
+        Add a new trigger, store it in the database and start matching it.
+        :raises re.error: If the pattern is not a valid regular expression.
+        :return: The new trigger.
+        :rtype: Trigger
+        """
+        with self.trigger_lock:
+            # compile first so that invalid patterns never reach the database
+            self.pattern_cache.compile(pattern_string)
+
+            cursor = self.database.cursor()
+            cursor.execute(
+                "INSERT INTO triggers (target_name_lower, regex, spymaster_name) VALUES (?, ?, ?)",
+                (user_name.lower(), pattern_string, spymaster_name)
+            )
+            self.database.commit()
+            trigger = Trigger(cursor.lastrowid, user_name, pattern_string, self.pattern_cache)
+            cursor.close()
+
+            triggers = self.triggers_for_user(trigger.user_name_lower)
+            triggers.append(trigger)
+            self.swap_in_triggers({trigger.user_name_lower: triggers})
+            return trigger
+
+    def remove_trigger(self, trigger_id):
+        """
+        Remove the trigger with the given ID from the database and stop matching it.
+        :return: True if the trigger existed, False otherwise.
+        :rtype: bool
+        """
+        with self.trigger_lock:
+            trigger = self.find_trigger(trigger_id)
+            if trigger is None:
+                return False
+
+            cursor = self.database.cursor()
+            cursor.execute("DELETE FROM triggers WHERE trigger_id=?", (trigger_id,))
+            self.database.commit()
+            cursor.close()
+
+            triggers = [t for t in self.triggers_for_user(trigger.user_name_lower) if t.trigger_id != trigger_id]
+            self.swap_in_triggers({trigger.user_name_lower: triggers})
+            return True
+
+    def update_trigger(self, trigger_id, pattern_string):
+        """
+        Replace the pattern of the trigger with the given ID.
+        :raises re.error: If the pattern is not a valid regular expression.
+        :return: True if the trigger existed, False otherwise.
+        :rtype: bool
+        """
+        with self.trigger_lock:
+            trigger = self.find_trigger(trigger_id)
+            if trigger is None:
+                return False
 
+            new_trigger = Trigger(trigger_id, trigger.user_name_lower, pattern_string, self.pattern_cache)
+
+            cursor = self.database.cursor()
+            cursor.execute("UPDATE triggers SET regex=? WHERE trigger_id=?", (pattern_string, trigger_id))
+            self.database.commit()
+            cursor.close()
+
+            triggers = [
+                new_trigger if t.trigger_id == trigger_id else t
+                for t in self.triggers_for_user(trigger.user_name_lower)
+            ]
+            self.swap_in_triggers({trigger.user_name_lower: triggers})
+            return True
+
+    def reload_triggers(self):
+        """
+        Re-read all triggers from the database. Unchanged patterns are taken from the pattern
+        cache instead of being recompiled.
+        """
+        with self.trigger_lock:
+            cursor = self.database.cursor()
+
+            user_names_to_triggers = {}
+            cursor.execute("SELECT trigger_id, target_name_lower, regex FROM triggers")
+            for row in cursor:
+                try:
+                    trig = Trigger(row[0], row[1], row[2], self.pattern_cache)
+                except re.error:
+                    logger.exception("invalid pattern in trigger {0}".format(row[0]))
+                    continue
+                if trig.user_name_lower not in user_names_to_triggers:
+                    user_names_to_triggers[trig.user_name_lower] = [trig]
+                else:
+                    user_names_to_triggers[trig.user_name_lower].append(trig)
+
+            cursor.close()
+
+            # users who no longer have any triggers
+            for user_name_lower in self.lowercase_user_names_to_matchers.keys():
+                if user_name_lower not in user_names_to_triggers:
+                    user_names_to_triggers[user_name_lower] = []
+
+            self.swap_in_triggers(user_names_to_triggers)
+
+    def potential_backfill(self):
+        """
+        Fill the incident counter tables from the incidents table if they have never been filled
+        (e.g. for a database created before the counters existed).
+        """
+        cursor = self.database.cursor()
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM incident_counts_by_trigger)")
+        have_counters = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM incidents)")
+        have_incidents = cursor.fetchone()[0]
+        if have_counters or not have_incidents:
+            cursor.close()
+            return
+
+        logger.info("backfilling incident counters")
+        cursor.execute("""
+        INSERT INTO incident_counts_by_trigger (trigger_id, incident_count)
+        SELECT trigger_id, COUNT(*) FROM incidents GROUP BY trigger_id
+        """)
+        cursor.execute("DELETE FROM incident_counts_by_target")
+        cursor.execute("""
+        INSERT INTO incident_counts_by_target (target_name_lower, incident_count)
+        SELECT t.target_name_lower, SUM(c.incident_count)
+        FROM incident_counts_by_trigger c
+        INNER JOIN triggers t ON t.trigger_id = c.trigger_id
+        GROUP BY t.target_name_lower
+        """)
+        self.database.commit()
+        cursor.close()
+
+    def potential_bucket_backfill(self):
+        """
+        Rebuild the buckets of the rate window from the incidents table if they are missing or out
+        of date, e.g. because "bucket seconds" has been turned on (or changed) after incidents have
+        been recorded; then prune the buckets which have left the window.
+        """
+        if self.bucket_seconds is None:
+            return
+
+        cursor = self.database.cursor()
+        window_start = self.rate_window_start()
+
+        cursor.execute(
+            "SELECT i.timestamp FROM incidents i INNER JOIN triggers t ON t.trigger_id = i.trigger_id "
+            "ORDER BY i.incident_id DESC LIMIT 1"
+        )
+        row = cursor.fetchone()
+        latest_incident_bucket = bucket_start(row[0], self.bucket_seconds) if row is not None else None
+        cursor.execute("SELECT MAX(bucket_start) FROM incident_counts_by_bucket")
+        latest_bucket = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM incident_counts_by_bucket WHERE bucket_start % ? != 0)",
+            (self.bucket_seconds,)
+        )
+        other_bucket_size = cursor.fetchone()[0]
+
+        missing_buckets = (
+            latest_incident_bucket is not None and
+            latest_incident_bucket >= window_start and
+            (latest_bucket is None or latest_bucket < latest_incident_bucket)
+        )
+        if missing_buckets or other_bucket_size:
+            logger.info("backfilling incident buckets")
+            cursor.execute("DELETE FROM incident_counts_by_bucket")
+            cursor.execute("""
+            INSERT INTO incident_counts_by_bucket (target_name_lower, bucket_start, incident_count)
+            SELECT t.target_name_lower, (CAST(i.timestamp AS INTEGER) / ?) * ?, COUNT(*)
+            FROM incidents i
+            INNER JOIN triggers t ON t.trigger_id = i.trigger_id
+            WHERE i.timestamp >= ?
+            GROUP BY t.target_name_lower, (CAST(i.timestamp AS INTEGER) / ?) * ?
+            """, (self.bucket_seconds, self.bucket_seconds, window_start, self.bucket_seconds, self.bucket_seconds))
+
+        self.prune_buckets(cursor)
+        self.database.commit()
         cursor.close()
 
     def __init__(self, connector, config_section):
@@ -155,6 +556,17 @@ class Echelon(Module):
         else:
             self.database = sqlite3.connect(":memory:", check_same_thread=False)
 
+        self.bucket_seconds = None
+        if "bucket seconds" in config_section:
+            self.bucket_seconds = int(config_section["bucket seconds"])
+
+        self.rate_buckets = 24
+        if "rate buckets" in config_section:
+            self.rate_buckets = int(config_section["rate buckets"])
+
+        # the start of the rate window when the buckets were last pruned
+        self.buckets_pruned_before = None
+
         self.spymasters = set()
         if "spymasters" in config_section:
             for line in config_section["spymasters"].split("\n"):
@@ -180,8 +592,38 @@ class Echelon(Module):
             timestamp INTEGER NOT NULL
         )
         """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS incident_counts_by_trigger (
+            trigger_id INTEGER NOT NULL REFERENCES triggers (trigger_id),
+            incident_count INTEGER NOT NULL,
+            PRIMARY KEY (trigger_id)
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS incident_counts_by_target (
+            target_name_lower TEXT NOT NULL,
+            incident_count INTEGER NOT NULL,
+            PRIMARY KEY (target_name_lower)
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS incident_counts_by_bucket (
+            target_name_lower TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            incident_count INTEGER NOT NULL,
+            PRIMARY KEY (target_name_lower, bucket_start)
+        )
+        """)
         cursor.execute("CREATE INDEX IF NOT EXISTS index_target_name_lower ON triggers (target_name_lower)")
         self.database.commit()
         cursor.close()
 
+        self.potential_backfill()
+        self.potential_bucket_backfill()
+
+        self.pattern_cache = PatternCache()
+        self.trigger_lock = threading.Lock()
+        self.lowercase_user_names_to_matchers = {}
+        """:type: dict[str, TriggerMatcher]"""
+
         self.reload_triggers()
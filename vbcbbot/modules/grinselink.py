@@ -1,3 +1,4 @@
+from vbcbbot.message_window import MessageWindow
 from vbcbbot.modules import Module
 
 import logging
@@ -20,36 +21,30 @@ class Grinselink(Module):
 
         logger.debug("{0}'s message edited!".format(message.user_name))
 
-        if message.id in self.known_grinselink_ids:
+        if self.recent_messages_reacted_to.get(message.id, False):
             # we already reacted to this
             return
 
-        body_lxml = message.body_lxml()
-        for _ in body_lxml.iterfind(".//a[@href]"):
+        if message.body_index().has_links():
             logger.info("detected stealth Grinselink")
-            self.known_grinselink_ids.add(message.id)
+            self.recent_messages_reacted_to.replace(message.id, True)
             self.connector.send_message(self.message_to_post_stealth)
-            return
 
     def message_received(self, message):
         """Called by the communicator when a new message has been received."""
 
-        # cull old posts
-        for known_message_id in list(self.known_grinselink_ids):
-            if abs(known_message_id - message.id) > remember_this_many_posts:
-                self.known_grinselink_ids.remove(known_message_id)
+        # the oldest post falls out of the window
+        self.recent_messages_reacted_to.add(message.id, False)
 
         if message.user_name != self.username_to_monitor:
             return
 
         logger.debug("message posted by {0}!".format(message.user_name))
 
-        body_lxml = message.body_lxml()
-        for _ in body_lxml.iterfind(".//a[@href]"):
+        if message.body_index().has_links():
             logger.info("detected Grinselink")
-            self.known_grinselink_ids.add(message.id)
+            self.recent_messages_reacted_to.replace(message.id, True)
             self.connector.send_message(self.message_to_post)
-            return
 
     def __init__(self, connector, config_section):
         """
@@ -66,4 +61,5 @@ class Grinselink(Module):
         self.message_to_post = config_section["message to post"]
         self.message_to_post_stealth = config_section["message to post stealth"]
 
-        self.known_grinselink_ids = set()
+        # message ID -> whether we have reacted to it
+        self.recent_messages_reacted_to = MessageWindow(remember_this_many_posts)
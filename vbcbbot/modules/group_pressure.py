@@ -1,10 +1,169 @@
 from vbcbbot.modules import Module
+import collections
 import logging
 
 __author__ = 'ondra'
 logger = logging.getLogger("vbcbbot.modules.group_pressure")
 
 
+class BodyTally:
+    """Keeps track of who has recently sent a specific message body."""
+    __slots__ = ("entry_count", "reset_sequence", "senders_to_counts")
+
+    def __init__(self):
+        # how many entries in the window have this body
+        self.entry_count = 0
+        # only entries after this one are counted (the bot has said it already)
+        self.reset_sequence = -1
+        self.senders_to_counts = {}
+        """:type: dict[str, int]"""
+
+
+class SlidingWindow:
+    """
+    The most recent messages, along with who has sent each message body since the bot last sent it.
+    Adding, evicting and editing a message takes constant time.
+    """
+
+    def __init__(self, size, trigger_count, own_name):
+        """
+        :param size: How many messages to keep.
+        :param trigger_count: How many different senders make a message body pressing.
+        :param own_name: The name of the bot, whose messages reset the count for their bodies.
+        """
+        self.size = size
+        self.trigger_count = trigger_count
+        self.own_name = own_name
+        self.next_sequence = 0
+
+        # entries are [sequence, message ID, sender, body]
+        self.entries = collections.deque()
+        self.message_ids_to_entries = {}
+        self.bodies_to_tallies = {}
+        """:type: dict[str, BodyTally]"""
+
+        # bodies sent by at least trigger_count users (a dict to keep the insertion order)
+        self.pressing_bodies = {}
+
+        # the sequence numbers up to which reset() has discarded each body's senders; kept (in a
+        # dict and, for pruning, in the order they were made) while older entries remain in the
+        # window, since these might still be edited into the body
+        self.bodies_to_reset_marks = {}
+        self.reset_marks = collections.deque()
+
+    def count(self, entry):
+        (sequence, _, sender, body) = entry
+        tally = self.bodies_to_tallies.get(body, None)
+        if tally is None:
+            tally = BodyTally()
+            tally.reset_sequence = self.bodies_to_reset_marks.get(body, -1)
+            self.bodies_to_tallies[body] = tally
+        tally.entry_count += 1
+
+        if sender == self.own_name:
+            # (when recounting, a later reset() may already have been applied)
+            self.reset_tally(body, tally, max(sequence, tally.reset_sequence))
+            return
+
+        if sequence > tally.reset_sequence:
+            tally.senders_to_counts[sender] = tally.senders_to_counts.get(sender, 0) + 1
+            if len(tally.senders_to_counts) >= self.trigger_count:
+                self.pressing_bodies[body] = True
+
+    def uncount(self, entry):
+        (sequence, _, sender, body) = entry
+        tally = self.bodies_to_tallies[body]
+        tally.entry_count -= 1
+
+        if sender != self.own_name and sequence > tally.reset_sequence:
+            remaining = tally.senders_to_counts[sender] - 1
+            if remaining == 0:
+                del tally.senders_to_counts[sender]
+                if len(tally.senders_to_counts) < self.trigger_count:
+                    self.pressing_bodies.pop(body, None)
+            else:
+                tally.senders_to_counts[sender] = remaining
+
+        if tally.entry_count == 0:
+            del self.bodies_to_tallies[body]
+
+    def reset_tally(self, body, tally, sequence):
+        tally.reset_sequence = sequence
+        tally.senders_to_counts.clear()
+        self.pressing_bodies.pop(body, None)
+
+    def add(self, message_id, sender, body):
+        """Add a new message, evicting the oldest one if the window is full."""
+        while len(self.entries) >= self.size:
+            old_entry = self.entries.popleft()
+            if self.message_ids_to_entries.get(old_entry[1], None) is old_entry:
+                del self.message_ids_to_entries[old_entry[1]]
+            self.uncount(old_entry)
+
+        entry = [self.next_sequence, message_id, sender, body]
+        self.next_sequence += 1
+        self.entries.append(entry)
+        self.message_ids_to_entries[message_id] = entry
+        self.count(entry)
+
+        # reset marks older than every entry in the window don't affect anything anymore
+        oldest_sequence = self.entries[0][0]
+        while len(self.reset_marks) > 0 and self.reset_marks[0][0] < oldest_sequence:
+            (mark, marked_body) = self.reset_marks.popleft()
+            if self.bodies_to_reset_marks.get(marked_body, None) == mark:
+                del self.bodies_to_reset_marks[marked_body]
+
+    def edit(self, message_id, body):
+        """
+        Replace the body of a message in the window.
+        :return: Whether the message was in the window.
+        :rtype: bool
+        """
+        entry = self.message_ids_to_entries.get(message_id, None)
+        if entry is None:
+            return False
+        if entry[3] == body:
+            return True
+
+        if entry[2] == self.own_name:
+            # moves a reset point, which the counts can't be adjusted for incrementally
+            entry[3] = body
+            self.recount()
+            return True
+
+        self.uncount(entry)
+        entry[3] = body
+        self.count(entry)
+        return True
+
+    def reset(self, body):
+        """Forget who has sent the body so far (e.g. because the bot has just sent it)."""
+        mark = self.next_sequence - 1
+        self.bodies_to_reset_marks[body] = mark
+        self.reset_marks.append((mark, body))
+
+        tally = self.bodies_to_tallies.get(body, None)
+        if tally is not None:
+            self.reset_tally(body, tally, mark)
+
+    def recount(self):
+        """Rebuild all the counts from the messages in the window (and the reset marks)."""
+        self.bodies_to_tallies = {}
+        self.pressing_bodies = {}
+        for entry in self.entries:
+            self.count(entry)
+
+    def senders(self, body):
+        """
+        Return who has sent the body since the bot last did.
+        :rtype: set[str]
+        """
+        tally = self.bodies_to_tallies.get(body, None)
+        if tally is None:
+            return set()
+        return set(tally.senders_to_counts.keys())
+
+
 class GroupPressure(Module):
     """
     Submit to group pressure: if enough people say a specific thing in the last X messages, join in
@@ -20,54 +179,26 @@ class GroupPressure(Module):
             # nope
             return
 
-        # clean out the backlog
-        if len(self.backlog) >= self.backlog_size:
-            difference = len(self.backlog) - self.backlog_size
-            self.backlog = self.backlog[difference:]
-
         if modified:
             # find the message in the backlog and modify it
-            new_backlog = []
-            for (message_id, message_sender, message_body) in self.backlog:
-                if message_id == message.id:
-                    # store the updated version
-                    new_backlog.append((message.id, message.user_name, body))
-                else:
-                    # port it unchanged
-                    new_backlog.append((message_id, message_sender, message_body))
-            self.backlog = new_backlog
+            self.window.edit(message.id, body)
         else:
             # simply append the message
-            self.backlog.append((message.id, message.user_name, body))
+            self.window.add(message.id, message.user_name, body)
 
         if initial_salvo:
             return
 
-        # perform accounting
-        message_senders = {}
-        for (message_id, sender, message) in self.backlog:
-            if sender == self.connector.username:
-                # this is my message -- start counting from zero, so to speak
-                message_senders[message] = set()
-            elif message not in message_senders:
-                # one occurrence
-                message_senders[message] = {sender}
-            else:
-                # add this message's sender to the set of senders
-                # (ignores dupes)
-                message_senders[message].add(sender)
-
         # find some group pressure to bow to
-        for (message, senders) in message_senders.items():
-            if len(senders) >= self.trigger_count:
-                logger.debug("bowing to the group pressure of {0} sending {1}".format(
-                    repr(senders), repr(message)
-                ))
-                # submit to group pressure
-                self.connector.send_message(message)
+        for pressing_body in list(self.window.pressing_bodies.keys()):
+            logger.debug("bowing to the group pressure of {0} sending {1}".format(
+                repr(self.window.senders(pressing_body)), repr(pressing_body)
+            ))
+            # submit to group pressure
+            self.connector.send_message(pressing_body)
 
-                # fake this message into the backlog to prevent duplicates
-                self.backlog.append((-1, self.connector.username, message))
+            # start counting from zero to prevent duplicates
+            self.window.reset(pressing_body)
 
     def __init__(self, connector, config_section):
         Module.__init__(self, connector, config_section)
@@ -79,4 +210,4 @@ class GroupPressure(Module):
         if "trigger count" in config_section:
             self.trigger_count = int(config_section["trigger count"])
 
-        self.backlog = []
+        self.window = SlidingWindow(self.backlog_size, self.trigger_count, self.connector.username)
@@ -1,13 +1,28 @@
 from vbcbbot.html_decompiler import SmileyText
+from vbcbbot.message_window import MessageWindow
 from vbcbbot.modules import Module
 from vbcbbot.utils import RegexMatcher
 
 import base64
+import concurrent.futures
+import email.utils
+import gzip
+import hashlib
 import http.server
+import json
 import logging
+import mimetypes
+import os
+import select
+import socket
 import threading
 import time
-from urllib.parse import unquote_plus, urljoin
+from urllib.parse import parse_qs, unquote_plus, urljoin, urlsplit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 __author__ = 'ondra'
 
@@ -15,42 +30,69 @@ logger = logging.getLogger("vbcbbot.modules.http_interface")
 editor_regex = RegexMatcher("^/editor/([1-9][0-9]*)$")
 
 
+def html_escape_table(escape_quotes, escape_apostrophes):
+    table = {ord("<"): "&lt;", ord(">"): "&gt;", ord("&"): "&amp;", ord("\n"): "<br/>\n"}
+    if escape_quotes:
+        table[ord('"')] = "&quot;"
+    if escape_apostrophes:
+        table[ord("'")] = "&apos;"
+    return table
+
+
+def js_escape_table(escape_quotes, escape_apostrophes):
+    table = {ord("\\"): "\\\\"}
+    if escape_quotes:
+        table[ord('"')] = '\\"'
+    if escape_apostrophes:
+        table[ord("'")] = "\\'"
+    return table
+
+
+# for str.translate, by (escape_quotes, escape_apostrophes)
+html_escape_tables = {(q, a): html_escape_table(q, a) for q in (False, True) for a in (False, True)}
+js_escape_tables = {(q, a): js_escape_table(q, a) for q in (False, True) for a in (False, True)}
+
+
 def html_escape(s, escape_quotes=True, escape_apostrophes=False):
-    ret = ""
-    strange = str(s)
-    for c in strange:
-        if c == "<":
-            ret += "&lt;"
-        elif c == ">":
-            ret += "&gt;"
-        elif c == "&":
-            ret += "&amp;"
-        elif escape_quotes and c == '"':
-            ret += "&quot;"
-        elif escape_apostrophes and c == "'":
-            ret += "&apos;"
-        elif ord(c) > 0x7E:
-            ret += "&#{0};".format(ord(c))
-        elif c == "\n":
-            ret += "<br/>\n"
-        else:
-            ret += c
-    return ret
+    """
+    Escape text for inclusion in HTML, turning line breaks into <br/> tags. Characters beyond ASCII
+    are left alone; the output is served as UTF-8.
+    """
+    return str(s).translate(html_escape_tables[(bool(escape_quotes), bool(escape_apostrophes))])
 
 
 def js_escape_string(s, escape_quotes=True, escape_apostrophes=False):
-    ret = ""
-    strange = str(s)
-    for c in strange:
-        if c == "\\":
-            ret += "\\\\"
-        elif escape_quotes and c == '"':
-            ret += '\\"'
-        elif escape_apostrophes and c == "'":
-            ret += "\\'"
-        else:
-            ret += c
-    return ret
+    """Escape text for inclusion in a JavaScript string literal."""
+    return str(s).translate(js_escape_tables[(bool(escape_quotes), bool(escape_apostrophes))])
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """
+    Return whether the value of an Accept-Encoding header allows the given content coding.
+    :type accept_encoding: str|None
+    :type encoding: str
+    :rtype: bool
+    """
+    if accept_encoding is None:
+        return False
+    for coding in accept_encoding.split(","):
+        pieces = [piece.strip() for piece in coding.split(";")]
+        if pieces[0].lower() not in (encoding, "*"):
+            continue
+        for param in pieces[1:]:
+            if param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                return False
+        return True
+    return False
+
+
+# BBCode elements rendered as a fixed pair of tags around their contents
+simple_element_tags = {
+    "h": ('<sup>', '</sup>'),
+    "t": ('<sub>', '</sub>'),
+    "strike": ('<span class="strike" style="text-decoration:line-through">', '</span>'),
+    "spoiler": ('<span class="spoiler">', '</span>'),
+}
 
 
 def robust_urljoin(base, tail):
@@ -61,64 +103,290 @@ def robust_urljoin(base, tail):
 
 
 def dom_to_html(body_dom, base_url):
-    ret = ""
+    pieces = []
+    append_dom_html(pieces, body_dom, base_url)
+    return "".join(pieces)
+
+
+def append_dom_html(pieces, body_dom, base_url):
+    """
+    Render the nodes of a decompiled message body as HTML, appending the pieces to the given list.
+    :type pieces: list[str]
+    """
     for node in body_dom:
         if node.is_element():
             if node.name == "url":
-                ret += '<a class="url" href="{url}">{inside}</a>'.format(
-                    url=html_escape(robust_urljoin(base_url, node.attribute_value)),
-                    inside=dom_to_html(node.children, base_url)
-                )
+                pieces.append('<a class="url" href="')
+                pieces.append(html_escape(robust_urljoin(base_url, node.attribute_value)))
+                pieces.append('">')
+                append_dom_html(pieces, node.children, base_url)
+                pieces.append('</a>')
             elif node.name == "icon":
-                ret += '<a class="iconlink" href="{src}"><img class="icon" src="{src}" /></a>'.format(
+                pieces.append('<a class="iconlink" href="{src}"><img class="icon" src="{src}" /></a>'.format(
                     src=html_escape(robust_urljoin(base_url, node.children[0].text))
-                )
+                ))
             elif node.name in "biu":
-                ret += '<{n}>{inside}</{n}>'.format(
-                    n=node.name, inside=dom_to_html(node.children, base_url)
-                )
-            elif node.name == "h":
-                ret += '<sup>{inside}</sup>'.format(
-                    inside=dom_to_html(node.children, base_url)
-                )
-            elif node.name == "t":
-                ret += '<sub>{inside}</sub>'.format(
-                    inside=dom_to_html(node.children, base_url)
-                )
-            elif node.name == "strike":
-                ret += '<span class="strike" style="text-decoration:line-through">{inside}</span>'.format(
-                    inside=dom_to_html(node.children, base_url)
-                )
+                pieces.append('<{0}>'.format(node.name))
+                append_dom_html(pieces, node.children, base_url)
+                pieces.append('</{0}>'.format(node.name))
+            elif node.name in simple_element_tags:
+                (start_tag, end_tag) = simple_element_tags[node.name]
+                pieces.append(start_tag)
+                append_dom_html(pieces, node.children, base_url)
+                pieces.append(end_tag)
             elif node.name == "color":
-                ret += '<span class="color" style="color:{color}">{inside}</span>'.format(
-                    color=node.attribute_value,
-                    inside=dom_to_html(node.children, base_url)
-                )
-            elif node.name == "spoiler":
-                ret += '<span class="spoiler">{inside}</span>'.format(
-                    inside=dom_to_html(node.children, base_url)
-                )
+                pieces.append('<span class="color" style="color:{0}">'.format(node.attribute_value))
+                append_dom_html(pieces, node.children, base_url)
+                pieces.append('</span>')
             elif node.name == "noparse":
-                ret += html_escape("".join(str(child) for child in node.children))
+                pieces.append(html_escape("".join(str(child) for child in node.children)))
             elif node.name == "tex":
-                ret += '<script type="math/tex">{math}</script>'.format(
-                    math="".join(str(child) for child in node.children)
-                )
+                pieces.append('<script type="math/tex">')
+                pieces.append("".join(str(child) for child in node.children))
+                pieces.append('</script>')
             else:
-                ret += html_escape(node)
+                pieces.append(html_escape(node))
         elif isinstance(node, SmileyText):
-            ret += '<img class="smiley" src="{src}" alt="{smiley}" title="{smiley}" />'.format(
+            pieces.append('<img class="smiley" src="{src}" alt="{smiley}" title="{smiley}" />'.format(
                 src=html_escape(robust_urljoin(base_url, node.smiley_url)), smiley=html_escape(node.text)
-            )
+            ))
         else:
-            ret += html_escape(node)
-    return ret
+            pieces.append(html_escape(node))
+
+
+class RenderedMessage:
+    """The HTML rendering of a message, encoded for the different responses it is part of."""
+    __slots__ = ("html", "json")
+
+    def __init__(self, html):
+        """
+        :type html: str
+        """
+        self.html = html.encode("utf-8")
+        self.json = json.dumps(html, ensure_ascii=False).encode("utf-8")
+
+
+class StaticFile:
+    """A static file held in memory along with its compressed variants and validators."""
+
+    # compressing these again gains nothing
+    precompressed_types = {"image/png", "image/jpeg", "image/gif", "application/zip", "application/gzip"}
+
+    def __init__(self, file_path, body, mtime_ns):
+        """
+        :type body: bytes
+        """
+        self.file_path = file_path
+        self.mtime_ns = mtime_ns
+        self.size = len(body)
+        self.body = body
+        self.version = hashlib.sha1(body).hexdigest()[:16]
+        self.last_modified = email.utils.formatdate(mtime_ns / 1e9, usegmt=True)
+
+        (content_type, _) = mimetypes.guess_type(file_path)
+        if content_type is None:
+            content_type = "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+
+        # encoding -> body; only variants that are actually smaller are kept
+        self.encoded_bodies = {}
+        if content_type.split(";")[0] not in self.precompressed_types:
+            if brotli is not None:
+                brotli_body = brotli.compress(body)
+                if len(brotli_body) < len(body):
+                    self.encoded_bodies["br"] = brotli_body
+            gzipped_body = gzip.compress(body, 9)
+            if len(gzipped_body) < len(body):
+                self.encoded_bodies["gzip"] = gzipped_body
+
+    def etag(self, encoding=None):
+        """
+        Return the (strong) entity tag of the given variant of the file.
+        :param encoding: The content coding of the variant, or None for the uncompressed one.
+        :rtype: str
+        """
+        if encoding is None:
+            return '"{0}"'.format(self.version)
+        return '"{0}-{1}"'.format(self.version, encoding)
+
+    def matches(self, if_none_match):
+        """
+        Return whether any of the entity tags in an If-None-Match header denotes this version of the
+        file (in any variant).
+        :rtype: bool
+        """
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == "*" or tag.strip('"').split("-")[0] == self.version:
+                return True
+        return False
+
+
+class StaticFileCache:
+    """
+    Holds a fixed set of static files in memory, reloading each one when it changes on disk (which
+    is checked at most every check_interval seconds per file).
+    """
+
+    def __init__(self, file_paths, check_interval=2.0):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.files = {}
+        """:type: dict[str, StaticFile|None]"""
+        self.last_checks = {}
+        for file_path in file_paths:
+            self.files[file_path] = None
+            self.last_checks[file_path] = time.monotonic()
+            self.reload(file_path)
+
+    def reload(self, file_path):
+        """Load the file anew if it has changed on disk."""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            self.files[file_path] = None
+            return
+
+        current = self.files[file_path]
+        if current is not None and current.mtime_ns == stat.st_mtime_ns and current.size == stat.st_size:
+            return
+
+        try:
+            with open(file_path, "rb") as f:
+                body = f.read()
+        except OSError:
+            logger.exception("loading static file {0}".format(file_path))
+            self.files[file_path] = None
+            return
+        self.files[file_path] = StaticFile(file_path, body, stat.st_mtime_ns)
+
+    def get(self, file_path):
+        """
+        Return the current version of the given file, or None if it is not served or not readable.
+        :rtype: StaticFile|None
+        """
+        with self.lock:
+            if file_path not in self.files:
+                return None
+            now = time.monotonic()
+            if now - self.last_checks[file_path] >= self.check_interval:
+                self.last_checks[file_path] = now
+                self.reload(file_path)
+            return self.files[file_path]
+
+    def versions(self):
+        """
+        Return the current versions of all the files, which change whenever one of the files does.
+        :rtype: tuple
+        """
+        return tuple(
+            None if static_file is None else static_file.version
+            for static_file in (self.get(file_path) for file_path in sorted(self.files.keys()))
+        )
+
+    def versioned_urls(self, html):
+        """
+        Append the current version of each file to the links to it in the given HTML, which allows
+        browsers to cache the files until they change.
+        :rtype: str
+        """
+        for file_path in self.files.keys():
+            static_file = self.get(file_path)
+            if static_file is None:
+                continue
+            html = html.replace(
+                '"/{0}"'.format(file_path), '"/{0}?v={1}"'.format(file_path, static_file.version)
+            )
+        return html
+
+
+class SmileyPicker:
+    """The rendered smiley picker for one version of the smiley set."""
+    __slots__ = ("smiley_version", "etag", "body", "gzipped_body")
+
+    def __init__(self, smiley_version, etag, html):
+        """
+        :type html: str
+        """
+        self.smiley_version = smiley_version
+        self.etag = etag
+        self.body = html.encode("utf-8")
+        self.gzipped_body = gzip.compress(self.body)
+
+
+class PooledHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    An HTTP server that handles each connection on one of a bounded number of worker threads.
+    Connections beyond that wait until a worker becomes free; to keep that from happening because
+    of idle connections, kept-alive connections are closed early once the pool is nearly full.
+    """
+
+    def __init__(self, server_address, request_handler_class, max_threads, keep_alive_timeout):
+        """
+        :param keep_alive_timeout: How long (in seconds) an idle kept-alive connection is kept open
+        while the pool is not crowded.
+        """
+        http.server.ThreadingHTTPServer.__init__(self, server_address, request_handler_class)
+        self.max_threads = max_threads
+        self.keep_alive_timeout = keep_alive_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_threads, "HttpInterface request")
+        self.open_connections = set()
+        self.open_connections_lock = threading.Lock()
+
+    def is_crowded(self):
+        """
+        Return whether (almost) all workers are busy, or connections are even waiting for one.
+        :rtype: bool
+        """
+        with self.open_connections_lock:
+            open_count = len(self.open_connections)
+        return open_count >= self.max_threads - max(self.max_threads // 8, 1)
+
+    def process_request(self, request, client_address):
+        with self.open_connections_lock:
+            self.open_connections.add(request)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.open_connections_lock:
+            self.open_connections.discard(request)
+        http.server.ThreadingHTTPServer.shutdown_request(self, request)
+
+    def server_close(self):
+        http.server.ThreadingHTTPServer.server_close(self)
+
+        # wake up the workers waiting on kept-alive connections so they don't hold up exiting
+        with self.open_connections_lock:
+            open_connections = list(self.open_connections)
+        for connection in open_connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=False)
 
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
     http_interface = None
     """:type: HttpInterface"""
 
+    # keep connections alive between requests; every response must therefore state its length
+    protocol_version = "HTTP/1.1"
+
+    # how often an idle kept-alive connection checks whether the pool has become crowded (seconds)
+    crowding_check_interval = 0.5
+
+    # responses smaller than this are not worth compressing
+    min_gzip_size = 512
+    compressible_types = {"text/html", "text/plain", "text/css", "application/json", "application/javascript"}
+
+    # how long browsers may cache a static file requested with its current version
+    immutable_max_age = 365*24*60*60
+
     def check_auth(self):
         username_colon_password = "{0}:{1}".format(
             self.http_interface.username, self.http_interface.password
@@ -127,131 +395,248 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         auth_token = "Basic " + auth_bytes.decode("us-ascii")
 
         if "Authorization" not in self.headers or self.headers["Authorization"] != auth_token:
-            self.send_response(401)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.send_header("WWW-Authenticate", "Basic realm=\"Chatbox\"")
-            self.end_headers()
-            self.wfile.write(b"Please authenticate!")
+            # any request body is still unread; don't parse it as the next request
+            self.close_connection = True
+            self.send_body(
+                401, "text/plain; charset=utf-8", b"Please authenticate!",
+                headers=[("WWW-Authenticate", "Basic realm=\"Chatbox\"")]
+            )
             return False
 
         return True
 
-    def send_ok_html_response(self, body_bytes):
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.wait_for_next_request():
+                return
+            self.handle_one_request()
+
+    def wait_for_next_request(self):
+        """
+        Wait until the client sends another request on the kept-alive connection. Gives up after the
+        keep-alive timeout, or as soon as the pool is crowded so that idle connections don't keep
+        other clients waiting for a worker. (Browsers don't pipeline requests, so there is nothing
+        buffered that could be missed.)
+        :return: Whether a request is coming; if not, the connection is to be closed.
+        :rtype: bool
+        """
+        deadline = time.monotonic() + self.server.keep_alive_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait_time = min(remaining, self.crowding_check_interval)
+            (readable, _, _) = select.select([self.connection], [], [], wait_time)
+            if readable:
+                return True
+            if self.server.is_crowded():
+                return False
+
+    def accepts_gzip(self):
+        """:rtype: bool"""
+        return accepts_encoding(self.headers.get("Accept-Encoding", None), "gzip")
+
+    def send_body(self, http_code, content_type, body_bytes, headers=None, gzipped_body=None):
+        """
+        Send a complete response, gzipped if the client accepts it and it is worth it.
+        :param content_type: The value of the Content-Type header, or None to leave it out.
+        :param headers: Additional headers as a list of (name, value) pairs.
+        :param gzipped_body: The body already compressed with gzip, or None to compress it here if
+        necessary.
+        :type gzipped_body: bytes|None
+        """
+        compressible = content_type is not None and \
+            content_type.split(";")[0].strip() in self.compressible_types
+        if compressible and self.accepts_gzip() and \
+                (gzipped_body is not None or len(body_bytes) >= self.min_gzip_size):
+            if gzipped_body is None:
+                gzipped_body = gzip.compress(body_bytes)
+            body_bytes = gzipped_body
+            encoding = "gzip"
+        else:
+            encoding = None
+
+        self.send_response(http_code)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
         self.send_header("Content-Length", str(len(body_bytes)))
+        if headers is not None:
+            for (name, value) in headers:
+                self.send_header(name, value)
         self.end_headers()
         self.wfile.write(body_bytes)
 
+    def send_ok_html_response(self, body_bytes, etag=None):
+        headers = None
+        if etag is not None:
+            headers = [("Cache-Control", "no-cache"), ("ETag", etag)]
+        self.send_body(200, "text/html; charset=utf-8", body_bytes, headers=headers)
+
     def send_plaintext_response(self, http_code, body_bytes):
-        self.send_response(http_code)
-        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_body(http_code, "text/plain; charset=utf-8", body_bytes)
+
+    def send_static_file(self, static_file, url_query):
+        """
+        Send a static file, or 304 if the client has it already.
+        :type static_file: StaticFile
+        :param url_query: The query string of the request; if it contains the current version of the
+        file, the client may cache it for a long time.
+        """
+        versions = parse_qs(url_query).get("v", [])
+        if static_file.version in versions:
+            cache_control = "public, max-age={0}, immutable".format(self.immutable_max_age)
+        else:
+            cache_control = "no-cache"
+
+        accept_encoding = self.headers.get("Accept-Encoding", None)
+        encoding = None
+        for candidate in ("br", "gzip"):
+            if candidate in static_file.encoded_bodies and accepts_encoding(accept_encoding, candidate):
+                encoding = candidate
+                break
+
+        if_none_match = self.headers.get("If-None-Match", None)
+        if if_none_match is not None:
+            not_modified = static_file.matches(if_none_match)
+        else:
+            if_modified_since = self.headers.get("If-Modified-Since", None)
+            not_modified = if_modified_since is not None and if_modified_since == static_file.last_modified
+
+        headers = [
+            ("ETag", static_file.etag(encoding)),
+            ("Last-Modified", static_file.last_modified),
+            ("Cache-Control", cache_control),
+        ]
+        if static_file.encoded_bodies:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        if not_modified:
+            self.send_response(304)
+            body_bytes = b""
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", static_file.content_type)
+            if encoding is None:
+                body_bytes = static_file.body
+            else:
+                self.send_header("Content-Encoding", encoding)
+                body_bytes = static_file.encoded_bodies[encoding]
+        for (name, value) in headers:
+            self.send_header(name, value)
         self.send_header("Content-Length", str(len(body_bytes)))
         self.end_headers()
         self.wfile.write(body_bytes)
 
-    def do_GET(self):
-        try:
-            if not self.check_auth():
-                return
-
-            if self.path == "/":
-                # assemble the quick-messages
-                q_msg_string = '<span class="quickmessagelist">'
+    def send_redirect(self, location):
+        self.send_response(303)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-                for quick_message in self.http_interface.quick_messages:
-                    q_msg_string += ' <button type="button" onclick="sendQuick(\'{jmsg}\')">{msg}</button>'.format(
-                        msg=html_escape(quick_message),
-                        jmsg=html_escape(js_escape_string(
-                            quick_message, escape_quotes=False, escape_apostrophes=True
-                        ), escape_quotes=True)
-                    )
+    def send_messages(self, since, wait=False):
+        """
+        Output the messages. Without a version to start from, all the messages are output as HTML;
+        otherwise, the messages added or modified since that version are output as JSON along with
+        the IDs of all the current messages, so that the client can patch its copy.
+        :param since: The version the client already has (as returned in "version"), or None.
+        :type since: str|None
+        :param wait: Whether to wait (up to long_poll_timeout) for something to change if the client
+        is already up to date.
+        :type wait: bool
+        """
+        interface = self.http_interface
+        gzip_wanted = self.accepts_gzip()
+        gzipped_body = None
+        with interface.message_lock:
+            # if all long-polling slots are taken, answer right away and leave out X-Long-Poll; the
+            # client then falls back to polling until a slot is free again
+            long_poll = interface.long_polls < interface.max_long_polls
+            if since is not None and wait and long_poll:
+                since_version = interface.parse_version(since)
+                if since_version is not None:
+                    interface.long_polls += 1
+                    try:
+                        interface.messages_changed.wait_for(
+                            lambda: interface.version != since_version or interface.stop_now,
+                            timeout=interface.long_poll_timeout
+                        )
+                    finally:
+                        interface.long_polls -= 1
 
-                q_msg_string += '</span>'
+            etag = interface.current_etag()
+            if since is None:
+                if self.headers.get("If-None-Match", None) == etag:
+                    self.send_not_modified(etag, long_poll)
+                    return
+                cache_key = "html"
+                body_bytes = interface.full_html_response()
+                content_type = "text/html; charset=utf-8"
+            else:
+                since_version = interface.parse_version(since)
+                if since_version == interface.version:
+                    self.send_not_modified(etag, long_poll)
+                    return
+                cache_key = since_version
+                body_bytes = interface.update_json_response(since_version)
+                content_type = "application/json; charset=utf-8"
+
+            if gzip_wanted and len(body_bytes) >= self.min_gzip_size:
+                # every client polling at this version gets the same bytes; compress them once
+                gzipped_body = interface.gzipped_response(cache_key, body_bytes)
+
+        headers = [("Cache-Control", "no-cache"), ("ETag", etag)]
+        if long_poll:
+            headers.append(("X-Long-Poll", "1"))
+        self.send_body(200, content_type, body_bytes, headers=headers, gzipped_body=gzipped_body)
+
+    def send_not_modified(self, etag, long_poll=True):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if long_poll:
+            self.send_header("X-Long-Poll", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-                # output the chatbox form
-                page = self.http_interface.page_template
-                for (old, new) in (
-                        ("%%NICKNAME%%", self.http_interface.connector.username),
-                        ("%%QUICKMESSAGES%%", q_msg_string)
-                ):
-                    page = page.replace(old, new)
+    def send_smiley_picker(self):
+        picker = self.http_interface.smiley_picker()
+        if self.headers.get("If-None-Match", None) == picker.etag:
+            self.send_not_modified(picker.etag, long_poll=False)
+            return
+        self.send_body(
+            200, "text/html; charset=utf-8", picker.body,
+            headers=[("Cache-Control", "no-cache"), ("ETag", picker.etag)],
+            gzipped_body=picker.gzipped_body
+        )
 
-                self.send_ok_html_response(page.encode("utf-8"))
-            elif self.path == "/messages":
-                # output the messages as a chunk
-                all_messages = b""
+    def do_GET(self):
+        try:
+            if not self.check_auth():
+                return
 
-                with self.http_interface.message_lock:
-                    for message in self.http_interface.messages:
-                        sender_info_url = robust_urljoin(
-                            self.http_interface.connector.base_url,
-                            "member.php?u={0}".format(message.user_id)
-                        )
-                        sender_name = dom_to_html(
-                            message.decompiled_user_name_dom(),
-                            self.http_interface.connector.base_url
-                        )
-                        if message.user_name == self.http_interface.connector.username:
-                            # it's me
-                            sender_name = '<span class="myself">{0}</span>'.format(sender_name)
-                        output_string = self.http_interface.post_template.format(
-                            message_id=html_escape(message.id), sender_id=html_escape(message.user_id),
-                            sender_name=sender_name,
-                            sender_info_url=html_escape(sender_info_url),
-                            time=time.strftime("%Y-%m-%d %H:%M", time.localtime(message.timestamp)),
-                            body=dom_to_html(
-                                message.decompiled_body_dom(),
-                                self.http_interface.connector.base_url
-                            )
-                        )
-                        all_messages += output_string.encode("utf-8")
-
-                self.send_ok_html_response(all_messages)
-
-            elif self.path == "/smilies":
-                smiley_string = '<span class="smileylist">'
-                smiley_string += '<button type="button" onclick="hideSmilies()">Hide!</button>'
-
-                for (smiley_code, smiley_image_url) in sorted(
-                    self.http_interface.connector.smiley_codes_to_urls.items()
-                ):
-                    smiley_string += "".join([
-                        ' ',
-                        '<span class="smiley">',
-                        '<a class="jsclick" onclick="smileyClicked(\'{c}\')">'.format(
-                            c=html_escape(
-                                js_escape_string(
-                                    smiley_code, escape_quotes=False, escape_apostrophes=True
-                                ),
-                                escape_quotes=True, escape_apostrophes=False
-                            )
-                        ),
-                        '<img class="smiley picksmiley" src="{u}" title="{c}"/>'.format(
-                            c=html_escape(smiley_code),
-                            u=html_escape(robust_urljoin(
-                                self.http_interface.connector.base_url, smiley_image_url
-                            ))
-                        ),
-                        '</a>',
-                        '</span>'
-                    ])
+            (_, _, url_path, url_query, _) = urlsplit(self.path)
 
-                smiley_string += '</span>'
+            if url_path == "/":
+                self.send_ok_html_response(self.http_interface.page_response())
+            elif url_path == "/messages":
+                query = parse_qs(url_query, keep_blank_values=True)
+                self.send_messages(query.get("since", [None])[0], query.get("wait", ["0"])[0] == "1")
 
-                self.send_ok_html_response(smiley_string.encode("utf-8"))
+            elif url_path == "/smilies":
+                self.send_smiley_picker()
 
-            elif editor_regex.match(self.path):
+            elif editor_regex.match(url_path):
                 # editor
                 message_number = int(editor_regex.last_match.group(1))
-                message_to_edit = None
 
                 # find that message
                 with self.http_interface.message_lock:
-                    for message in self.http_interface.messages:
-                        if message.id == message_number:
-                            message_to_edit = message
-                            break
+                    message_to_edit = self.http_interface.messages.get(message_number, None)
 
                 current_message_body = ""
                 if message_to_edit is not None:
@@ -260,27 +645,17 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 output_string = self.http_interface.editor_template.format(
                     message_id=html_escape(message_number), body=html_escape(current_message_body)
                 )
+                output_string = self.http_interface.static_files.versioned_urls(output_string)
                 output_bytes = output_string.encode("utf-8")
 
                 self.send_ok_html_response(output_bytes)
 
             else:
-                body = None
-                if self.path[1:] in self.http_interface.allowed_files:
-                    try:
-                        with open(self.path[1:], "rb") as f:
-                            body = f.read()
-                    except FileNotFoundError:
-                        # body remains None
-                        pass
-
-                if body is None:
+                static_file = self.http_interface.static_files.get(url_path[1:])
+                if static_file is None:
                     self.send_plaintext_response(404, b"No such file or directory!")
                 else:
-                    self.send_response(200)
-                    self.send_header("Content-Length", str(len(body)))
-                    self.end_headers()
-                    self.wfile.write(body)
+                    self.send_static_file(static_file, url_query)
         except:
             logger.exception("handling GET request")
             raise
@@ -290,7 +665,12 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             if not self.check_auth():
                 return
 
-            length = int(self.headers["Content-Length"])
+            length_string = self.headers.get("Content-Length", None)
+            if length_string is None or not length_string.isdigit():
+                self.close_connection = True
+                self.send_plaintext_response(411, b"A valid Content-Length is required.")
+                return
+            length = int(length_string)
             post_body_bytes = self.rfile.read(length)
             post_body = post_body_bytes.decode("utf-8")
 
@@ -305,11 +685,10 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                     self.send_plaintext_response(400, b"You must specify the message body.")
                     return
 
-                self.http_interface.connector.send_message(values["message"], custom_smileys=True)
+                # don't keep the browser waiting for the round trip to the forum
+                self.http_interface.queue_send(values["message"])
 
-                self.send_response(303)
-                self.send_header("Location", "/")
-                self.end_headers()
+                self.send_redirect("/")
 
             elif self.path == "/editmessage":
                 if "message_id" not in values or len(values["message_id"]) == 0 \
@@ -320,13 +699,12 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 elif not values["message_id"].isnumeric():
                     self.send_plaintext_response(400, b"Message ID must be numeric.")
                 else:
-                    self.http_interface.connector.edit_message(
-                        int(values["message_id"]), values["new_body"], custom_smileys=True
-                    )
+                    self.http_interface.queue_edit(int(values["message_id"]), values["new_body"])
+
+                    self.send_redirect("/")
 
-                    self.send_response(303)
-                    self.send_header("Location", "/")
-                    self.end_headers()
+            else:
+                self.send_plaintext_response(404, b"No such file or directory!")
         except:
             logger.exception("handling POST request")
             raise
@@ -338,22 +716,250 @@ class HttpInterface(Module):
     def message_received(self, message):
         """Called by the communicator when a new message has been received."""
 
+        # render it once, outside the lock
+        fragment = RenderedMessage(self.render_message(message))
+
         # add it!
         with self.message_lock:
-            self.messages.insert(0, message)
-            while len(self.messages) > self.backlog:
-                self.messages.pop()
+            self.version += 1
+            evicted = self.messages.add(message.id, message)
+            if evicted is not None:
+                (evicted_id, _) = evicted
+                del self.versions_by_id[evicted_id]
+                del self.fragments_by_id[evicted_id]
+            self.versions_by_id[message.id] = self.version
+            self.fragments_by_id[message.id] = fragment
+            self.response_cache.clear()
+            self.messages_changed.notify_all()
 
     def message_modified(self, modified_message):
         """Called by the communicator when a message has been edited."""
 
+        with self.message_lock:
+            if modified_message.id not in self.fragments_by_id:
+                return
+
+        fragment = RenderedMessage(self.render_message(modified_message))
+
         # find and change!
         with self.message_lock:
-            for i in range(len(self.messages)):
-                if self.messages[i].id == modified_message.id:
-                    # update!
-                    self.messages[i] = modified_message
-                    break
+            if self.messages.replace(modified_message.id, modified_message):
+                self.version += 1
+                self.versions_by_id[modified_message.id] = self.version
+                self.fragments_by_id[modified_message.id] = fragment
+                self.response_cache.clear()
+                self.messages_changed.notify_all()
+
+    def queue_send(self, body):
+        """Send a message to the chatbox in the background."""
+        self.send_executor.submit(self.perform_send, self.connector.send_message, body, custom_smileys=True)
+
+    def queue_edit(self, message_id, new_body):
+        """Edit a message in the chatbox in the background."""
+        self.send_executor.submit(
+            self.perform_send, self.connector.edit_message, message_id, new_body, custom_smileys=True
+        )
+
+    @staticmethod
+    def perform_send(send_function, *args, **kwargs):
+        try:
+            send_function(*args, **kwargs)
+        except:
+            logger.exception("sending message from HTTP interface")
+
+    def gzipped_response(self, cache_key, body_bytes):
+        """
+        Return the gzipped version of a cached response (see full_html_response and
+        update_json_response), compressing it only once. Must be called with message_lock held.
+        :rtype: bytes
+        """
+        gzipped_key = ("gzip", cache_key)
+        response = self.response_cache.get(gzipped_key, None)
+        if response is None:
+            response = gzip.compress(body_bytes)
+            self.response_cache[gzipped_key] = response
+        return response
+
+    def render_page(self):
+        """
+        Fill in the page template (except for the links to static files, whose versions may change).
+        :rtype: str
+        """
+        q_msg_pieces = ['<span class="quickmessagelist">']
+        for quick_message in self.quick_messages:
+            q_msg_pieces.append(' <button type="button" onclick="sendQuick(\'{jmsg}\')">{msg}</button>'.format(
+                msg=html_escape(quick_message),
+                jmsg=html_escape(js_escape_string(
+                    quick_message, escape_quotes=False, escape_apostrophes=True
+                ), escape_quotes=True)
+            ))
+        q_msg_pieces.append('</span>')
+
+        page = self.page_template
+        for (old, new) in (
+                ("%%NICKNAME%%", self.connector.username),
+                ("%%QUICKMESSAGES%%", "".join(q_msg_pieces))
+        ):
+            page = page.replace(old, new)
+        return page
+
+    def page_response(self):
+        """
+        Return the chatbox page, linking to the current versions of the static files.
+        :rtype: bytes
+        """
+        static_versions = self.static_files.versions()
+        cached_page = self.cached_page
+        if cached_page is None or cached_page[0] != static_versions:
+            # concurrent requests might render it twice, which is harmless
+            page = self.static_files.versioned_urls(self.rendered_page)
+            cached_page = (static_versions, page.encode("utf-8"))
+            self.cached_page = cached_page
+        return cached_page[1]
+
+    def render_smiley_picker(self):
+        """
+        Render the smiley picker for the current smiley set.
+        :rtype: str
+        """
+        base_url = self.connector.base_url
+        pieces = [
+            '<span class="smileylist">',
+            '<button type="button" onclick="hideSmilies()">Hide!</button>'
+        ]
+        for (smiley_code, smiley_image_url) in sorted(self.connector.smiley_codes_to_urls.items()):
+            pieces.append(''.join([
+                ' ',
+                '<span class="smiley">',
+                '<a class="jsclick" onclick="smileyClicked(\'{c}\')">'.format(
+                    c=html_escape(
+                        js_escape_string(
+                            smiley_code, escape_quotes=False, escape_apostrophes=True
+                        ),
+                        escape_quotes=True, escape_apostrophes=False
+                    )
+                ),
+                '<img class="smiley picksmiley" src="{u}" title="{c}"/>'.format(
+                    c=html_escape(smiley_code),
+                    u=html_escape(robust_urljoin(base_url, smiley_image_url))
+                ),
+                '</a>',
+                '</span>'
+            ]))
+        pieces.append('</span>')
+        return "".join(pieces)
+
+    def smiley_picker(self):
+        """
+        Return the smiley picker, rendering it anew only if the smiley set has changed.
+        :rtype: SmileyPicker
+        """
+        smiley_version = self.connector.smiley_version
+        picker = self.cached_smiley_picker
+        if picker is not None and picker.smiley_version == smiley_version:
+            return picker
+
+        etag = '"smilies-{0}-{1}"'.format(self.version_epoch, smiley_version)
+        picker = SmileyPicker(smiley_version, etag, self.render_smiley_picker())
+        self.cached_smiley_picker = picker
+        return picker
+
+    def full_html_response(self):
+        """
+        Return all the rendered messages as one chunk of HTML. Must be called with message_lock
+        held.
+        :rtype: bytes
+        """
+        response = self.response_cache.get("html", None)
+        if response is None:
+            response = b"".join(
+                self.fragments_by_id[message_id].html for message_id in self.messages.keys_newest_first()
+            )
+            self.response_cache["html"] = response
+        return response
+
+    def update_json_response(self, since_version):
+        """
+        Return the JSON update from the given version (None for all messages) to the current one.
+        Clients polling at the same version share the same response. Must be called with
+        message_lock held.
+        :rtype: bytes
+        """
+        response = self.response_cache.get(since_version, None)
+        if response is not None:
+            return response
+
+        posts = []
+        message_ids = list(self.messages.keys_newest_first())
+        for message_id in message_ids:
+            if since_version is None or self.versions_by_id[message_id] > since_version:
+                posts.append(b'"%d": %s' % (message_id, self.fragments_by_id[message_id].json))
+
+        response = b"".join([
+            b'{"version": ', json.dumps(self.current_version_token()).encode("utf-8"),
+            b', "partial": ', b"false" if since_version is None else b"true",
+            b', "ids": ', json.dumps(message_ids).encode("utf-8"),
+            b', "posts": {', b", ".join(posts), b"}}"
+        ])
+        self.response_cache[since_version] = response
+        return response
+
+    def current_version_token(self):
+        """
+        Return the token identifying the current state of the messages. Must be called with
+        message_lock held.
+        :rtype: str
+        """
+        return "{0}-{1}".format(self.version_epoch, self.version)
+
+    def current_etag(self):
+        """
+        Return the entity tag of the current state of the messages. Must be called with
+        message_lock held.
+        :rtype: str
+        """
+        return '"{0}"'.format(self.current_version_token())
+
+    def parse_version(self, version_token):
+        """
+        Return the version number encoded in a token returned by current_version_token, or None if
+        it is invalid or stems from an earlier run.
+        :rtype: int|None
+        """
+        pieces = version_token.split("-")
+        if len(pieces) != 2 or pieces[0] != self.version_epoch or not pieces[1].isdigit():
+            return None
+        version = int(pieces[1])
+        if version > self.version:
+            return None
+        return version
+
+    def render_message(self, message):
+        """
+        Render a message as HTML using the post template.
+        :rtype: str
+        """
+        sender_info_url = robust_urljoin(
+            self.connector.base_url,
+            "member.php?u={0}".format(message.user_id)
+        )
+        sender_name = dom_to_html(
+            message.decompiled_user_name_dom(),
+            self.connector.base_url
+        )
+        if message.user_name == self.connector.username:
+            # it's me
+            sender_name = '<span class="myself">{0}</span>'.format(sender_name)
+        return self.post_template.format(
+            message_id=html_escape(message.id), sender_id=html_escape(message.user_id),
+            sender_name=sender_name,
+            sender_info_url=html_escape(sender_info_url),
+            time=time.strftime("%Y-%m-%d %H:%M", time.localtime(message.timestamp)),
+            body=dom_to_html(
+                message.decompiled_body_dom(),
+                self.connector.base_url
+            )
+        )
 
     def __init__(self, connector, config_section):
         """
@@ -379,6 +985,12 @@ class HttpInterface(Module):
             for f in config_section["allowed files"].split():
                 self.allowed_files.add(f.strip())
 
+        # how often the static files are checked for changes (in seconds)
+        static_check_interval = 2.0
+        if "static file check interval" in config_section:
+            static_check_interval = float(config_section["static file check interval"])
+        self.static_files = StaticFileCache(self.allowed_files, static_check_interval)
+
         self.quick_messages = []
         if "quick messages" in config_section:
             for msg_line in config_section["quick messages"].split("\n"):
@@ -400,13 +1012,67 @@ class HttpInterface(Module):
         self.username = config_section["username"]
         self.password = config_section["password"]
 
-        self.messages = []
+        # keyed by message ID
+        self.messages = MessageWindow(self.backlog)
         self.message_lock = threading.RLock()
+        # wakes up long-polling clients
+        self.messages_changed = threading.Condition(self.message_lock)
+
+        # how long a client asking to wait for changes is kept waiting at most (in seconds)
+        self.long_poll_timeout = 25
+        if "long poll timeout" in config_section:
+            self.long_poll_timeout = float(config_section["long poll timeout"])
+
+        # incremented whenever a message is added or modified; clients ask for what has changed
+        # since the version they have (the epoch tells apart the versions of different runs)
+        self.version = 0
+        self.version_epoch = "{0:x}".format(int(time.time()))
+        self.versions_by_id = {}
+
+        # rendered once when a message arrives or is edited; the responses built from them are
+        # shared until the next change
+        self.fragments_by_id = {}
+        """:type: dict[int, RenderedMessage]"""
+        self.response_cache = {}
+
+        # the page only changes along with the static files it links to; the smiley picker along
+        # with the smiley set
+        self.rendered_page = self.render_page()
+        self.cached_page = None
+        """:type: (tuple, bytes)|None"""
+        self.cached_smiley_picker = None
+        """:type: SmileyPicker|None"""
+
         self.stop_now = False
         self.server_thread = threading.Thread(None, self.server_proc, "HttpInterface")
 
+        # messages posted through the interface are sent one after the other, in order
+        self.send_executor = concurrent.futures.ThreadPoolExecutor(1, "HttpInterface sender")
+
+        # Each open connection occupies one worker thread for as long as it is open: a long poll for
+        # up to long_poll_timeout, an idle kept-alive connection for up to keep_alive_timeout.
+        # Browsers open up to six connections per tab, so with the defaults, a handful of tabs can
+        # fill the pool. To keep new requests (posting, static files) from queueing behind idle
+        # connections, at most max_long_polls connections wait for changes at the same time (the
+        # others fall back to polling), and idle connections are closed early when the pool is
+        # nearly full. Raise max connections if many clients are expected.
+        max_connections = 32
+        if "max connections" in config_section:
+            max_connections = int(config_section["max connections"])
+
+        self.max_long_polls = max(max_connections // 2, 1)
+        if "max long polls" in config_section:
+            self.max_long_polls = int(config_section["max long polls"])
+        self.long_polls = 0
+
+        # how long an idle kept-alive connection may hold on to its thread (in seconds)
+        keep_alive_timeout = 10
+        if "keep alive timeout" in config_section:
+            keep_alive_timeout = float(config_section["keep alive timeout"])
+
         RequestHandler.http_interface = self
-        self.server = http.server.HTTPServer(('', port), RequestHandler)
+        RequestHandler.timeout = keep_alive_timeout
+        self.server = PooledHTTPServer(('', port), RequestHandler, max_connections, keep_alive_timeout)
 
     def server_proc(self):
         self.server.serve_forever()
@@ -415,4 +1081,10 @@ class HttpInterface(Module):
         self.server_thread.start()
 
     def stop(self):
-        self.stop_now = True
+        with self.message_lock:
+            self.stop_now = True
+            self.messages_changed.notify_all()
+        if self.server_thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+        self.send_executor.shutdown(wait=False)
@@ -1,9 +1,11 @@
 from vbcbbot.modules import Module
 from vbcbbot.utils import remove_control_characters_and_strip
 
+import concurrent.futures
 import logging
 import random
 import re
+import threading
 import time
 import urllib.request as ur
 
@@ -13,6 +15,10 @@ logger = logging.getLogger("vbcbbot.modules.is_tuwel_down")
 
 is_down_re = re.compile("^!ist?tuwel(up|down)$")
 
+# seconds to wait after the API's next expected check, and at least between refreshes
+refresh_slack = 5
+minimum_refresh_delay = 10
+
 parse_messages = lambda value: [ln.strip() for ln in value.split("\n") if len(ln.strip()) > 0]
 
 
@@ -27,20 +33,22 @@ class IsTuwelDown(Module):
         if is_down_re.match(body) is None:
             return
 
-        response = ur.urlopen(self.api_url)
-        response_data = response.read().decode("us-ascii")
+        snapshot = self.current_snapshot()
+        if snapshot is None:
+            # nothing (recent) known, e.g. just started or the API is unreachable; join or start a
+            # refresh
+            try:
+                snapshot = self.refresh().result(timeout=self.timeout)
+            except Exception:
+                snapshot = None
 
-        pieces = response_data.split(" ")
-        if len(pieces) != 3:
-            logger.debug("unexpected server answer {0} for nickname {1}".format(
-                repr(response_data)
-            ))
+        if snapshot is None:
             self.connector.send_message(
                 random.choice(self.unknown_messages).format(sender=message.user_name)
             )
             return
 
-        (status, since_string, last_update_string) = pieces
+        (status, since_string, last_update_string) = snapshot
 
         try:
             since = time.strftime("%Y-%m-%d %H:%M", time.localtime(int(since_string)))
@@ -64,6 +72,109 @@ class IsTuwelDown(Module):
             outgoing.format(sender=message.user_name, since=since, last_update=last_update)
         )
 
+    def current_snapshot(self):
+        """
+        Return the last status fetched from the API, or None if none has been fetched or it is too
+        old to be passed off as current.
+        :rtype: (str, str, str)|None
+        """
+        with self.refresh_lock:
+            if self.snapshot is None or time.monotonic() - self.snapshot_time > self.maximum_snapshot_age:
+                return None
+            return self.snapshot
+
+    def fetch_status(self):
+        """
+        Ask the API for the current status.
+        :return: The status, the timestamp since which TUWEL has had this status, and the timestamp
+        when the API last checked it; or None if the answer couldn't be understood.
+        :rtype: (str, str, str)|None
+        """
+        response = ur.urlopen(self.api_url, timeout=self.timeout)
+        response_data = response.read().decode("us-ascii")
+
+        pieces = response_data.split(" ")
+        if len(pieces) != 3:
+            logger.debug("unexpected server answer {0}".format(repr(response_data)))
+            return None
+
+        return pieces[0], pieces[1], pieces[2]
+
+    def refresh(self):
+        """
+        Fetch the current status and store it as the snapshot. If a refresh is already in progress,
+        no new request is made; its result is shared instead.
+        :return: A future resolving to the new snapshot.
+        :rtype: concurrent.futures.Future
+        """
+        with self.refresh_lock:
+            if self.pending_refresh is not None:
+                return self.pending_refresh
+            future = concurrent.futures.Future()
+            self.pending_refresh = future
+
+        try:
+            snapshot = self.fetch_status()
+        except Exception as exc:
+            logger.warning("fetching TUWEL status failed: {0}".format(exc))
+            with self.refresh_lock:
+                self.pending_refresh = None
+            future.set_exception(exc)
+            return future
+
+        with self.refresh_lock:
+            if snapshot is not None:
+                self.snapshot = snapshot
+                self.snapshot_time = time.monotonic()
+            self.pending_refresh = None
+        future.set_result(snapshot)
+        return future
+
+    def next_refresh_delay(self, snapshot):
+        """
+        Choose how long to wait before the next refresh: just after the API is expected to have
+        checked again, judging by its last update.
+        :rtype: float
+        """
+        if snapshot is None:
+            return self.error_retry_interval
+        try:
+            last_update = int(snapshot[2])
+        except ValueError:
+            return self.refresh_interval
+
+        delay = last_update + self.refresh_interval + refresh_slack - time.time()
+        if delay <= 0:
+            # the API is lagging behind; don't hammer it
+            return self.refresh_interval
+        return min(max(delay, minimum_refresh_delay), self.refresh_interval + refresh_slack)
+
+    def refresh_periodically(self):
+        try:
+            snapshot = self.refresh().result()
+        except Exception:
+            snapshot = None
+        delay = self.next_refresh_delay(snapshot)
+
+        with self.refresh_lock:
+            if self.stop_now:
+                return
+            self.schedule_refresh(delay)
+
+    def schedule_refresh(self, delay):
+        # fetching blocks on the network
+        self.scheduler.call_later(delay, self.refresh_periodically, key=self.refresh_key, blocking=True)
+
+    def start(self):
+        with self.refresh_lock:
+            self.stop_now = False
+            self.schedule_refresh(0)
+
+    def stop(self):
+        with self.refresh_lock:
+            self.stop_now = True
+            self.scheduler.cancel_key(self.refresh_key)
+
     def __init__(self, connector, config_section):
         """
         Create a new messaging responder.
@@ -88,3 +199,30 @@ class IsTuwelDown(Module):
         self.unknown_messages = ["[noparse]{sender}[/noparse]: I don\u2019 know either..."]
         if "unknown messages" in config_section:
             self.unknown_messages = parse_messages(config_section["unknown messages"])
+
+        self.timeout = 10
+        if "timeout" in config_section:
+            self.timeout = float(config_section["timeout"])
+
+        # how often the API itself checks TUWEL (in seconds)
+        self.refresh_interval = 60
+        if "refresh interval" in config_section:
+            self.refresh_interval = float(config_section["refresh interval"])
+
+        self.error_retry_interval = 30
+        if "error retry interval" in config_section:
+            self.error_retry_interval = float(config_section["error retry interval"])
+
+        # after failed refreshes, the last status is only reported until it is this old (in seconds)
+        self.maximum_snapshot_age = 3 * self.refresh_interval
+        if "maximum snapshot age" in config_section:
+            self.maximum_snapshot_age = float(config_section["maximum snapshot age"])
+
+        self.snapshot = None
+        """:type: (str, str, str)|None"""
+        self.snapshot_time = None
+        """:type: float|None"""
+        self.pending_refresh = None
+        self.refresh_lock = threading.Lock()
+        self.refresh_key = (self, "refresh")
+        self.stop_now = False
@@ -1,11 +1,13 @@
+from vbcbbot.http_pool import ConnectionPool, redirect_statuses
 from vbcbbot.modules import Module
 
 import base64
+import concurrent.futures
 import logging
 import re
+import threading
 import time
 import urllib.parse as up
-import urllib.request as ur
 
 __author__ = 'ondra'
 
@@ -13,6 +15,48 @@ logger = logging.getLogger("vbcbbot.modules.last_seen_api")
 seen_re = re.compile("^!(seen|lastseen) (.+)$")
 
 
+class ApiError(Exception):
+    """The API returned an unusable answer."""
+    pass
+
+
+def parse_answer(response_data, nickname):
+    """
+    Parse the API's answer for a single user.
+    :return: None if the user has never been seen, otherwise a tuple of the formatted timestamp
+    (-1 if the answer couldn't be understood), the message ID and the epoch.
+    :rtype: (str, int|None, int|None)|None
+    """
+    if response_data == "NULL":
+        return None
+
+    pieces = response_data.split(" ")
+    if len(pieces) != 3:
+        logger.debug("unexpected server answer {0} for nickname {1}".format(
+            repr(response_data), repr(nickname)
+        ))
+        return -1, None, None
+
+    (timestamp_string, message_id_string, epoch_string) = pieces
+
+    try:
+        timestamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(int(timestamp_string)))
+    except ValueError:
+        timestamp = -1
+
+    try:
+        message_id = int(message_id_string)
+    except ValueError:
+        message_id = None
+
+    try:
+        epoch = int(epoch_string)
+    except ValueError:
+        epoch = None
+
+    return timestamp, message_id, epoch
+
+
 class LastSeenApi(Module):
     """Checks when a user has most recently posted a message to the chatbox by consulting an API."""
 
@@ -35,67 +79,27 @@ class LastSeenApi(Module):
 
         nicknames = (nick.strip().replace("[/noparse]", "") for nick in match.group(2).split(";"))
         nicknames = [nick for nick in nicknames if len(nick) > 0]
-        nicknames_infos = {}
 
         if len(nicknames) == 0:
             return
         if len(nicknames) == 1 and len(nicknames[0]) == 0:
             return
 
-        for nickname in nicknames:
-            url_escaped_nickname = up.quote_plus(nickname)
-
-            # note: must be specified as "%%USERNAME%%" in the config file
-            # due to variable substitution in configparse
-            call_url = self.api_url.replace("%USERNAME%", url_escaped_nickname)
-
-            request = ur.Request(call_url)
-
-            # authenticate?
-            if self.api_username != "":
-                authentication_pair = "{0}:{1}".format(self.api_username, self.api_password)
-                authentication_bytes = authentication_pair.encode("utf-8")
-                authentication_b64_string = base64.b64encode(authentication_bytes).decode("us-ascii")
-                request.add_header("Authorization", "Basic {0}".format(authentication_b64_string))
-
-            response = ur.urlopen(request)
-            response_data = response.read().decode("us-ascii")
-
-            if response_data == "NULL":
-                nicknames_infos[nickname] = None
-                continue
-
-            pieces = response_data.split(" ")
-            if len(pieces) != 3:
-                logger.debug("unexpected server answer {0} for nickname {1}".format(
-                    repr(response_data), repr(nickname)
-                ))
-                continue
-
-            (timestamp_string, message_id_string, epoch_string) = pieces
-
-            try:
-                timestamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(int(timestamp_string)))
-            except ValueError:
-                timestamp = -1
-
-            try:
-               message_id = int(message_id_string)
-            except ValueError:
-                message_id = None
-
-            try:
-                epoch = int(epoch_string)
-            except ValueError:
-                epoch = None
-
-            nicknames_infos[nickname] = (timestamp, message_id, epoch)
+        nicknames_infos = self.look_up_all(nicknames)
 
         if len(nicknames) == 1:
             # single-user request
             nickname = nicknames[0]
-            info = nicknames_infos[nickname]
 
+            if nickname not in nicknames_infos:
+                self.connector.send_message(
+                    "[noparse]{0}[/noparse]: The great and powerful [i]signanz[/i] didn't answer me\u2014sorry!".format(
+                        message.user_name
+                    )
+                )
+                return
+
+            info = nicknames_infos[nickname]
             if info is None:
                 self.connector.send_message(
                     "[noparse]{0}[/noparse]: The great and powerful [i]signanz[/i] doesn't remember seeing "
@@ -129,8 +133,11 @@ class LastSeenApi(Module):
         else:
             response_bits = []
             for nickname in nicknames:
-                info = nicknames_infos[nickname]
+                if nickname not in nicknames_infos:
+                    response_bits.append("[i][noparse]{0}[/noparse][/i]: ?".format(nickname))
+                    continue
 
+                info = nicknames_infos[nickname]
                 if info is None:
                     text = "never"
                 else:
@@ -154,6 +161,121 @@ class LastSeenApi(Module):
                 )
             )
 
+    def look_up_all(self, nicknames):
+        """
+        Look up when the given users have last been seen, answering from the cache where possible
+        and querying the API concurrently otherwise. Gives up on any answer that hasn't arrived
+        once the deadline has passed.
+        :type nicknames: list[str]
+        :return: A dictionary mapping each nickname whose lookup succeeded to None (never seen) or a
+        tuple of the formatted timestamp, the message ID and the epoch.
+        :rtype: dict[str, (str, int|None, int|None)|None]
+        """
+        nicknames_infos = {}
+        to_query = []
+        now = time.monotonic()
+        with self.cache_lock:
+            for nickname in nicknames:
+                cached = self.cache.get(nickname, None)
+                if cached is not None and cached[0] > now:
+                    nicknames_infos[nickname] = cached[1]
+                elif nickname not in to_query:
+                    to_query.append(nickname)
+
+        if len(to_query) == 0:
+            return nicknames_infos
+
+        if self.bulk_api_url is not None and len(to_query) > 1:
+            futures_to_nicknames = {self.executor.submit(self.query_bulk, to_query): None}
+        else:
+            futures_to_nicknames = {
+                self.executor.submit(self.query_single, nickname): nickname
+                for nickname in to_query
+            }
+
+        (done, not_done) = concurrent.futures.wait(futures_to_nicknames.keys(), timeout=self.deadline)
+        for future in not_done:
+            future.cancel()
+        if len(not_done) > 0:
+            logger.warning("{0} of {1} last-seen lookups missed the deadline".format(
+                len(not_done), len(futures_to_nicknames)
+            ))
+
+        answers = {}
+        for future in done:
+            nickname = futures_to_nicknames[future]
+            try:
+                if nickname is None:
+                    answers.update(future.result())
+                else:
+                    answers[nickname] = future.result()
+            except Exception:
+                logger.exception("looking up {0}".format(
+                    repr(nickname) if nickname is not None else "nicknames in bulk"
+                ))
+
+        expires = time.monotonic() + self.cache_time
+        with self.cache_lock:
+            if len(self.cache) > 256:
+                self.cache = {nick: entry for (nick, entry) in self.cache.items() if entry[0] > now}
+            for (nickname, info) in answers.items():
+                self.cache[nickname] = (expires, info)
+
+        nicknames_infos.update(answers)
+        return nicknames_infos
+
+    def query(self, url, max_redirects=5):
+        """
+        Fetch the answer of the API at the given URL over a pooled connection, following redirects
+        (the credentials are only sent to the host of the original URL).
+        :rtype: str
+        """
+        original_host = up.urlsplit(url).netloc.lower()
+        for _ in range(max_redirects + 1):
+            headers = self.request_headers
+            if up.urlsplit(url).netloc.lower() != original_host:
+                headers = {key: value for (key, value) in headers.items() if key != "Authorization"}
+
+            (connection, response) = self.pool.request(url, "GET", headers)
+            try:
+                response_bytes = response.read()
+            except:
+                connection.close()
+                raise
+            self.pool.finish(url, connection, response, True)
+
+            if response.status in redirect_statuses:
+                location = response.getheader("Location")
+                if location is None:
+                    raise ApiError("HTTP {0} without a location".format(response.status))
+                url = up.urljoin(url, location)
+                continue
+
+            if response.status != 200:
+                raise ApiError("HTTP {0}".format(response.status))
+            return response_bytes.decode("us-ascii")
+
+        raise ApiError("too many redirects")
+
+    def query_single(self, nickname):
+        # note: must be specified as "%%USERNAME%%" in the config file
+        # due to variable substitution in configparse
+        call_url = self.api_url.replace("%USERNAME%", up.quote_plus(nickname))
+        return parse_answer(self.query(call_url), nickname)
+
+    def query_bulk(self, nicknames):
+        # the API answers with one line per nickname, in the order they were requested
+        call_url = self.bulk_api_url.replace(
+            "%USERNAMES%", ";".join(up.quote_plus(nickname) for nickname in nicknames)
+        )
+        lines = self.query(call_url).split("\n")
+        if len(lines) < len(nicknames):
+            raise ApiError("expected {0} answers, got {1}".format(len(nicknames), len(lines)))
+        return {
+            nickname: parse_answer(line.strip(), nickname)
+            for (nickname, line) in zip(nicknames, lines)
+        }
+
     def __init__(self, connector, config_section):
         """
         Create a new messaging responder.
@@ -178,3 +300,43 @@ class LastSeenApi(Module):
         self.archive_link_template = None
         if "archive link template" in config_section:
             self.archive_link_template = config_section["archive link template"]
+
+        # an optional URL answering for multiple users at once, containing "%%USERNAMES%%"
+        self.bulk_api_url = None
+        if "bulk api url" in config_section:
+            self.bulk_api_url = config_section["bulk api url"]
+
+        # seconds to wait for each request, and for all the answers to a single command
+        timeout = 5
+        if "timeout" in config_section:
+            timeout = float(config_section["timeout"])
+
+        self.deadline = 10
+        if "deadline" in config_section:
+            self.deadline = float(config_section["deadline"])
+
+        # seconds for which answers are reused
+        self.cache_time = 60
+        if "cache time" in config_section:
+            self.cache_time = float(config_section["cache time"])
+
+        max_workers = 4
+        if "concurrent lookups" in config_section:
+            max_workers = int(config_section["concurrent lookups"])
+
+        self.request_headers = {}
+        if self.api_username != "":
+            authentication_pair = "{0}:{1}".format(self.api_username, self.api_password)
+            authentication_bytes = authentication_pair.encode("utf-8")
+            authentication_b64_string = base64.b64encode(authentication_bytes).decode("us-ascii")
+            self.request_headers["Authorization"] = "Basic {0}".format(authentication_b64_string)
+
+        self.pool = ConnectionPool(timeout, max_workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, "LastSeenApi lookup")
+        self.cache = {}
+        """:type: dict[str, (float, (str, int|None, int|None)|None)]"""
+        self.cache_lock = threading.Lock()
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pool.close_all()
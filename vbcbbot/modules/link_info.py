@@ -1,6 +1,10 @@
+from vbcbbot.http_pool import ConnectionPool, default_ports, redirect_statuses
 from vbcbbot.modules import Module
 
 from bs4 import UnicodeDammit
+import codecs
+import collections
+import concurrent.futures
 from http.cookiejar import CookieJar
 import ipaddress
 import logging
@@ -8,7 +12,9 @@ from lxml import etree
 from lxml.cssselect import CSSSelector
 import re
 import socket
-import urllib.error as ue
+import sqlite3
+import threading
+import time
 import urllib.parse as up
 import urllib.request as ur
 
@@ -21,7 +27,24 @@ google_image_search_url = "http://www.google.com/imghp?hl=en&tab=wi"
 google_search_by_image_url = "https://www.google.com/searchbyimage?hl=en&image_url={0}"
 fake_user_agent = "Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0"
 
-netloc_split_port_re = re.compile("^(.*?)(:[0-9]+)?$")
+html_content_types = ("text/html", "application/xhtml+xml")
+image_extensions = (".png", ".jpg", ".jpeg", ".gif")
+read_chunk_size = 8192
+encoding_sniff_bytes = 1024
+meta_charset_re = re.compile(b"<meta[^>]+charset\\s*=\\s*[\"']?\\s*([-_.:a-z0-9]+)", re.IGNORECASE)
+byte_order_marks = (
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+default_cache_ttls = {
+    "text/html": 60*60,
+    "application/xhtml+xml": 60*60,
+    "image/*": 24*60*60,
+    "blocked": 60*60,
+    "error": 5*60,
+    "*": 60*60,
+}
 
 
 def find_links(node_list):
@@ -44,124 +67,744 @@ def find_icons(node_list):
     return ret
 
 
-def obtain_image_info(url, text):
-    try:
-        # initialize cookies
-        jar = CookieJar()
-        opener = ur.build_opener(ur.HTTPCookieProcessor(jar))
-
-        # alibi-visit the image search page to get the cookies
-        opener.open(ur.Request(
-            google_image_search_url,
-            headers={"Referer": google_homepage_url, "User-Agent": fake_user_agent}
-        ),timeout=10).read()
-
-        # fetch the actual info
-        search_url = google_search_by_image_url.format(up.quote_plus(url))
-        response_object = opener.open(ur.Request(
-            search_url,
-            headers={"Referer": google_image_search_url, "User-Agent": fake_user_agent}
-        ), timeout=10)
-        response_bytes = response_object.read()
-
-        parse_me = response_bytes
-        ud_result = UnicodeDammit(response_bytes)
-        if ud_result is not None:
-            parse_me = ud_result.unicode_markup
-        dom = etree.HTML(parse_me)
-        sel = CSSSelector(".qb-bmqc .qb-b")
-        found_hints = sel(dom)
-        if len(found_hints) == 0:
-            return text
-        return "{0} ({1})".format(text, "".join(found_hints[0].itertext()))
-    except:
-        logger.exception("image info")
-        return text
+def is_public_address(address):
+    """
+    Return whether the IP address may be accessed (i.e. is neither private nor link-local).
+    :type address: str
+    :rtype: bool
+    """
+    ip_addr = ipaddress.ip_address(address)
+    return not (ip_addr.is_link_local or ip_addr.is_private)
+
+
+def getaddrinfo_lookup(host):
+    """
+    Resolve the host name using the system resolver.
+    :return: The IP addresses of the host.
+    :rtype: list[str]
+    """
+    resolutions = socket.getaddrinfo(host, None, proto=socket.SOL_TCP)
+    return [sock_addr[0] for (family, type, proto, canon_name, sock_addr) in resolutions]
+
+
+class StaticLookup:
+    """Resolves host names from a fixed table; a stand-in for the system resolver in tests."""
+
+    def __init__(self, hosts_to_addresses):
+        """
+        :param hosts_to_addresses: The IP addresses of each known host name.
+        :type hosts_to_addresses: dict[str, list[str]]
+        """
+        self.hosts_to_addresses = hosts_to_addresses
+
+    def __call__(self, host):
+        if host not in self.hosts_to_addresses:
+            raise socket.gaierror(socket.EAI_NONAME, "unknown host")
+        return list(self.hosts_to_addresses[host])
+
+
+class ResolutionTimings:
+    """Statistics about the resolution of a single host name."""
+
+    def __init__(self):
+        self.lookups = 0
+        self.cache_hits = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds):
+        self.lookups += 1
+        self.total_seconds += seconds
+        if self.max_seconds < seconds:
+            self.max_seconds = seconds
+
+    def __repr__(self):
+        return "ResolutionTimings(lookups={0}, cache_hits={1}, total_seconds={2:.3f}, max_seconds={3:.3f})".format(
+            self.lookups, self.cache_hits, self.total_seconds, self.max_seconds
+        )
+
+
+class Resolver:
+    """
+    Resolves and vets host names on its own threads, caching the results. The vetted address is
+    then used for the connection itself, so the host name is resolved only once per check.
+    """
+
+    def __init__(self, timeout=5, ttl=5*60, negative_ttl=30, max_entries=1024, lookup=None,
+                 address_filter=None):
+        """
+        Create a new resolver.
+        :param timeout: How long to wait for a lookup, in seconds.
+        :param ttl: How long successful lookups are cached, in seconds. (The system resolver does
+        not expose the TTLs of the DNS records.)
+        :param negative_ttl: How long failed lookups are cached, in seconds.
+        :param max_entries: The maximum number of host names to cache.
+        :param lookup: A function taking a host name and returning a list of IP addresses; the
+        system resolver is used if None.
+        :param address_filter: A function taking an IP address and returning whether it may be
+        accessed; is_public_address is used if None.
+        """
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lookup = lookup if lookup is not None else getaddrinfo_lookup
+        self.address_filter = address_filter if address_filter is not None else is_public_address
+
+        self.hosts_to_entries = collections.OrderedDict()
+        """:type: collections.OrderedDict[str, (list[str]|None, float)]"""
+        self.hosts_to_pending = {}
+        # kept for the same hosts as the cache entries (and limited in the same way)
+        self.hosts_to_timings = collections.OrderedDict()
+        """:type: collections.OrderedDict[str, ResolutionTimings]"""
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def timed_lookup(self, host):
+        start_time = time.monotonic()
+        try:
+            return self.lookup(host)
+        finally:
+            elapsed = time.monotonic() - start_time
+            with self.lock:
+                self.timings_for(host).record(elapsed)
+            logger.debug("resolving {0} took {1:.3f}s".format(repr(host), elapsed))
+
+    def run_lookup(self, host, future):
+        """
+        Look up the host and deliver the outcome through the future. Runs on a thread of its own
+        (plain, unlike a thread pool's, so it is also available while the interpreter is shutting
+        down), which lingers in the background if the lookup outlasts the timeout.
+        :type future: concurrent.futures.Future
+        """
+        try:
+            future.set_result(self.timed_lookup(host))
+        except BaseException as exc:
+            future.set_exception(exc)
 
+    def timings_for(self, host):
+        """
+        Return the resolution statistics of the host, creating them if necessary and evicting those
+        of the least recently used host if there are too many. Must be called with lock held.
+        :rtype: ResolutionTimings
+        """
+        timings = self.hosts_to_timings.get(host, None)
+        if timings is None:
+            timings = ResolutionTimings()
+            self.hosts_to_timings[host] = timings
+            while len(self.hosts_to_timings) > self.max_entries:
+                self.hosts_to_timings.popitem(last=False)
+        else:
+            self.hosts_to_timings.move_to_end(host)
+        return timings
+
+    def resolve(self, host):
+        """
+        Return the IP addresses of the host.
+        :raises FetchError: If the host cannot be resolved.
+        :rtype: list[str]
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.hosts_to_entries.get(host, None)
+            if entry is not None and entry[1] > now:
+                self.hosts_to_entries.move_to_end(host)
+                self.timings_for(host).cache_hits += 1
+                if entry[0] is None:
+                    raise FetchError("(cannot resolve)")
+                return entry[0]
+
+            future = self.hosts_to_pending.get(host, None)
+            if future is None:
+                if self.stopped:
+                    raise FetchError("(cannot resolve)")
+                future = concurrent.futures.Future()
+                self.hosts_to_pending[host] = future
+                threading.Thread(
+                    None, self.run_lookup, "LinkInfo resolver", (host, future), daemon=True
+                ).start()
 
-def check_url_blacklist(url):
-    url_parts = up.urlparse(url)
-    netloc_with_port = url_parts.netloc
+        try:
+            addresses = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            # leave it pending; whoever asks next can still use its result
+            raise FetchError("(cannot resolve)")
+        except (OSError, UnicodeError):
+            addresses = []
+
+        with self.lock:
+            if self.hosts_to_pending.get(host, None) is future:
+                del self.hosts_to_pending[host]
+                if len(addresses) == 0:
+                    self.hosts_to_entries[host] = (None, time.monotonic() + self.negative_ttl)
+                else:
+                    self.hosts_to_entries[host] = (addresses, time.monotonic() + self.ttl)
+                self.hosts_to_entries.move_to_end(host)
+                while len(self.hosts_to_entries) > self.max_entries:
+                    (evicted_host, _) = self.hosts_to_entries.popitem(last=False)
+                    self.hosts_to_timings.pop(evicted_host, None)
+
+        if len(addresses) == 0:
+            raise FetchError("(cannot resolve)")
+        return addresses
+
+    def vetted_address(self, url):
+        """
+        Resolve the host of the URL and make sure none of its addresses are off-limits.
+        :raises FetchError: If the URL is invalid, its host cannot be resolved or it may not be
+        accessed.
+        :return: The address to connect to.
+        :rtype: str
+        """
+        try:
+            host = up.urlsplit(url).hostname
+        except ValueError:
+            host = None
+        if host is None or host == "":
+            raise FetchError("(invalid URL)", "blocked")
 
-    if netloc_with_port == '':
-        return "(invalid URL)"
+        addresses = self.resolve(host)
+        for address in addresses:
+            if not self.address_filter(address):
+                raise FetchError("(I refuse to access local IP addresses)", "blocked")
 
-    # remove the port
-    netloc = netloc_split_port_re.match(netloc_with_port).group(1)
+        # it's fine
+        return addresses[0]
 
-    # resolve
-    resolutions = socket.getaddrinfo(netloc, None, proto=socket.SOL_TCP)
+    def timings(self):
+        """
+        Return a snapshot of the per-host resolution statistics.
+        :rtype: dict[str, ResolutionTimings]
+        """
+        with self.lock:
+            return dict(self.hosts_to_timings)
+
+    def shutdown(self):
+        """Refuse to start any further lookups."""
+        with self.lock:
+            self.stopped = True
 
-    if len(resolutions) == 0:
-        return "(cannot resolve)"
 
-    for (family, type, proto, canon_name, sock_addr) in resolutions:
-        ip_addr = ipaddress.ip_address(sock_addr[0])
-        if ip_addr.is_link_local or ip_addr.is_private:
-            return "(I refuse to access local IP addresses)"
+class FetchError(Exception):
+    """A linked resource could not (or may not) be fetched."""
+
+    def __init__(self, message, kind="error"):
+        """
+        :param message: The description of the problem shown to the users.
+        :param kind: "blocked" if the resource may not be accessed, "error" if fetching it failed.
+        """
+        Exception.__init__(self, message)
+        self.kind = kind
 
-    # it's fine
-    return None
 
+class FetchResult:
+    """The outcome of fetching a URL."""
 
-def obtain_link_info(url):
+    def __init__(self, url, status, content_type, title=None):
+        """
+        :param title: The title of an HTML document (None if it has none or isn't HTML).
+        """
+        self.url = url
+        self.status = status
+        self.content_type = content_type
+        self.title = title
+
+
+def known_encoding(name):
+    """
+    Return the canonical name of the encoding, or None if Python doesn't know it.
+    :type name: str|bytes|None
+    :rtype: str|None
+    """
+    if name is None:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode("ascii", "replace")
     try:
-        lower_url = url.lower()
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+
+def sniff_encoding(head, header_encoding=None):
+    """
+    Determine the encoding of an HTML document from its first bytes (a byte-order mark or a meta
+    tag) and the charset given in its Content-Type header.
+    :param head: The first bytes of the document.
+    :type head: bytes
+    :param header_encoding: The charset from the Content-Type header, if any.
+    :type header_encoding: str|None
+    :rtype: str
+    """
+    for (bom, encoding) in byte_order_marks:
+        if head.startswith(bom):
+            return encoding
+
+    encoding = known_encoding(header_encoding)
+    if encoding is not None:
+        return encoding
+
+    meta_match = meta_charset_re.search(head[:encoding_sniff_bytes])
+    if meta_match is not None:
+        encoding = known_encoding(meta_match.group(1))
+        if encoding is not None:
+            if encoding.startswith("utf-16"):
+                # the document could not have been parsed this far if it really were UTF-16
+                return "utf-8"
+            return encoding
+
+    # nothing declared; use UTF-8 if it fits, otherwise fall back to what browsers do
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head[:encoding_sniff_bytes], final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "windows-1252"
+
 
-        if not lower_url.startswith("http://") and not lower_url.startswith("https://"):
-            return "(I only access HTTP and HTTPS URLs)"
+class TitleExtractor:
+    """
+    Finds the title of an HTML document while it is being downloaded, feeding the chunks to a pull
+    parser and stopping as soon as the title (or failing that, the first top-level heading) has
+    been closed.
+    """
 
-        message = check_url_blacklist(url)
-        if message is not None:
-            return message
+    def __init__(self, header_encoding=None, max_bytes=256*1024):
+        """
+        :param header_encoding: The charset from the Content-Type header, if any.
+        :param max_bytes: The number of bytes after which to give up.
+        """
+        self.header_encoding = header_encoding
+        self.max_bytes = max_bytes
+        self.bytes_fed = 0
+        self.head = b""
+        self.decoder = None
+        self.parser = None
+        self.title = None
+        self.heading = None
+
+    @property
+    def done(self):
+        """Whether no more data is needed."""
+        return self.title is not None or self.heading is not None or self.bytes_fed >= self.max_bytes
+
+    def feed(self, chunk):
+        """
+        Feed the next chunk of the document.
+        :type chunk: bytes
+        :return: Whether no more data is needed.
+        :rtype: bool
+        """
+        chunk = chunk[:self.max_bytes - self.bytes_fed]
+        self.bytes_fed += len(chunk)
+
+        if self.parser is None:
+            # collect enough bytes to sniff the encoding
+            self.head += chunk
+            if len(self.head) < encoding_sniff_bytes and self.bytes_fed < self.max_bytes:
+                return False
+            self.start_parsing()
+            chunk, self.head = self.head, b""
+
+        self.parse(self.decoder.decode(chunk))
+        return self.done
+
+    def start_parsing(self):
+        encoding = sniff_encoding(self.head, self.header_encoding)
+        logger.debug("parsing HTML as {0}".format(encoding))
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self.parser = etree.HTMLPullParser(events=("end",), tag=("title", "h1"))
+
+    def parse(self, text):
+        if len(text) > 0:
+            self.parser.feed(text)
+        self.collect_events()
+
+    def collect_events(self):
+        for (_, element) in self.parser.read_events():
+            if element.tag == "title":
+                self.title = "".join(element.itertext())
+                break
+            elif element.tag == "h1" and self.heading is None:
+                # a title after the body has started would be invalid anyway
+                self.heading = "".join(element.itertext())
+
+    def result(self):
+        """
+        Return the title or the first top-level heading, whichever was found, or None.
+        :rtype: str|None
+        """
+        if self.parser is None:
+            self.start_parsing()
+            self.parse(self.decoder.decode(self.head))
+            self.head = b""
+
+        if self.title is None and self.heading is None:
+            self.parse(self.decoder.decode(b"", final=True))
+            # closing the parser closes any elements left open by a truncated document
+            try:
+                self.parser.close()
+            except etree.LxmlError:
+                pass
+            self.collect_events()
+
+        if self.title is not None:
+            return self.title
+        return self.heading
+
+
+class LinkPreviewer:
+    """Obtains short descriptions of the resources behind links."""
+
+    def __init__(self, timeout=5, max_bytes=256*1024, max_search_page_bytes=1024*1024, resolver=None):
+        """
+        Create a new link previewer.
+        :param timeout: The timeout of each network operation, in seconds.
+        :param max_bytes: The maximum number of bytes to read from a linked resource.
+        :param max_search_page_bytes: The maximum number of bytes to read from an image search
+        result page.
+        :param resolver: The resolver used to find and vet the addresses of hosts, or None to
+        create a default one.
+        :type resolver: Resolver|None
+        """
+        self.timeout = timeout
+        self.resolver = resolver if resolver is not None else Resolver(timeout)
+        self.max_bytes = max_bytes
+        self.max_search_page_bytes = max_search_page_bytes
+        self.pool = ConnectionPool(timeout)
+
+        # one cookie jar for all image searches; the cookies are only fetched once
+        self.google_jar = CookieJar()
+        self.google_opener = ur.build_opener(ur.HTTPCookieProcessor(self.google_jar))
+        self.google_lock = threading.Lock()
+        self.google_cookies_fetched = False
+
+    def request(self, url, address, method, headers):
+        """
+        Perform a single request (without following redirects) to the vetted address.
+        :return: The connection (to be released or closed by the caller) and the response.
+        :rtype: (http.client.HTTPConnection, http.client.HTTPResponse)
+        """
+        all_headers = {"User-Agent": fake_user_agent, "Accept-Encoding": "identity"}
+        all_headers.update(headers)
+        return self.pool.request(url, method, all_headers, address)
+
+    def finish(self, url, address, connection, response, read_completely):
+        """Release the connection to the pool if possible; close it otherwise."""
+        self.pool.finish(url, connection, response, read_completely, address)
+
+    def read_title(self, response):
+        """
+        Read an HTML response until its title has been found or max_bytes have been read.
+        :return: The title (None if none was found) and whether the response has been read
+        completely.
+        :rtype: (str|None, bool)
+        """
+        extractor = TitleExtractor(response.headers.get_content_charset(), self.max_bytes)
+        while True:
+            chunk = response.read(read_chunk_size)
+            if len(chunk) == 0:
+                return extractor.result(), True
+            if extractor.feed(chunk):
+                return extractor.result(), response.isclosed()
+
+    def fetch(self, url, max_redirects=5):
+        """
+        Fetch the headers (and the title, if it is an HTML document) of the resource behind the URL,
+        following redirects and refusing to access local addresses.
+        :raises FetchError: If the resource could not be fetched.
+        :rtype: FetchResult
+        """
+        for _ in range(max_redirects + 1):
+            address = self.resolver.vetted_address(url)
 
+            # images don't need a body; HTML only needs the beginning
+            lower_path = up.urlsplit(url).path.lower()
+            if lower_path.endswith(image_extensions):
+                method, headers = "HEAD", {}
+            else:
+                method, headers = "GET", {"Range": "bytes=0-{0}".format(self.max_bytes - 1)}
+
+            (connection, response) = self.request(url, address, method, headers)
+
+            if method == "HEAD" and response.status in (405, 501):
+                # HEAD not supported; fall back to a ranged GET
+                self.finish(url, address, connection, response, False)
+                method, headers = "GET", {"Range": "bytes=0-{0}".format(self.max_bytes - 1)}
+                (connection, response) = self.request(url, address, method, headers)
+
+            if response.status == 416:
+                # (probably) empty resource; ask for the whole thing (on a new connection, as the
+                # error page's body is not worth reading without limit)
+                self.finish(url, address, connection, response, False)
+                (connection, response) = self.request(url, address, "GET", {})
+
+            if response.status in redirect_statuses:
+                location = response.getheader("Location")
+                self.finish(url, address, connection, response, False)
+                if location is None:
+                    raise FetchError("(HTTP {0})".format(response.status))
+                url = up.urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                self.finish(url, address, connection, response, False)
+                raise FetchError("(HTTP {0})".format(response.status))
+
+            content_type = response.getheader("Content-Type", "application/octet-stream")
+            # application/x-blahblah; charset=utf-32
+            content_type = content_type.split(";")[0].strip().lower()
+
+            title = None
+            read_completely = False
+            if method == "HEAD":
+                response.read()
+                read_completely = True
+            elif content_type in html_content_types:
+                (title, read_completely) = self.read_title(response)
+            self.finish(url, address, connection, response, read_completely)
+
+            return FetchResult(url, response.status, content_type, title)
+
+        raise FetchError("(too many redirects)")
+
+    def obtain_image_info(self, url, text):
         try:
-            response_object = ur.urlopen(url, timeout=5)
-        except ue.HTTPError as err:
-            return "(HTTP {0})".format(err.code)
-        response_bytes = response_object.read()
-        response_headers = response_object.getheaders()
-
-        # find content-type
-        content_type = "application/octet-stream"
-        for (n, v) in response_headers:
-            if n == "Content-Type":
-                # application/x-blahblah; charset=utf-32
-                content_type = v.split(";")[0]
-
-        if content_type == "application/octet-stream":
-            return "(can't figure out the content type, sorry)"
-
-        if content_type in ("text/html", "application/xhtml+xml"):
-            # HTML? parse it and get the title
+            with self.google_lock:
+                if not self.google_cookies_fetched:
+                    # alibi-visit the image search page to get the cookies
+                    self.google_opener.open(ur.Request(
+                        google_image_search_url,
+                        headers={"Referer": google_homepage_url, "User-Agent": fake_user_agent}
+                    ), timeout=self.timeout).read()
+                    self.google_cookies_fetched = True
+
+            # fetch the actual info
+            search_url = google_search_by_image_url.format(up.quote_plus(url))
+            response_object = self.google_opener.open(ur.Request(
+                search_url,
+                headers={"Referer": google_image_search_url, "User-Agent": fake_user_agent}
+            ), timeout=self.timeout)
+            response_bytes = response_object.read(self.max_search_page_bytes)
+
             parse_me = response_bytes
             ud_result = UnicodeDammit(response_bytes)
             if ud_result is not None:
                 parse_me = ud_result.unicode_markup
-            html = etree.HTML(parse_me)
-            title_element = html.find(".//title")
-            if title_element is not None:
-                return "".join(title_element.itertext())
-            h1_element = html.find(".//h1")
-            if h1_element is not None:
-                return "".join(h1_element.itertext())
-            return "(HTML without a title O_o)"
-        elif content_type == "image/png":
-            return obtain_image_info(url, "PNG image")
-        elif content_type == "image/jpeg":
-            return obtain_image_info(url, "JPEG image")
-        elif content_type == "image/gif":
-            return obtain_image_info(url, "GIF image")
-        elif content_type == "application/json":
-            return "JSON"
-        elif content_type in ("text/xml", "application/xml"):
-            return "XML"
-
-        return "file of type {0}".format(content_type)
-
-    except:
-        logger.exception("link info")
-        return "(an error occurred)"
+            dom = etree.HTML(parse_me)
+            sel = CSSSelector(".qb-bmqc .qb-b")
+            found_hints = sel(dom)
+            if len(found_hints) == 0:
+                return text
+            return "{0} ({1})".format(text, "".join(found_hints[0].itertext()))
+        except:
+            logger.exception("image info")
+            with self.google_lock:
+                # perhaps the cookies have gone stale
+                self.google_cookies_fetched = False
+            return text
+
+    def describe_link(self, url):
+        """
+        Obtain a description of the resource behind the URL.
+        :return: The description and its kind: the content type of the resource, "blocked" if it
+        may not be accessed, or "error" if obtaining the description failed.
+        :rtype: (str, str)
+        """
+        try:
+            lower_url = url.lower()
+
+            if not lower_url.startswith("http://") and not lower_url.startswith("https://"):
+                return "(I only access HTTP and HTTPS URLs)", "blocked"
+
+            try:
+                result = self.fetch(url)
+            except FetchError as err:
+                return str(err), err.kind
+            content_type = result.content_type
+
+            if content_type == "application/octet-stream":
+                return "(can't figure out the content type, sorry)", content_type
+
+            if content_type in html_content_types:
+                # HTML? the title has already been parsed out
+                if result.title is None:
+                    return "(HTML without a title O_o)", content_type
+                return result.title, content_type
+            elif content_type == "image/png":
+                return self.obtain_image_info(url, "PNG image"), content_type
+            elif content_type == "image/jpeg":
+                return self.obtain_image_info(url, "JPEG image"), content_type
+            elif content_type == "image/gif":
+                return self.obtain_image_info(url, "GIF image"), content_type
+            elif content_type == "application/json":
+                return "JSON", content_type
+            elif content_type in ("text/xml", "application/xml"):
+                return "XML", content_type
+
+            return "file of type {0}".format(content_type), content_type
+
+        except:
+            logger.exception("link info")
+            return "(an error occurred)", "error"
+
+
+def normalize_url(url):
+    """
+    Normalize the URL for use as a cache key: lowercase the scheme and host, drop the default port
+    and the fragment, and make sure the path is not empty.
+    :type url: str
+    :rtype: str
+    """
+    try:
+        url_parts = up.urlsplit(url.strip())
+        scheme = url_parts.scheme.lower()
+        host = url_parts.hostname or ""
+        port = url_parts.port
+    except ValueError:
+        return url
+
+    netloc = host
+    if ":" in host:
+        # IPv6 literal
+        netloc = "[{0}]".format(host)
+    if port is not None and port != default_ports.get(scheme, None):
+        netloc += ":{0}".format(port)
+    if url_parts.username is not None:
+        netloc = "{0}@{1}".format(url_parts.netloc.rsplit("@", 1)[0], netloc)
+
+    return up.urlunsplit((scheme, netloc, url_parts.path or "/", url_parts.query, ""))
+
+
+class LinkInfoCache:
+    """
+    Caches link descriptions by normalized URL. Entries expire after a time depending on their
+    kind, the least recently used entries are evicted from memory (optionally into a SQLite
+    database), and concurrent requests for the same URL share a single fetch.
+    """
+
+    def __init__(self, kinds_to_ttls, default_ttl, max_entries=256, database_path=None):
+        """
+        Create a new link info cache.
+        :param kinds_to_ttls: Time to live in seconds for each kind of description (a content type,
+        a content type pattern such as "image/*", "blocked" or "error").
+        :type kinds_to_ttls: dict[str, float]
+        :param default_ttl: Time to live for descriptions of any other kind.
+        :param max_entries: The maximum number of entries kept in memory.
+        :param database_path: The path of the SQLite database to spill evicted entries into, or None.
+        """
+        self.kinds_to_ttls = kinds_to_ttls
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        """:type: collections.OrderedDict[str, (str, float)]"""
+        self.urls_to_pending = {}
+        """:type: dict[str, concurrent.futures.Future]"""
+        self.lock = threading.Lock()
+
+        self.database = None
+        if database_path is not None:
+            self.database = sqlite3.connect(database_path, check_same_thread=False)
+            cursor = self.database.cursor()
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS link_info_cache (
+                url TEXT NOT NULL,
+                info TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (url)
+            )
+            """)
+            cursor.execute("DELETE FROM link_info_cache WHERE expires < ?", (time.time(),))
+            self.database.commit()
+
+    def ttl_for_kind(self, kind):
+        if kind in self.kinds_to_ttls:
+            return self.kinds_to_ttls[kind]
+        wildcard = kind.split("/")[0] + "/*"
+        if wildcard in self.kinds_to_ttls:
+            return self.kinds_to_ttls[wildcard]
+        return self.default_ttl
+
+    def lookup(self, key):
+        """
+        Return the cached description for the normalized URL, or None. Must be called with lock
+        held.
+        """
+        now = time.time()
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            if entry[1] > now:
+                self.entries.move_to_end(key)
+                return entry[0]
+            del self.entries[key]
+
+        if self.database is not None:
+            cursor = self.database.cursor()
+            cursor.execute("SELECT info, expires FROM link_info_cache WHERE url=?", (key,))
+            row = cursor.fetchone()
+            if row is not None and row[1] > now:
+                # promote it back into memory
+                self.store(key, row[0], row[1])
+                return row[0]
+
+        return None
+
+    def store(self, key, info, expires):
+        """Store an entry in memory, spilling the least recently used one. Call with lock held."""
+        self.entries[key] = (info, expires)
+        self.entries.move_to_end(key)
+
+        spilled = []
+        while len(self.entries) > self.max_entries:
+            spilled.append(self.entries.popitem(last=False))
+
+        if self.database is not None and len(spilled) > 0:
+            cursor = self.database.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO link_info_cache (url, info, expires) VALUES (?, ?, ?)",
+                ((url, entry[0], entry[1]) for (url, entry) in spilled)
+            )
+            self.database.commit()
+
+    def get_or_fetch(self, url, describe):
+        """
+        Return the description of the URL, calling describe to obtain it if it isn't cached. If
+        another thread is already obtaining the description of the same URL, wait for its result.
+        :param url: The URL to describe.
+        :param describe: A function taking the URL and returning a (description, kind) tuple.
+        :rtype: str
+        """
+        key = normalize_url(url)
+        with self.lock:
+            info = self.lookup(key)
+            if info is not None:
+                return info
+
+            pending = self.urls_to_pending.get(key, None)
+            if pending is None:
+                future = concurrent.futures.Future()
+                self.urls_to_pending[key] = future
+            else:
+                future = None
+
+        if future is None:
+            # someone else is fetching this already
+            return pending.result()
+
+        try:
+            (info, kind) = describe(url)
+        except BaseException as exc:
+            with self.lock:
+                del self.urls_to_pending[key]
+            future.set_exception(exc)
+            raise
+
+        with self.lock:
+            ttl = self.ttl_for_kind(kind)
+            if ttl > 0:
+                self.store(key, info, time.time() + ttl)
+            del self.urls_to_pending[key]
+        future.set_result(info)
+        return info
 
 
 class LinkInfo(Module):
@@ -172,10 +815,20 @@ class LinkInfo(Module):
         return
 
     def post_link_info(self, links):
-        # fetch their info
-        links_infos = ((link, obtain_link_info(link)) for link in links)
+        # fetch their info concurrently, but don't wait for stragglers forever
+        futures = [
+            self.executor.submit(self.cache.get_or_fetch, link, self.previewer.describe_link)
+            for link in links
+        ]
+        concurrent.futures.wait(futures, timeout=self.message_deadline)
+
+        for (link, future) in zip(links, futures):
+            if future.done():
+                link_info = future.result()
+            else:
+                future.cancel()
+                link_info = "(timed out)"
 
-        for (link, link_info) in links_infos:
             # clear out [noparse] tags
             previous = None
             while link_info != previous:
@@ -232,5 +885,53 @@ class LinkInfo(Module):
         if config_section is None:
             config_section = {}
 
+        timeout = 5
+        if "timeout" in config_section:
+            timeout = float(config_section["timeout"])
+
+        max_bytes = 256*1024
+        if "maximum download size" in config_section:
+            max_bytes = int(config_section["maximum download size"])
+
+        max_workers = 4
+        if "concurrent fetches" in config_section:
+            max_workers = int(config_section["concurrent fetches"])
+
+        # how long to wait for all the links of a message to be resolved
+        self.message_deadline = 15
+        if "message deadline" in config_section:
+            self.message_deadline = float(config_section["message deadline"])
+
+        # cache lifetimes (in seconds) by content type or by "blocked" and "error"
+        kinds_to_ttls = dict(default_cache_ttls)
+        if "cache ttls" in config_section:
+            for line in config_section["cache ttls"].split("\n"):
+                pieces = line.split()
+                if len(pieces) != 2:
+                    continue
+                kinds_to_ttls[pieces[0]] = float(pieces[1])
+
+        cache_size = 256
+        if "cache size" in config_section:
+            cache_size = int(config_section["cache size"])
+
+        cache_database = None
+        if "cache database" in config_section:
+            cache_database = config_section["cache database"]
+
+        dns_ttl = 5*60
+        if "dns cache time" in config_section:
+            dns_ttl = float(config_section["dns cache time"])
+
+        self.cache = LinkInfoCache(kinds_to_ttls, kinds_to_ttls.get("*", 60*60), cache_size, cache_database)
+        self.resolver = Resolver(timeout, dns_ttl)
+        self.previewer = LinkPreviewer(timeout, max_bytes, resolver=self.resolver)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, "LinkInfo fetcher")
+
         self.last_link = None
         self.last_icon = None
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.previewer.pool.close_all()
+        self.resolver.shutdown()
@@ -3,7 +3,6 @@ from vbcbbot.modules import Module
 import logging
 import random
 import threading
-import time
 
 __author__ = 'ondra'
 
@@ -16,78 +15,85 @@ class NoDevilBanana(Module):
     def message_modified(self, message):
         """Called by the communicator when a visible message has been modified."""
 
-        body_lxml = message.body_lxml()
-        if body_lxml is None:
-            return
-        for image in body_lxml.iterfind(".//img[@src]"):
-            if image.attrib['src'] == self.no_devil_banana_url:
-                logger.debug(":nodb: found in {0}'s edited message {1}".format(
-                    message.user_name, message.id
-                ))
-                with self.last_lock:
-                    if self.last_nodb_message < message.id:
-                        self.last_nodb_message = message.id
-            elif image.attrib['src'] in self.devil_banana_urls:
-                if message.user_name == self.connector.username:
-                    # ignore my own devil banana messages
-                    return
-                logger.debug("devil banana {2} found in {0}'s edited message {1}".format(
-                    message.user_name, message.id, image.attrib['src']
-                ))
-                with self.last_lock:
-                    if self.last_banana_message < message.id:
-                        self.last_banana_message_due_to_edit = True
-                        self.last_banana_message = message.id
+        index = message.body_index()
+        if index.has_image(self.no_devil_banana_url):
+            logger.debug(":nodb: found in {0}'s edited message {1}".format(
+                message.user_name, message.id
+            ))
+            with self.last_lock:
+                if self.last_nodb_message < message.id:
+                    self.last_nodb_message = message.id
+
+        bananas = index.images_in(self.devil_banana_urls)
+        if len(bananas) > 0:
+            if message.user_name == self.connector.username:
+                # ignore my own devil banana messages
+                return
+            logger.debug("devil banana {2} found in {0}'s edited message {1}".format(
+                message.user_name, message.id, bananas[0]
+            ))
+            with self.last_lock:
+                if self.last_banana_message < message.id:
+                    self.last_banana_message_due_to_edit = True
+                    self.last_banana_message = message.id
+            self.schedule_nodb()
 
     def message_received(self, message):
         """Called by the communicator when a new message has been received."""
 
-        body_lxml = message.body_lxml()
-        for image in body_lxml.iterfind(".//img[@src]"):
-            if image.attrib['src'] == self.no_devil_banana_url:
-                logger.debug(":nodb: found in {0}'s message {1}".format(
-                    message.user_name, message.id
-                ))
-                with self.last_lock:
-                    self.last_nodb_message = message.id
-            elif image.attrib['src'] in self.devil_banana_urls:
-                if message.user_name == self.connector.username:
-                    # ignore my own devil banana messages
-                    return
-                logger.debug("devil banana {2} found in {0}'s message {1}".format(
-                    message.user_name, message.id, image.attrib['src']
-                ))
-                with self.last_lock:
-                    self.last_banana_message_due_to_edit = False
-                    self.last_banana_message = message.id
+        index = message.body_index()
+        if index.has_image(self.no_devil_banana_url):
+            logger.debug(":nodb: found in {0}'s message {1}".format(
+                message.user_name, message.id
+            ))
+            with self.last_lock:
+                self.last_nodb_message = message.id
+
+        bananas = index.images_in(self.devil_banana_urls)
+        if len(bananas) > 0:
+            if message.user_name == self.connector.username:
+                # ignore my own devil banana messages
+                return
+            logger.debug("devil banana {2} found in {0}'s message {1}".format(
+                message.user_name, message.id, bananas[0]
+            ))
+            with self.last_lock:
+                self.last_banana_message_due_to_edit = False
+                self.last_banana_message = message.id
+            self.schedule_nodb()
+
+    def schedule_nodb(self):
+        """
+        Check back after nap_time whether someone has countered the banana in the meantime. Any
+        further bananas until then are handled by the same check.
+        """
+        # sending blocks on the forum
+        self.scheduler.call_later(self.nap_time, self.send_nodb_if_needed, key=self.nodb_key, blocking=True)
+
+    def send_nodb_if_needed(self):
+        send_nodb = False
+        addendum = False
+        with self.last_lock:
+            if self.last_banana_message > self.last_nodb_message:
+                logger.debug(
+                    "last banana message {0} later than last :nodb: message {1}".format(
+                        self.last_banana_message, self.last_nodb_message
+                    )
+                )
+                send_nodb = True
+                if self.last_banana_message_due_to_edit:
+                    addendum = True
+
+        if not send_nodb:
+            return
 
-    def nodb_sender(self):
-        try:
-            while not self.stop_now:
-
-                send_nodb = False
-                addendum = False
-                with self.last_lock:
-                    if self.last_banana_message > self.last_nodb_message:
-                        logger.debug(
-                            "last banana message {0} later than last :nodb: message {1}".format(
-                                self.last_banana_message, self.last_nodb_message
-                            )
-                        )
-                        send_nodb = True
-                        if self.last_banana_message_due_to_edit:
-                            addendum = True
-
-                if send_nodb:
-                    outgoing = ":nodb:"
-                    if addendum:
-                        outgoing += " " + self.randomizer.choice(self.addenda_banana_edited_in)
-                    self.connector.send_message(outgoing)
-
-                time.sleep(self.nap_time)
-        except:
-            logger.exception("nodb sender")
-            raise
+        outgoing = ":nodb:"
+        if addendum:
+            outgoing += " " + self.randomizer.choice(self.addenda_banana_edited_in)
+        self.connector.send_message(outgoing)
+
+        # check again in case our :nodb: doesn't make it (e.g. because we've been told to STFU)
+        self.schedule_nodb()
 
     def __init__(self, connector, config_section=None):
         """
@@ -101,21 +107,20 @@ class NoDevilBanana(Module):
             config_section = {}
 
         self.no_devil_banana_url = config_section['no devil banana url']
-        self.devil_banana_urls = config_section['devil banana urls']
+        self.devil_banana_urls = set()
+        for line in config_section['devil banana urls'].split("\n"):
+            url = line.strip()
+            if len(url) > 0:
+                self.devil_banana_urls.add(url)
         self.addenda_banana_edited_in = config_section['addenda banana edited in'].split("\n")
 
         self.nap_time = 10
-        self.stop_now = False
+        self.nodb_key = (self, "nodb")
         self.last_nodb_message = -1
         self.last_banana_message = -1
         self.last_banana_message_due_to_edit = False
         self.last_lock = threading.Lock()
         self.randomizer = random.Random()
 
-        self.nodb_sender_thread = threading.Thread(None, self.nodb_sender, "NoDevilBanana sender")
-
-    def start(self):
-        self.nodb_sender_thread.start()
-
     def stop(self):
-        self.stop_now = True
+        self.scheduler.cancel_key(self.nodb_key)
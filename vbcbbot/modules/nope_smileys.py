@@ -2,8 +2,6 @@ from vbcbbot.modules import Module
 
 import logging
 import queue
-import threading
-import time
 
 __author__ = 'ondra'
 
@@ -16,42 +14,34 @@ class NopeSmileys(Module):
     def message_received(self, message):
         """Called by the communicator when a new message has been received."""
 
-        body_lxml = message.body_lxml()
-        if body_lxml is None:
-            return
-        for image in body_lxml.iterfind(".//img[@src]"):
-            src = image.attrib['src']
-            if src in self.nope_mapping:
-                logger.debug("smiley {0} maps to nope smiley {1}".format(src,
-                                                                         self.nope_mapping[src]))
-                try:
-                    self.nope_queue.put(self.nope_mapping[src], block=False)
-                except queue.Full:
-                    # never mind; skip the rest of this message too
-                    return
-
-    def nope_sender(self):
+        for src in message.body_index().images_in(self.nope_mapping):
+            logger.debug("smiley {0} maps to nope smiley {1}".format(src,
+                                                                     self.nope_mapping[src]))
+            try:
+                self.nope_queue.put(self.nope_mapping[src], block=False)
+            except queue.Full:
+                # never mind; skip the rest of this message too
+                break
+
+        if not self.nope_queue.empty():
+            # collect whatever else turns up during the nap, then send it all in one message
+            self.scheduler.call_later(self.nap_time, self.send_nopes, key=self.send_key, blocking=True)
+
+    def send_nopes(self):
+        send_these = []
         try:
-            while not self.stop_now:
-                send_these = []
-                try:
-                    while True:
-                        send_this = self.nope_queue.get(block=False)
-                        send_these.append(send_this)
-                        self.nope_queue.task_done()
-                except queue.Empty:
-                    # we jumped out of the inner loop
-                    pass
-
-                if len(send_these) > 0:
-                    send_these_commands = ("[icon]{0}[/icon]".format(t) for t in send_these)
-                    message = " ".join(send_these_commands)
-                    self.connector.send_message(message)
-
-                time.sleep(self.nap_time)
-        except:
-            logger.exception("nope sender")
-            raise
+            while True:
+                send_this = self.nope_queue.get(block=False)
+                send_these.append(send_this)
+                self.nope_queue.task_done()
+        except queue.Empty:
+            # we jumped out of the inner loop
+            pass
+
+        if len(send_these) > 0:
+            send_these_commands = ("[icon]{0}[/icon]".format(t) for t in send_these)
+            message = " ".join(send_these_commands)
+            self.connector.send_message(message)
 
     def __init__(self, connector, config_section=None):
         """
@@ -73,7 +63,7 @@ class NopeSmileys(Module):
             smiley_to_nope[key_val[0]] = key_val[1]
 
         self.nap_time = 30
-        self.stop_now = False
+        self.send_key = (self, "send nopes")
         self.nope_queue = queue.Queue(maxsize=128)
 
         self.nope_mapping = {}
@@ -82,10 +72,5 @@ class NopeSmileys(Module):
             if smiley in smiley_to_nope:
                 self.nope_mapping[yes_url] = smiley_to_nope[smiley]
 
-        self.nope_sender_thread = threading.Thread(None, self.nope_sender, "NopeSmileys sender")
-
-    def start(self):
-        self.nope_sender_thread.start()
-
     def stop(self):
-        self.stop_now = True
+        self.scheduler.cancel_key(self.send_key)
@@ -1,9 +1,11 @@
 from vbcbbot.modules import Module
 
+import heapq
 import logging
 import random
 import re
 import sqlite3
+import threading
 import time
 
 __author__ = 'ondra'
@@ -83,24 +85,23 @@ class Stfu(Module):
         if body == "!stfu":
             # check for ban
             the_time = time.time()
-            cursor = self.database.cursor()
-            cursor.execute(
-                "SELECT deadline FROM running_bans WHERE banned_user=?",
-                (new_message.user_name,)
-            )
-            for row in cursor:
-                if row[0] is None:
+            with self.ban_lock:
+                is_banned = new_message.user_name in self.bans
+                deadline = self.bans.get(new_message.user_name, None)
+
+            if is_banned:
+                if deadline is None:
                     # ignore it
                     logger.debug("{0} wants to shut be up but they're permabanned".format(
                         new_message.user_name
                     ))
                     self.send_snark(new_message.user_name)
                     return
-                elif int(row[0]) > the_time:
+                elif deadline > the_time:
                     # ignore it
                     logger.debug("{0} wants to shut me up but they're banned until {1}".format(
                         new_message.user_name,
-                        time.strftime(time_format, time.localtime(the_time))
+                        time.strftime(time_format, time.localtime(deadline))
                     ))
                     self.send_snark(new_message.user_name)
                     return
@@ -111,6 +112,7 @@ class Stfu(Module):
             ))
             self.who_shut_me_up_last = new_message.user_name
             self.connector.stfu_deadline = the_time + self.stfu_duration
+            self.schedule(self.connector.stfu_deadline, None)
 
         elif body == "!unstfu":
             if new_message.user_name not in self.admins:
@@ -151,15 +153,19 @@ class Stfu(Module):
             else:
                 deadline = time.time() + seconds
 
-            # insert it into the DB
-            cursor = self.database.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO "
-                "running_bans (banned_user, deadline, banner) "
-                "VALUES (?, ?, ?)",
-                (ban_this_user, deadline, new_message.user_name)
-            )
-            self.database.commit()
+            # insert it into the DB and the cache
+            with self.ban_lock:
+                cursor = self.database.cursor()
+                cursor.execute(
+                    "INSERT OR REPLACE INTO "
+                    "running_bans (banned_user, deadline, banner) "
+                    "VALUES (?, ?, ?)",
+                    (ban_this_user, deadline, new_message.user_name)
+                )
+                self.database.commit()
+                self.bans[ban_this_user] = deadline
+            if deadline is not None:
+                self.schedule(deadline, ban_this_user)
 
             if self.who_shut_me_up_last == ban_this_user:
                 # un-STFU
@@ -193,14 +199,16 @@ class Stfu(Module):
 
             unban_this_user = body[len("!stfuunban "):]
 
-            cursor = self.database.cursor()
-            cursor.execute("DELETE FROM running_bans WHERE banned_user=?", (unban_this_user,))
-            self.database.commit()
+            with self.ban_lock:
+                cursor = self.database.cursor()
+                cursor.execute("DELETE FROM running_bans WHERE banned_user=?", (unban_this_user,))
+                self.database.commit()
+                was_banned = self.bans.pop(unban_this_user, False) is not False
 
             logger.info("{0} unbanned {1} from using !stfu".format(
                 new_message.user_name, unban_this_user
             ))
-            if cursor.rowcount > 0:
+            if was_banned:
                 self.connector.send_message("Alright, {0} may use !stfu again.".format(
                     unban_this_user
                 ))
@@ -209,6 +217,70 @@ class Stfu(Module):
                     unban_this_user
                 ))
 
+    def schedule(self, deadline, banned_user):
+        """
+        Register a deadline with the expiry timer.
+        :param deadline: The Unix timestamp at which something expires.
+        :param banned_user: The user whose ban expires, or None for the current STFU period.
+        """
+        with self.ban_lock:
+            heapq.heappush(self.deadline_heap, (deadline, banned_user or ""))
+            self.rearm_timer()
+
+    def rearm_timer(self):
+        """
+        Make sure the expiry timer fires at the earliest pending deadline. Must be called with
+        ban_lock held.
+        """
+        if len(self.deadline_heap) == 0 or self.stop_now:
+            return
+
+        next_deadline = self.deadline_heap[0][0]
+        if self.timer is not None:
+            if self.timer_deadline <= next_deadline:
+                # already fires early enough
+                return
+            self.timer.cancel()
+
+        self.timer_deadline = next_deadline
+        self.timer = self.scheduler.call_at(next_deadline, self.expire)
+
+    def expire(self):
+        """Called by the expiry timer; lifts bans and STFU periods whose deadline has passed."""
+        now = time.time()
+        expired_bans = []
+        with self.ban_lock:
+            self.timer = None
+            while len(self.deadline_heap) > 0 and self.deadline_heap[0][0] <= now:
+                (deadline, banned_user) = heapq.heappop(self.deadline_heap)
+                if banned_user == "":
+                    # STFU period; ignore it if it has since been extended or lifted
+                    if self.connector.stfu_deadline is not None and self.connector.stfu_deadline <= now:
+                        logger.info("STFU period is over")
+                        self.connector.stfu_deadline = None
+                elif self.bans.get(banned_user, None) == deadline:
+                    # (a stale heap entry if the ban has since been replaced or lifted)
+                    del self.bans[banned_user]
+                    expired_bans.append((banned_user, deadline))
+
+            if len(expired_bans) > 0:
+                logger.debug("bans expired: {0}".format(", ".join(user for (user, _) in expired_bans)))
+                cursor = self.database.cursor()
+                cursor.executemany(
+                    "DELETE FROM running_bans WHERE banned_user=? AND deadline=?",
+                    expired_bans
+                )
+                self.database.commit()
+
+            self.rearm_timer()
+
+    def stop(self):
+        with self.ban_lock:
+            self.stop_now = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
     def __init__(self, connector, config_section):
         """
         Create a new STFU responder.
@@ -267,3 +339,23 @@ class Stfu(Module):
             (time.time(),)
         )
         self.database.commit()
+
+        # cache the running bans; expiring ones are also kept in a heap ordered by deadline
+        self.bans = {}
+        """:type: dict[str, float|None]"""
+        self.deadline_heap = []
+        self.ban_lock = threading.RLock()
+        self.timer = None
+        self.timer_deadline = None
+        self.stop_now = False
+
+        cursor.execute("SELECT banned_user, deadline FROM running_bans")
+        for (banned_user, deadline) in cursor.fetchall():
+            self.bans[banned_user] = deadline
+            if deadline is not None:
+                self.deadline_heap.append((deadline, banned_user))
+        heapq.heapify(self.deadline_heap)
+
+    def start(self):
+        with self.ban_lock:
+            self.rearm_timer()
@@ -4,6 +4,7 @@ from vbcbbot.modules import Module
 import logging
 import re
 import sqlite3
+import threading
 import time
 import xml.dom as dom
 
@@ -54,31 +55,15 @@ class Thanks(Module):
 
             logger.debug("{0} thanks {1}".format(message.user_name, nickname))
 
-            cursor = self.database.cursor()
-            cursor.execute(
-                "INSERT OR IGNORE INTO thanks (thanker, thankee_folded, thank_count) "
-                "VALUES (?, ?, 0)",
-                (message.user_name, lower_nickname)
-            )
-            cursor.execute(
-                "UPDATE thanks SET thank_count=thank_count+1 WHERE thanker=? AND thankee_folded=?",
-                (message.user_name, lower_nickname)
-            )
-            self.database.commit()
-
-            cursor.execute(
-                "SELECT SUM(thank_count) FROM thanks WHERE thankee_folded=?",
-                (lower_nickname,)
-            )
-            for row in cursor:
-                self.connector.send_message(
-                    "[noparse]{0}[/noparse]: Alright! By the way, [noparse]{1}[/noparse] has been thanked {2} until "
-                    "now.".format(
-                        message.user_name, user_info[1],
-                        "once" if row[0] == 1 else "{0} times".format(row[0])
-                    )
+            thank_total = self.record_thanks(message.user_name, lower_nickname, user_info[1])
+            self.update_leaderboard(lower_nickname, user_info[1], thank_total)
+            self.connector.send_message(
+                "[noparse]{0}[/noparse]: Alright! By the way, [noparse]{1}[/noparse] has been thanked {2} until "
+                "now.".format(
+                    message.user_name, user_info[1],
+                    "once" if thank_total == 1 else "{0} times".format(thank_total)
                 )
-                return
+            )
 
         elif body.startswith("!thanked "):
             nickname = body[len("!thanked "):].strip()
@@ -93,35 +78,35 @@ class Thanks(Module):
                 self.connector.send_message("I don't know '[noparse]{0}[/noparse]'!".format(nickname))
                 return
 
-            cursor = self.database.cursor()
-            cursor.execute(
-                "SELECT COALESCE(SUM(thank_count), 0) FROM thanks WHERE thankee_folded=?",
-                (lower_nickname,)
-            )
+            with self.database_lock:
+                cursor = self.database.cursor()
+                cursor.execute(
+                    "SELECT thank_total FROM thankee_totals WHERE thankee_folded=?",
+                    (lower_nickname,)
+                )
+                row = cursor.fetchone()
+            thank_total = row[0] if row is not None else 0
 
-            count_phrase = None
             show_stats = True
-            for row in cursor:
-                if row[0] == 0:
-                    count_phrase = "not been thanked"
-                    show_stats = False
-                elif row[0] == 1:
-                    count_phrase = "been thanked once"
-                else:
-                    count_phrase = "been thanked {0} times".format(row[0])
-
-            if count_phrase is None:
-                return
+            if thank_total == 0:
+                count_phrase = "not been thanked"
+                show_stats = False
+            elif thank_total == 1:
+                count_phrase = "been thanked once"
+            else:
+                count_phrase = "been thanked {0} times".format(thank_total)
 
             # fetch stats
             stat_string = ""
             if show_stats:
-                cursor.execute(
-                    "SELECT thanker, thank_count FROM thanks WHERE thankee_folded=? ORDER BY thank_count DESC LIMIT ?",
-                    (lower_nickname, self.most_grateful_count)
-                )
+                with self.database_lock:
+                    cursor.execute(
+                        "SELECT thanker, thank_count FROM thanks WHERE thankee_folded=? ORDER BY thank_count DESC LIMIT ?",
+                        (lower_nickname, self.most_grateful_count)
+                    )
+                    rows = cursor.fetchall()
                 grateful_counts = []
-                for row in cursor:
+                for row in rows:
                     grateful_counts.append("[noparse]{0}[/noparse]: {1}\u00D7".format(row[0], row[1]))
 
                 # mention that the list is truncated if there might be more than self.most_grateful_count
@@ -138,23 +123,11 @@ class Thanks(Module):
             )
 
         elif body == "!topthanked":
-            cursor = self.database.cursor()
-            cursor.execute(
-                "SELECT thankee_folded, SUM(thank_count) AS thank_sum FROM thanks GROUP BY thankee_folded "
-                "ORDER BY thank_sum DESC LIMIT ?",
-                (self.most_thanked_count,)
-            )
-
             pieces = []
-            for row in cursor:
-                actual_username = row[0]
-                try:
-                    user_info = self.connector.get_user_id_and_nickname_for_uncased_name(row[0])
-                    if user_info is not None:
-                        actual_username = user_info[1]
-                except chatbox_connector.TransferError:
-                    pass
-                pieces.append("{0}: {1}".format(actual_username, row[1]))
+            for (thankee_folded, display_name, thank_total) in self.leaderboard:
+                if display_name is None:
+                    display_name = self.resolve_display_name(thankee_folded)
+                pieces.append("{0}: {1}".format(display_name, thank_total))
 
             self.connector.send_message(
                 "[noparse]{0}[/noparse]: {1}.".format(
@@ -162,6 +135,107 @@ class Thanks(Module):
                 )
             )
 
+    def record_thanks(self, thanker, thankee_folded, thankee_display_name):
+        """
+        Record that the thanker has thanked the thankee once more.
+        :return: The new total number of thanks received by the thankee.
+        :rtype: int
+        """
+        with self.database_lock:
+            cursor = self.database.cursor()
+            cursor.execute(
+                "INSERT INTO thanks (thanker, thankee_folded, thank_count) VALUES (?, ?, 1) "
+                "ON CONFLICT (thanker, thankee_folded) DO UPDATE SET thank_count=thank_count+1",
+                (thanker, thankee_folded)
+            )
+            cursor.execute(
+                "INSERT INTO thankee_totals (thankee_folded, display_name, thank_total) VALUES (?, ?, 1) "
+                "ON CONFLICT (thankee_folded) DO UPDATE SET thank_total=thank_total+1, display_name=excluded.display_name "
+                "RETURNING thank_total",
+                (thankee_folded, thankee_display_name)
+            )
+            thank_total = cursor.fetchone()[0]
+            cursor.close()
+            self.schedule_commit()
+        return thank_total
+
+    def schedule_commit(self):
+        """
+        Commit the current transaction, either immediately or (if a commit delay is configured)
+        together with any other changes made within the delay. Must be called with database_lock
+        held.
+        """
+        if self.commit_delay <= 0:
+            self.database.commit()
+            return
+
+        # coalesced: the commit already scheduled covers these changes too
+        try:
+            self.scheduler.call_later(self.commit_delay, self.commit_now, key=(self, "commit"))
+        except RuntimeError:
+            # nothing would commit them (e.g. while shutting down); better not to delay them at all
+            logger.warning("cannot schedule the commit; committing immediately")
+            self.database.commit()
+
+    def commit_now(self):
+        """Commit any pending changes to the database."""
+        with self.database_lock:
+            self.scheduler.cancel_key((self, "commit"))
+            self.database.commit()
+
+    def stop(self):
+        # the runner calls this at exit, so changes within the commit delay aren't lost
+        self.commit_now()
+
+    def update_leaderboard(self, thankee_folded, display_name, thank_total):
+        """
+        Update the cached leaderboard with a thankee's new total. Totals only ever grow, so the
+        leaderboard can be maintained incrementally.
+        """
+        entries = [entry for entry in self.leaderboard if entry[0] != thankee_folded]
+        entries.append((thankee_folded, display_name, thank_total))
+        entries.sort(key=lambda entry: -entry[2])
+        self.leaderboard = entries[:self.most_thanked_count]
+
+    def resolve_display_name(self, thankee_folded):
+        """
+        Look up the proper nickname of a thankee whose display name hasn't been stored yet (e.g.
+        because their total was backfilled from an older database) and remember it.
+        :rtype: str
+        """
+        display_name = thankee_folded
+        try:
+            user_info = self.connector.get_user_id_and_nickname_for_uncased_name(thankee_folded)
+            if user_info is None:
+                return display_name
+            display_name = user_info[1]
+        except chatbox_connector.TransferError:
+            return display_name
+
+        with self.database_lock:
+            cursor = self.database.cursor()
+            cursor.execute(
+                "UPDATE thankee_totals SET display_name=? WHERE thankee_folded=?",
+                (display_name, thankee_folded)
+            )
+            self.schedule_commit()
+
+        self.leaderboard = [
+            (tf, display_name if tf == thankee_folded else dn, tt)
+            for (tf, dn, tt) in self.leaderboard
+        ]
+        return display_name
+
+    def load_leaderboard(self):
+        """Load the leaderboard from the running totals."""
+        cursor = self.database.cursor()
+        cursor.execute(
+            "SELECT thankee_folded, display_name, thank_total FROM thankee_totals "
+            "ORDER BY thank_total DESC LIMIT ?",
+            (self.most_thanked_count,)
+        )
+        self.leaderboard = [(row[0], row[1], row[2]) for row in cursor]
+
     def __init__(self, connector, config_section):
         """
         Create a new messaging responder.
@@ -191,6 +265,13 @@ class Thanks(Module):
         if "most thanked count" in config_section:
             self.most_thanked_count = int(config_section["most thanked count"])
 
+        # seconds during which commits are grouped; 0 commits every thank immediately
+        self.commit_delay = 0.0
+        if "commit delay" in config_section:
+            self.commit_delay = float(config_section["commit delay"])
+
+        self.database_lock = threading.Lock()
+
         cursor = self.database.cursor()
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS thanks (
@@ -200,5 +281,28 @@ class Thanks(Module):
             PRIMARY KEY (thanker, thankee_folded)
         )
         """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS thankee_totals (
+            thankee_folded TEXT NOT NULL,
+            display_name TEXT NULL,
+            thank_total INT NOT NULL,
+            PRIMARY KEY (thankee_folded)
+        )
+        """)
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_thanks_thankee ON thanks (thankee_folded)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_thankee_totals_total ON thankee_totals (thank_total)")
         self.database.commit()
+
+        # backfill the running totals from older databases
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM thankee_totals)")
+        have_totals = cursor.fetchone()[0]
+        if not have_totals:
+            cursor.execute("""
+            INSERT INTO thankee_totals (thankee_folded, display_name, thank_total)
+            SELECT thankee_folded, NULL, SUM(thank_count) FROM thanks GROUP BY thankee_folded
+            """)
+            self.database.commit()
+
+        self.leaderboard = []
+        """:type: list[(str, str|None, int)]"""
+        self.load_leaderboard()
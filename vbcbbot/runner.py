@@ -4,6 +4,7 @@ from vbcbbot.html_decompiler import HtmlDecompiler
 import configparser
 import importlib
 import logging
+import signal
 import sys
 
 __author__ = 'ondra'
@@ -11,6 +12,36 @@ __author__ = 'ondra'
 logger = logging.getLogger("vbcbbot.runner")
 
 
+def stop_modules(modules):
+    """Stop the given modules, e.g. to make them write out pending changes when the bot exits."""
+    for module in modules:
+        try:
+            module.stop()
+        except:
+            logger.exception("stopping {0}".format(type(module).__name__))
+
+
+def exit_on_signal(signal_number, frame):
+    sys.exit(0)
+
+
+def wait_until_stopped(conn, modules):
+    """
+    Keep the main thread busy until the bot is told to stop (SIGTERM or Ctrl+C), then stop reading
+    and give the modules a chance to clean up. The main thread must not finish while the bot is
+    running: once it does, the interpreter starts shutting down and the thread pools
+    (concurrent.futures) used by the modules refuse any further work.
+    """
+    try:
+        conn.reading_thread.join()
+    except (SystemExit, KeyboardInterrupt):
+        logger.info("stopping")
+
+    conn.stop()
+    stop_modules(modules)
+    conn.reading_thread.join()
+
+
 def run():
     # turn on logging
     root_logger = logging.getLogger()
@@ -86,10 +117,15 @@ def run():
 
             loaded_modules.add(instance)
 
+        # raises SystemExit in the main thread, which wait_until_stopped handles
+        signal.signal(signal.SIGTERM, exit_on_signal)
+
         conn.start()
     except:
         logger.exception("runner")
         raise
 
+    wait_until_stopped(conn, loaded_modules)
+
 if __name__ == '__main__':
     run()
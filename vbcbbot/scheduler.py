@@ -0,0 +1,215 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+__author__ = 'ondra'
+
+logger = logging.getLogger("vbcbbot.scheduler")
+
+
+class ScheduledAction:
+    """An action registered with a Scheduler."""
+
+    def __init__(self, scheduler, due, callback, key, blocking=False):
+        """
+        :param due: When the action is due, as a time.monotonic() value.
+        :param key: The key under which the action is registered, or None.
+        :param blocking: Whether the action may block (e.g. on network I/O), in which case it is run
+        on a worker thread instead of the scheduler thread.
+        """
+        self.scheduler = scheduler
+        self.due = due
+        self.callback = callback
+        self.key = key
+        self.blocking = blocking
+        self.cancelled = False
+
+    def cancel(self):
+        """Make sure the action doesn't run (if it hasn't started already)."""
+        self.scheduler.cancel(self)
+
+    @property
+    def remaining(self):
+        """The number of seconds until the action is due."""
+        return max(self.due - time.monotonic(), 0)
+
+
+class Scheduler:
+    """
+    Runs delayed actions on a single background thread, which only wakes up when an action is
+    due. Actions run one after another on that thread, so they should not block for long; actions
+    that may (such as sending a message to the chatbox) are registered as blocking and run on a
+    small pool of worker threads instead, so that they cannot hold up other modules' timers.
+    """
+
+    def __init__(self, name="vbcbbot scheduler", blocking_workers=4):
+        self.name = name
+        self.heap = []
+        """:type: list[(float, int, ScheduledAction)]"""
+        self.sequence = itertools.count()
+        self.keys_to_actions = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stop_now = False
+
+        # blocking actions are handed to the workers through this queue; None makes a worker finish
+        self.blocking_queue = queue.Queue()
+        self.workers = []
+        for i in range(blocking_workers):
+            worker = threading.Thread(None, self.run_worker, "{0} worker {1}".format(name, i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def call_later(self, delay, callback, key=None, blocking=False):
+        """
+        Run the callback after the given number of seconds.
+        :param key: If not None and an action with the same key is already pending, no new action is
+        registered; the pending one is returned instead. This coalesces bursts of events into one
+        action.
+        :param blocking: Whether the callback may block for a while; see ScheduledAction.
+        :raises RuntimeError: If the scheduler has been shut down.
+        :rtype: ScheduledAction
+        """
+        with self.condition:
+            if self.stop_now:
+                raise RuntimeError("the scheduler has been shut down")
+
+            if key is not None:
+                pending_action = self.keys_to_actions.get(key, None)
+                if pending_action is not None:
+                    return pending_action
+
+            action = ScheduledAction(self, time.monotonic() + max(delay, 0), callback, key, blocking)
+            heapq.heappush(self.heap, (action.due, next(self.sequence), action))
+            if key is not None:
+                self.keys_to_actions[key] = action
+
+            if self.thread is None:
+                self.thread = threading.Thread(None, self.run, self.name, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return action
+
+    def call_at(self, when, callback, key=None, blocking=False):
+        """
+        Run the callback at the given time (a time.time() value). See call_later.
+        :rtype: ScheduledAction
+        """
+        return self.call_later(when - time.time(), callback, key, blocking)
+
+    def debounce(self, key, delay, callback, blocking=False):
+        """
+        Run the callback once the given number of seconds have passed without the same key being
+        debounced again, replacing any pending action with this key.
+        :rtype: ScheduledAction
+        """
+        with self.condition:
+            self.cancel_key(key)
+            return self.call_later(delay, callback, key, blocking)
+
+    def cancel(self, action):
+        """Cancel a pending action."""
+        with self.condition:
+            action.cancelled = True
+            if action.key is not None and self.keys_to_actions.get(action.key, None) is action:
+                del self.keys_to_actions[action.key]
+            # the thread discards it once it reaches the top of the heap
+            self.condition.notify()
+
+    def cancel_key(self, key):
+        """Cancel the pending action with the given key, if any."""
+        with self.condition:
+            pending_action = self.keys_to_actions.get(key, None)
+            if pending_action is not None:
+                self.cancel(pending_action)
+
+    def next_due_action(self):
+        """
+        Wait until the next action is due and return it, or return None once shut down.
+        :rtype: ScheduledAction|None
+        """
+        with self.condition:
+            while not self.stop_now:
+                while len(self.heap) > 0 and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+
+                wait_time = self.heap[0][0] - time.monotonic()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+
+                (_, _, action) = heapq.heappop(self.heap)
+                if action.key is not None and self.keys_to_actions.get(action.key, None) is action:
+                    del self.keys_to_actions[action.key]
+                return action
+            return None
+
+    def run(self):
+        while True:
+            action = self.next_due_action()
+            if action is None:
+                return
+            try:
+                if action.blocking:
+                    self.blocking_queue.put(action)
+                else:
+                    self.run_action(action)
+            except:
+                logger.exception("dispatching scheduled action {0}".format(repr(action.callback)))
+
+    def run_worker(self):
+        while True:
+            action = self.blocking_queue.get()
+            if action is None:
+                return
+            if not action.cancelled:
+                self.run_action(action)
+
+    @staticmethod
+    def run_action(action):
+        try:
+            action.callback()
+        except:
+            logger.exception("scheduled action {0}".format(repr(action.callback)))
+
+    def shutdown(self, wait=True):
+        """Cancel all pending actions and stop the thread."""
+        with self.condition:
+            self.stop_now = True
+            for (_, _, action) in self.heap:
+                action.cancelled = True
+            self.heap = []
+            self.keys_to_actions = {}
+            self.condition.notify()
+            thread = self.thread
+        for _ in self.workers:
+            self.blocking_queue.put(None)
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if wait:
+            for worker in self.workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+
+default_scheduler_instance = None
+default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    Return the scheduler shared by all modules.
+    :rtype: Scheduler
+    """
+    global default_scheduler_instance
+    with default_scheduler_lock:
+        if default_scheduler_instance is None:
+            default_scheduler_instance = Scheduler()
+        return default_scheduler_instance
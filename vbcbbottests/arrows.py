@@ -0,0 +1,107 @@
+import vbcbbot.arrows as a
+
+import random
+import re
+import time
+import unittest
+
+__author__ = 'ondra'
+
+# the backtracking-prone expression the tokenizer replaces; used as a reference on short inputs
+reference_arrow_re_string = "((?:[-=~>]*[>{sra}]+[-=~>]*)+)".format(sra=a.special_right_arrows)
+reference_waste_bin_re = re.compile(
+    "^(.+?)" + reference_arrow_re_string + "(.*[tT][oO][nN][nN][eE].*)$"
+)
+
+
+def reference_reverse_arrows(text):
+    response = text
+    old_response = None
+    while response != old_response:
+        old_response = response
+        for (right, left) in a.right_arrows_to_left_arrows.items():
+            response = response.replace(right, left)
+    return response
+
+
+def reference_split(text):
+    match = reference_waste_bin_re.match(text)
+    if match is None:
+        return None
+    return match.group(1), match.group(2), match.group(3)
+
+
+def best_time(func, arg, repetitions=3):
+    best = None
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class TestSplitWasteBinToss(unittest.TestCase):
+    def test_simple(self):
+        self.assertEqual(
+            a.split_waste_bin_toss("Python 2 -> Restm\u00fclltonne"),
+            ("Python 2 ", "->", " Restm\u00fclltonne")
+        )
+
+    def test_special_arrow(self):
+        self.assertEqual(
+            a.split_waste_bin_toss("PHP \u21d2\u21d2 Biotonne"),
+            ("PHP ", "\u21d2\u21d2", " Biotonne")
+        )
+
+    def test_no_bin(self):
+        self.assertIsNone(a.split_waste_bin_toss("Python 2 -> Museum"))
+
+    def test_no_arrow(self):
+        self.assertIsNone(a.split_waste_bin_toss("Python 2 in die Tonne"))
+
+    def test_multiline(self):
+        self.assertIsNone(a.split_waste_bin_toss("Python 2\n-> Tonne"))
+
+    def test_fuzz_against_reference(self):
+        rng = random.Random(4848)
+        alphabet = "ab -=~>\u2192\u21d2tonTONE\n"
+        for _ in range(20000):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 14)))
+            if rng.random() < 0.5:
+                text += "tonne"
+            self.assertEqual(a.split_waste_bin_toss(text), reference_split(text), repr(text))
+
+    def test_linear_worst_case(self):
+        # long runs of shafts without heads make the reference expression backtrack quadratically
+        for pattern in ("-", "->", "-=~", "a-"):
+            short_text = pattern * 500 + " Tonne"
+            long_text = pattern * 4000 + " Tonne"
+            short_time = best_time(a.split_waste_bin_toss, short_text)
+            long_time = best_time(a.split_waste_bin_toss, long_text)
+            # 8 times the input; allow generous noise, but nowhere near the quadratic 64
+            self.assertLess(long_time, max(short_time, 1e-4) * 24, repr(pattern))
+
+    def test_length_guard(self):
+        self.assertIsNone(a.split_waste_bin_toss("x" + "-" * a.maximum_scan_length + "> Tonne"))
+
+
+class TestReverseArrows(unittest.TestCase):
+    def test_digraphs(self):
+        self.assertEqual(a.reverse_arrows("a -> b => Tonne"), "a <- b <= Tonne")
+
+    def test_special_arrows(self):
+        self.assertEqual(a.reverse_arrows("a \u2192 Tonne \u21d2"), "a \u2190 Tonne \u21d0")
+
+    def test_fuzz_against_reference(self):
+        rng = random.Random(48)
+        alphabet = "a -=<>~" + a.special_right_arrows[:10]
+        for _ in range(5000):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+            self.assertEqual(a.reverse_arrows(text), reference_reverse_arrows(text), repr(text))
+
+    def test_contains_right_arrow(self):
+        self.assertTrue(a.contains_right_arrow("x => Tonne"))
+        self.assertTrue(a.contains_right_arrow("x \u27a1 Tonne"))
+        self.assertFalse(a.contains_right_arrow("x > Tonne"))
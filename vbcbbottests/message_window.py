@@ -0,0 +1,46 @@
+from vbcbbot.message_window import MessageWindow
+import unittest
+
+__author__ = 'ondra'
+
+
+class TestMessageWindow(unittest.TestCase):
+    def setUp(self):
+        self.window = MessageWindow(3)
+
+    def test_order(self):
+        for i in range(1, 4):
+            self.assertIsNone(self.window.add(i, "m{0}".format(i)))
+        self.assertEqual(list(self.window.oldest_first()), ["m1", "m2", "m3"])
+        self.assertEqual(list(self.window.newest_first()), ["m3", "m2", "m1"])
+        self.assertEqual(list(self.window.keys_newest_first()), [3, 2, 1])
+
+    def test_evict(self):
+        for i in range(1, 6):
+            self.window.add(i, "m{0}".format(i))
+        self.assertEqual(self.window.add(6, "m6"), (3, "m3"))
+        self.assertEqual(len(self.window), 3)
+        self.assertEqual(list(self.window.newest_first()), ["m6", "m5", "m4"])
+        self.assertNotIn(3, self.window)
+        self.assertIsNone(self.window.get(3))
+
+    def test_replace(self):
+        for i in range(1, 5):
+            self.window.add(i, "m{0}".format(i))
+        self.assertTrue(self.window.replace(3, "edited"))
+        self.assertFalse(self.window.replace(1, "gone"))
+        self.assertEqual(self.window.get(3), "edited")
+        self.assertEqual(list(self.window.oldest_first()), ["m2", "edited", "m4"])
+
+    def test_add_existing(self):
+        self.window.add(1, "m1")
+        self.window.add(2, "m2")
+        self.assertIsNone(self.window.add(1, "again"))
+        self.assertEqual(list(self.window.oldest_first()), ["again", "m2"])
+
+    def test_clear(self):
+        self.window.add(1, "m1")
+        self.window.clear()
+        self.assertEqual(len(self.window), 0)
+        self.window.add(2, "m2")
+        self.assertEqual(list(self.window.newest_first()), ["m2"])
@@ -0,0 +1,108 @@
+import vbcbbot.modules.bin_admin as ba
+import time
+import unittest
+import unittest.mock as mock
+
+__author__ = 'ondra'
+
+
+class FakeConnector:
+    def __init__(self):
+        self.username = "Bot"
+        self.sent = []
+
+    def subscribe_to_message_updates(self, subscriber):
+        pass
+
+    def send_message(self, message, **kwargs):
+        self.sent.append(message)
+
+
+class FakeMessage:
+    def __init__(self, user_name, body):
+        self.user_name = user_name
+        self.body = body
+
+    def decompiled_body(self):
+        return self.body
+
+
+class TestBinAdmin(unittest.TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        self.module = ba.BinAdmin(self.connector, {"page size": "3"})
+
+    def tearDown(self):
+        self.module.database.close()
+
+    def toss(self, item, when, bin_name="Restm\u00fclltonne"):
+        with mock.patch("time.localtime", return_value=time.localtime(when)):
+            self.module.message_received(FakeMessage("User", "{0} -> {1}".format(item, bin_name)))
+
+    def say(self, body, user_name="User"):
+        self.module.message_received(FakeMessage(user_name, body))
+        return self.connector.sent[-1]
+
+    def stored_count(self, bin_name="restm\u00fclltonne"):
+        actual = self.module.database.execute(
+            "SELECT COUNT(*) FROM bin_items WHERE bin=?", (bin_name,)
+        ).fetchone()[0]
+        self.assertEqual(self.module.bin_item_count(bin_name), actual)
+        return actual
+
+    def test_paging_across_equal_timestamps(self):
+        for item in ("a", "b", "c", "d", "e"):
+            self.toss(item, 1400000000)
+        self.toss("f", 1400000100)
+        self.toss("g", 1399999900)
+
+        self.assertEqual(self.say("!tonneninhalt restm\u00fclltonne"), "In dieser Tonne befinden sich: f, e, d (noch 4 \u2013 !weiter)")
+        self.assertEqual(self.say("!weiter"), "Au\u00dferdem befindet sich in dieser Tonne: c, b, a (noch 1 \u2013 !weiter)")
+        self.assertEqual(self.say("!weiter"), "Au\u00dferdem befindet sich in dieser Tonne: g")
+
+        # the listing is complete; nothing to continue
+        count = len(self.connector.sent)
+        self.module.message_received(FakeMessage("User", "!weiter"))
+        self.assertEqual(len(self.connector.sent), count)
+
+    def test_continue_after_changes(self):
+        for (i, item) in enumerate(("a", "b", "c", "d", "e")):
+            self.toss(item, 1400000000 + i)
+        self.assertEqual(self.say("!tonneninhalt restm\u00fclltonne"), "In dieser Tonne befinden sich: e, d, c (noch 2 \u2013 !weiter)")
+
+        # newer items don't show up in (or get counted for) the rest of the listing
+        self.toss("x", 1400000100)
+        self.toss("y", 1400000101)
+        self.assertEqual(self.say("!weiter"), "Au\u00dferdem befindet sich in dieser Tonne: b, a")
+
+    def test_continue_after_emptying(self):
+        for (i, item) in enumerate(("a", "b", "c", "d")):
+            self.toss(item, 1400000000 + i)
+        self.say("!tonneninhalt restm\u00fclltonne")
+        self.say("!tonneninhalt restm\u00fclltonne", user_name="Other")
+        self.assertEqual(self.say("!entleere restm\u00fclltonne"), "Tonne entleert.")
+
+        count = len(self.connector.sent)
+        self.module.message_received(FakeMessage("Other", "!weiter"))
+        self.assertEqual(len(self.connector.sent), count)
+
+    def test_counts_through_emptying(self):
+        for (i, item) in enumerate(("a", "b", "c")):
+            self.toss(item, 1400000000 + i)
+        # the same item again doesn't count twice
+        self.toss("a", 1400000010)
+        self.toss("z", 1400000000, bin_name="Biotonne")
+        self.assertEqual(self.stored_count(), 3)
+
+        self.say("!entleere restm\u00fclltonne")
+        self.assertEqual(self.stored_count(), 0)
+        self.assertEqual(self.stored_count("biotonne"), 1)
+        self.assertEqual(self.say("!tonneninhalt restm\u00fclltonne"), "In dieser Tonne befindet sich nichts.")
+
+        self.toss("a", 1400000020)
+        self.assertEqual(self.stored_count(), 1)
+        self.assertEqual(self.say("!tonneninhalt restm\u00fclltonne"), "In dieser Tonne befindet sich: a")
+
+        self.say("!m\u00fcllabfuhr")
+        self.assertEqual(self.stored_count(), 0)
+        self.assertEqual(self.stored_count("biotonne"), 0)
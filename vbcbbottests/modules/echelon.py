@@ -0,0 +1,195 @@
+import vbcbbot.modules.echelon as e
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock as mock
+
+__author__ = 'ondra'
+
+
+def old_trigger_ids(triggers, body):
+    ret = []
+    for trigger in triggers:
+        for _ in trigger.pattern.finditer(body):
+            ret.append(trigger.trigger_id)
+    return ret
+
+
+class TestTriggerMatcher(unittest.TestCase):
+    def assert_same_as_separately(self, pattern_strings, body, expected):
+        triggers = [e.Trigger(i + 1, "target", ps) for (i, ps) in enumerate(pattern_strings)]
+        found = e.TriggerMatcher(triggers).find_trigger_ids(body)
+        self.assertEqual(found, expected)
+        self.assertEqual(found, old_trigger_ids(triggers, body))
+
+    def test_overlapping_at_same_position(self):
+        self.assert_same_as_separately(["foo", "fo+"], "foo foo", [1, 1, 2, 2])
+
+    def test_overlapping_across_positions(self):
+        self.assert_same_as_separately(["hello", "lo w"], "hello world", [1, 2])
+
+    def test_no_match(self):
+        self.assert_same_as_separately(["foo", "bar"], "nothing to see here", [])
+
+    def test_standalone(self):
+        self.assert_same_as_separately(["(a)\\1", "b"], "aa b aa", [1, 1, 2])
+
+
+class FakeConnector:
+    def __init__(self):
+        self.sent = []
+
+    def subscribe_to_message_updates(self, subscriber):
+        pass
+
+    def send_message(self, message, **kwargs):
+        self.sent.append(message)
+
+
+class FakeMessage:
+    def __init__(self, message_id, user_name, body, timestamp):
+        self.id = message_id
+        self.user_name = user_name
+        self.body = body
+        self.timestamp = timestamp
+
+    def decompiled_body(self):
+        return self.body
+
+
+class EchelonTestCase(unittest.TestCase):
+    def setUp(self):
+        (handle, self.database_path) = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.modules = []
+
+    def tearDown(self):
+        for module in self.modules:
+            module.database.close()
+        os.remove(self.database_path)
+
+    def make_echelon(self, **config):
+        config_section = {"database": self.database_path}
+        config_section.update(config)
+        module = e.Echelon(FakeConnector(), config_section)
+        self.modules.append(module)
+        return module
+
+    def bucket_rows(self, module):
+        return module.database.execute(
+            "SELECT target_name_lower, bucket_start, incident_count FROM incident_counts_by_bucket "
+            "ORDER BY target_name_lower, bucket_start"
+        ).fetchall()
+
+
+class TestIncidentBuckets(EchelonTestCase):
+    def test_backfill_when_turned_on(self):
+        now = int(time.time())
+        module = self.make_echelon()
+        module.add_trigger("Target", "bad", "Boss")
+        module.process_message(FakeMessage(1, "Target", "bad", now - 10 * 3600))
+        module.process_message(FakeMessage(2, "Target", "bad bad", now))
+        self.assertEqual(self.bucket_rows(module), [])
+
+        module = self.make_echelon(**{"bucket seconds": "3600", "rate buckets": "5"})
+        self.assertEqual(self.bucket_rows(module), [("target", e.bucket_start(now, 3600), 2)])
+        self.assertEqual(module.recent_incident_count("target"), 2)
+
+    def test_rebuilt_when_bucket_size_changes(self):
+        now = int(time.time())
+        module = self.make_echelon(**{"bucket seconds": "3600"})
+        module.add_trigger("Target", "bad", "Boss")
+        module.process_message(FakeMessage(1, "Target", "bad", now))
+
+        module = self.make_echelon(**{"bucket seconds": "60"})
+        self.assertEqual(self.bucket_rows(module), [("target", e.bucket_start(now, 60), 1)])
+
+    def test_pruned(self):
+        now = int(time.time())
+        module = self.make_echelon(**{"bucket seconds": "3600", "rate buckets": "2"})
+        module.add_trigger("Target", "bad", "Boss")
+        with mock.patch("time.time", return_value=now - 5 * 3600):
+            module.process_message(FakeMessage(1, "Target", "bad", now - 5 * 3600))
+        self.assertEqual(len(self.bucket_rows(module)), 1)
+
+        # five hours later, the old bucket has left the window
+        module.process_message(FakeMessage(2, "Target", "bad", now))
+        self.assertEqual(self.bucket_rows(module), [("target", e.bucket_start(now, 3600), 1)])
+        self.assertEqual(module.recent_incident_count("target"), 1)
+
+
+class TestTriggerChanges(EchelonTestCase):
+    def trigger_ids(self, module, user_name_lower, body):
+        # the same lookup as process_message
+        matcher = module.lowercase_user_names_to_matchers.get(user_name_lower, None)
+        if matcher is None:
+            return []
+        return matcher.find_trigger_ids(body)
+
+    def cached_pattern_strings(self, module):
+        return set(module.pattern_cache.pattern_strings_to_patterns.keys())
+
+    def test_add_update_remove(self):
+        module = self.make_echelon()
+        first = module.add_trigger("Target", "foo", "Boss")
+        second = module.add_trigger("Target", "bar", "Boss")
+        self.assertEqual(self.trigger_ids(module, "target", "foo bar"), [first.trigger_id, second.trigger_id])
+
+        self.assertTrue(module.update_trigger(second.trigger_id, "baz"))
+        self.assertEqual(self.trigger_ids(module, "target", "foo bar baz"), [first.trigger_id, second.trigger_id])
+        self.assertEqual(module.database.execute(
+            "SELECT regex FROM triggers WHERE trigger_id=?", (second.trigger_id,)
+        ).fetchone()[0], "baz")
+
+        self.assertTrue(module.remove_trigger(first.trigger_id))
+        self.assertEqual(self.trigger_ids(module, "target", "foo baz"), [second.trigger_id])
+        self.assertTrue(module.remove_trigger(second.trigger_id))
+        self.assertNotIn("target", module.lowercase_user_names_to_matchers)
+
+        self.assertFalse(module.remove_trigger(first.trigger_id))
+        self.assertFalse(module.update_trigger(first.trigger_id, "foo"))
+
+    def test_unused_patterns_evicted(self):
+        module = self.make_echelon()
+        first = module.add_trigger("Target", "foo", "Boss")
+        second = module.add_trigger("Other", "foo", "Boss")
+        third = module.add_trigger("Target", "bar", "Boss")
+        self.assertEqual(self.cached_pattern_strings(module), {"foo", "bar"})
+
+        module.update_trigger(third.trigger_id, "baz")
+        self.assertEqual(self.cached_pattern_strings(module), {"foo", "baz"})
+
+        # still used by the other user's trigger
+        module.remove_trigger(first.trigger_id)
+        self.assertEqual(self.cached_pattern_strings(module), {"foo", "baz"})
+        module.remove_trigger(second.trigger_id)
+        self.assertEqual(self.cached_pattern_strings(module), {"baz"})
+
+    def test_concurrent_matching_sees_whole_sets(self):
+        module = self.make_echelon()
+        first = module.add_trigger("Target", "foo", "Boss")
+        old_set = [first.trigger_id]
+        new_sets = []
+        seen = []
+        stop = threading.Event()
+
+        def match_continuously():
+            while not stop.is_set():
+                seen.append(self.trigger_ids(module, "target", "foo bar"))
+
+        reader = threading.Thread(target=match_continuously)
+        reader.start()
+        try:
+            for _ in range(50):
+                second = module.add_trigger("Target", "bar", "Boss")
+                new_sets.append([first.trigger_id, second.trigger_id])
+                module.remove_trigger(second.trigger_id)
+        finally:
+            stop.set()
+            reader.join()
+
+        self.assertGreater(len(seen), 0)
+        for trigger_ids in seen:
+            self.assertTrue(trigger_ids == old_set or trigger_ids in new_sets, trigger_ids)
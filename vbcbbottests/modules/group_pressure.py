@@ -0,0 +1,92 @@
+import vbcbbot.modules.group_pressure as gp
+import random
+import unittest
+
+__author__ = 'ondra'
+
+
+def reference_senders(backlog, own_name, reset_marks):
+    message_senders = {}
+    for (message_id, sender, body) in backlog:
+        if sender == own_name:
+            message_senders[body] = set()
+        elif message_id > reset_marks.get(body, -1):
+            message_senders.setdefault(body, set()).add(sender)
+    return message_senders
+
+
+class TestSlidingWindow(unittest.TestCase):
+    def test_trigger_and_reset(self):
+        window = gp.SlidingWindow(5, 2, "Bot")
+        window.add(1, "a", "hi")
+        self.assertEqual(window.pressing_bodies, {})
+        window.add(2, "a", "hi")
+        self.assertEqual(window.pressing_bodies, {})
+        window.add(3, "b", "hi")
+        self.assertEqual(list(window.pressing_bodies), ["hi"])
+        window.reset("hi")
+        self.assertEqual(window.pressing_bodies, {})
+        window.add(4, "c", "hi")
+        self.assertEqual(window.senders("hi"), {"c"})
+
+    def test_eviction(self):
+        window = gp.SlidingWindow(2, 2, "Bot")
+        window.add(1, "a", "hi")
+        window.add(2, "x", "yo")
+        window.add(3, "b", "hi")
+        self.assertEqual(window.senders("hi"), {"b"})
+        self.assertEqual(window.pressing_bodies, {})
+
+    def test_edit(self):
+        window = gp.SlidingWindow(5, 2, "Bot")
+        window.add(1, "a", "hi")
+        window.add(2, "b", "hu")
+        window.edit(2, "hi")
+        self.assertEqual(list(window.pressing_bodies), ["hi"])
+        self.assertEqual(window.senders("hu"), set())
+
+    def test_edit_own_message_keeps_reset(self):
+        window = gp.SlidingWindow(10, 2, "Bot")
+        window.add(1, "Bot", "meh")
+        window.add(2, "a", "hi")
+        window.add(3, "b", "hi")
+        self.assertEqual(list(window.pressing_bodies), ["hi"])
+        window.reset("hi")
+
+        # the edit makes the window recount everything; "hi" must not become pressing again
+        window.edit(1, "whatever")
+        self.assertEqual(window.pressing_bodies, {})
+        self.assertEqual(window.senders("hi"), set())
+        window.add(4, "c", "hi")
+        self.assertEqual(window.senders("hi"), {"c"})
+
+    def test_fuzz_against_reference(self):
+        rng = random.Random(20)
+        senders = ["a", "b", "c", "d", "Bot"]
+        bodies = ["x", "y", "z"]
+        window = gp.SlidingWindow(6, 3, "Bot")
+        backlog = []
+        reset_marks = {}
+        for message_id in range(5000):
+            if backlog and rng.random() < 0.1:
+                body = rng.choice(bodies)
+                reset_marks[body] = backlog[-1][0]
+                window.reset(body)
+            elif backlog and rng.random() < 0.2:
+                index = rng.randrange(len(backlog))
+                (edit_id, sender, _) = backlog[index]
+                body = rng.choice(bodies)
+                backlog[index] = (edit_id, sender, body)
+                window.edit(edit_id, body)
+            else:
+                entry = (message_id, rng.choice(senders), rng.choice(bodies))
+                backlog = (backlog + [entry])[-6:]
+                window.add(*entry)
+
+            expected = reference_senders(backlog, "Bot", reset_marks)
+            for body in bodies:
+                self.assertEqual(window.senders(body), expected.get(body, set()))
+            self.assertEqual(
+                set(window.pressing_bodies),
+                {body for (body, body_senders) in expected.items() if len(body_senders) >= 3}
+            )
@@ -0,0 +1,41 @@
+import vbcbbot.html_decompiler as hd
+import vbcbbot.modules.http_interface as hi
+import unittest
+
+__author__ = 'ondra'
+
+
+class TestEscaping(unittest.TestCase):
+    def test_html(self):
+        self.assertEqual(
+            hi.html_escape("<a href=\"x\">it's</a> & more\n"),
+            "&lt;a href=&quot;x&quot;&gt;it's&lt;/a&gt; &amp; more<br/>\n"
+        )
+
+    def test_html_apostrophes(self):
+        self.assertEqual(hi.html_escape("\"it's\"", escape_quotes=False, escape_apostrophes=True), "\"it&apos;s\"")
+
+    def test_html_keeps_non_ascii(self):
+        self.assertEqual(hi.html_escape("Gr\u00fc\u00dfe \U0001F600"), "Gr\u00fc\u00dfe \U0001F600")
+
+    def test_js(self):
+        self.assertEqual(
+            hi.js_escape_string("a\\b\"c'd", escape_quotes=False, escape_apostrophes=True),
+            "a\\\\b\"c\\'d"
+        )
+
+
+class TestDomToHtml(unittest.TestCase):
+    def test_nested(self):
+        dom = [
+            hd.Text("x < y "),
+            hd.Element("url", [hd.Element("b", [hd.Text("link")])], "page?a=1&b=2"),
+            hd.Element("strike", [hd.Element("h", [hd.Text("\u00e4")])]),
+            hd.SmileyText(":)", "smile.png"),
+        ]
+        self.assertEqual(
+            hi.dom_to_html(dom, "http://example.com/"),
+            'x &lt; y <a class="url" href="http://example.com/page?a=1&amp;b=2"><b>link</b></a>'
+            '<span class="strike" style="text-decoration:line-through"><sup>\u00e4</sup></span>'
+            '<img class="smiley" src="http://example.com/smile.png" alt=":)" title=":)" />'
+        )
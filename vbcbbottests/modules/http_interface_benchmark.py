@@ -0,0 +1,51 @@
+"""
+Measures how fast HttpInterface renders a full backlog of messages.
+
+Run with: python -m vbcbbottests.modules.http_interface_benchmark
+"""
+from vbcbbot.chatbox_connector import ChatboxMessage
+import vbcbbot.modules.http_interface as hi
+import timeit
+
+__author__ = 'ondra'
+
+base_url = "http://forum.example.com/"
+sample_bodies = [
+    "Gr\u00fc\u00df Gott! Hei\u00dft das &quot;sch\u00f6n&quot; oder &lt;b&gt;nicht&lt;/b&gt;? \U0001F600\U0001F44D",
+    '<b>Wichtig:</b> <a href="showthread.php?t=42&amp;p=7">der Thread</a> <img src="images/smilies/smile.png" />',
+    "<i>\u00c4rger</i> \u00fcber <strike>\u00d6sterreich</strike> <sup>hoch</sup> <sub>tief</sub> \u2014 \u00bbna ja\u00ab",
+    '<font color="red">\U0001F525\U0001F525\U0001F525</font> und <u>mehr</u> Text, der einfach nur l\u00e4nger ist.',
+    "Eine ganz normale Nachricht ohne jegliche Formatierung, aber mit ein paar Umlauten: \u00e4\u00f6\u00fc.",
+]
+
+
+def make_backlog(count=50):
+    """
+    Return the decompiled body DOMs of a backlog of sample messages.
+    :rtype: list[list[vbcbbot.html_decompiler.Node]]
+    """
+    doms = []
+    for i in range(count):
+        message = ChatboxMessage(i, 1, "User{0}".format(i % 7), sample_bodies[i % len(sample_bodies)])
+        doms.append(message.decompiled_body_dom())
+    return doms
+
+
+def render_backlog(doms):
+    """:rtype: bytes"""
+    return "".join(hi.dom_to_html(dom, base_url) for dom in doms).encode("utf-8")
+
+
+def main():
+    doms = make_backlog()
+    repetitions = 200
+    seconds = min(timeit.repeat(lambda: render_backlog(doms), number=repetitions, repeat=5))
+    rendered = render_backlog(doms)
+    print("{0} messages, {1} bytes of UTF-8 HTML".format(len(doms), len(rendered)))
+    print("{0:.3f} ms per backlog, {1:.0f} messages per second".format(
+        seconds / repetitions * 1000, len(doms) * repetitions / seconds
+    ))
+
+
+if __name__ == '__main__':
+    main()
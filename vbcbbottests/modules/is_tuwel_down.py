@@ -0,0 +1,87 @@
+import vbcbbot.modules.is_tuwel_down as itd
+import vbcbbot.scheduler as s
+import threading
+import time
+import unittest
+
+__author__ = 'ondra'
+
+
+class FakeConnector:
+    def __init__(self):
+        self.sent = []
+
+    def subscribe_to_message_updates(self, subscriber):
+        pass
+
+    def send_message(self, message, **kwargs):
+        self.sent.append(message)
+
+
+class FakeMessage:
+    def __init__(self, body):
+        self.user_name = "User"
+        self.body = body
+
+    def decompiled_body(self):
+        return self.body
+
+
+class TestPeriodicRefresh(unittest.TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        self.module = itd.IsTuwelDown(self.connector, {
+            "api url": "http://tuwel.example.com/status",
+            "refresh interval": "0.05",
+            "error retry interval": "0.05",
+            "up messages": "up since {since}",
+            "unknown messages": "unknown",
+        })
+        self.module.scheduler = s.Scheduler()
+        self.fetch_count = 0
+        self.fetch_threads = set()
+        self.fail = False
+        self.module.fetch_status = self.fetch_status
+
+    def tearDown(self):
+        self.module.stop()
+        self.module.scheduler.shutdown()
+
+    def fetch_status(self):
+        self.fetch_count += 1
+        self.fetch_threads.add(threading.current_thread())
+        if self.fail:
+            raise OSError("unreachable")
+        # an unparseable last update makes the module wait for one refresh interval
+        return "0", "1400000000", "?"
+
+    def test_refreshes_in_background(self):
+        self.module.start()
+        time.sleep(0.3)
+        self.assertGreaterEqual(self.fetch_count, 3)
+        self.assertNotIn(threading.current_thread(), self.fetch_threads)
+        self.assertNotIn(self.module.scheduler.thread, self.fetch_threads)
+
+        count = self.fetch_count
+        self.module.process_message(FakeMessage("!istuwelup"))
+        self.assertTrue(self.connector.sent[-1].startswith("up since "))
+        # answered from the snapshot (a background refresh may have happened in the meantime)
+        self.assertLessEqual(self.fetch_count, count + 1)
+
+    def test_stops(self):
+        self.module.start()
+        time.sleep(0.1)
+        self.module.stop()
+        time.sleep(0.1)
+        count = self.fetch_count
+        time.sleep(0.2)
+        self.assertEqual(self.fetch_count, count)
+
+    def test_stale_snapshot_is_unknown(self):
+        self.module.maximum_snapshot_age = 0.1
+        self.module.start()
+        time.sleep(0.1)
+        self.fail = True
+        time.sleep(0.3)
+        self.module.process_message(FakeMessage("!istuwelup"))
+        self.assertEqual(self.connector.sent[-1], "unknown")
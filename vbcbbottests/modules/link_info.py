@@ -0,0 +1,143 @@
+import vbcbbot.modules.link_info as li
+import threading
+import unittest
+
+__author__ = 'ondra'
+
+
+class CountingLookup(li.StaticLookup):
+    def __init__(self, hosts_to_addresses):
+        li.StaticLookup.__init__(self, hosts_to_addresses)
+        self.calls = 0
+
+    def __call__(self, host):
+        self.calls += 1
+        return li.StaticLookup.__call__(self, host)
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.lookup = CountingLookup({
+            "example.com": ["93.184.216.34"],
+            "intranet.example.com": ["93.184.216.35", "192.168.0.1"],
+            "ll.example.com": ["fe80::1"],
+        })
+        self.resolver = li.Resolver(lookup=self.lookup)
+
+    def tearDown(self):
+        self.resolver.shutdown()
+
+    def assert_fetch_error(self, url, message, kind):
+        with self.assertRaises(li.FetchError) as context:
+            self.resolver.vetted_address(url)
+        self.assertEqual(str(context.exception), message)
+        self.assertEqual(context.exception.kind, kind)
+
+    def test_public(self):
+        self.assertEqual(self.resolver.vetted_address("http://example.com/x"), "93.184.216.34")
+
+    def test_any_private_address_blocks(self):
+        self.assert_fetch_error("http://intranet.example.com/", "(I refuse to access local IP addresses)", "blocked")
+
+    def test_link_local(self):
+        self.assert_fetch_error("https://ll.example.com:8443/", "(I refuse to access local IP addresses)", "blocked")
+
+    def test_literal_address(self):
+        self.resolver.lookup = li.getaddrinfo_lookup
+        self.assert_fetch_error("http://127.0.0.1:8080/", "(I refuse to access local IP addresses)", "blocked")
+
+    def test_unknown_host(self):
+        self.assert_fetch_error("http://nonexistent.example.com/", "(cannot resolve)", "error")
+
+    def test_invalid(self):
+        self.assert_fetch_error("http:///path", "(invalid URL)", "blocked")
+
+    def test_cached(self):
+        for _ in range(3):
+            self.resolver.vetted_address("http://example.com/")
+        self.assertEqual(self.lookup.calls, 1)
+        self.assertEqual(self.resolver.timings()["example.com"].cache_hits, 2)
+
+    def test_negative_cached(self):
+        for _ in range(3):
+            with self.assertRaises(li.FetchError):
+                self.resolver.vetted_address("http://nonexistent.example.com/")
+        self.assertEqual(self.lookup.calls, 1)
+
+    def test_slow_lookup(self):
+        finish_lookup = threading.Event()
+
+        def slow_lookup(host):
+            finish_lookup.wait(1)
+            return ["93.184.216.34"]
+
+        resolver = li.Resolver(timeout=0.05, lookup=slow_lookup)
+        try:
+            with self.assertRaises(li.FetchError):
+                resolver.vetted_address("http://slow.example.com/")
+
+            # the lookup goes on in the background; its result is used once it arrives
+            finish_lookup.set()
+            self.assertEqual(resolver.vetted_address("http://slow.example.com/"), "93.184.216.34")
+        finally:
+            resolver.shutdown()
+
+    def test_timings_evicted_with_entries(self):
+        resolver = li.Resolver(max_entries=2, lookup=li.StaticLookup({
+            "a.example.com": ["93.184.216.1"],
+            "b.example.com": ["93.184.216.2"],
+            "c.example.com": ["93.184.216.3"],
+        }))
+        try:
+            for host in ("a", "b", "c"):
+                resolver.vetted_address("http://{0}.example.com/".format(host))
+            self.assertEqual(sorted(resolver.timings().keys()), ["b.example.com", "c.example.com"])
+        finally:
+            resolver.shutdown()
+
+
+def extract_title(document, header_encoding=None, max_bytes=256*1024, chunk_size=7):
+    extractor = li.TitleExtractor(header_encoding, max_bytes)
+    fed = 0
+    for i in range(0, len(document), chunk_size):
+        fed += chunk_size
+        if extractor.feed(document[i:i+chunk_size]):
+            break
+    return extractor.result(), fed
+
+
+class TestTitleExtractor(unittest.TestCase):
+    def test_utf8_without_declaration(self):
+        doc = "<html><head><title>Hell\u00f6 W\u00f6rld</title></head></html>".encode("utf-8")
+        self.assertEqual(extract_title(doc)[0], "Hell\u00f6 W\u00f6rld")
+
+    def test_meta_charset(self):
+        doc = "<html><head><meta charset='iso-8859-1'><title>Gr\u00fc\u00dfe</title>".encode("iso-8859-1")
+        self.assertEqual(extract_title(doc)[0], "Gr\u00fc\u00dfe")
+
+    def test_header_charset_wins(self):
+        doc = "<meta charset='utf-8'><title>\u0160koda</title>".encode("iso-8859-2")
+        self.assertEqual(extract_title(doc, "iso-8859-2")[0], "\u0160koda")
+
+    def test_undeclared_legacy_encoding(self):
+        doc = "<title>Caf\u00e9</title>".encode("windows-1252")
+        self.assertEqual(extract_title(doc)[0], "Caf\u00e9")
+
+    def test_heading(self):
+        self.assertEqual(extract_title(b"<body><h1>Head<b>line</b></h1><p>text</p>")[0], "Headline")
+
+    def test_none(self):
+        self.assertIsNone(extract_title(b"<body><p>no title here</p></body>")[0])
+        self.assertIsNone(extract_title(b"")[0])
+
+    def test_stops_after_title(self):
+        doc = b"<title>Early</title>" + b"<p>filler</p>" * 100000
+        (title, fed) = extract_title(doc, chunk_size=4096)
+        self.assertEqual(title, "Early")
+        self.assertLessEqual(fed, 4096)
+
+    def test_byte_limit(self):
+        doc = b"<p>filler</p>" * 100000 + b"<title>Late</title>"
+        (title, fed) = extract_title(doc, max_bytes=64*1024, chunk_size=4096)
+        self.assertIsNone(title)
+        self.assertLessEqual(fed, 64*1024)
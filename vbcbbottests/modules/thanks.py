@@ -0,0 +1,55 @@
+import vbcbbot.modules.thanks as th
+import vbcbbot.scheduler as s
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+__author__ = 'ondra'
+
+
+class FakeConnector:
+    def subscribe_to_message_updates(self, subscriber):
+        pass
+
+
+class TestDelayedCommit(unittest.TestCase):
+    def setUp(self):
+        (handle, self.database_path) = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.module = th.Thanks(FakeConnector(), {"database": self.database_path, "commit delay": "0.05"})
+        self.module.scheduler = s.Scheduler()
+
+    def tearDown(self):
+        self.module.scheduler.shutdown()
+        self.module.database.close()
+        os.remove(self.database_path)
+
+    def committed_total(self, thankee_folded):
+        """Read the total through a separate connection, which only sees committed changes."""
+        database = sqlite3.connect(self.database_path)
+        try:
+            row = database.execute(
+                "SELECT thank_total FROM thankee_totals WHERE thankee_folded=?", (thankee_folded,)
+            ).fetchone()
+            return row[0] if row is not None else None
+        finally:
+            database.close()
+
+    def test_committed_after_delay(self):
+        self.module.record_thanks("alice", "bob", "Bob")
+        self.module.record_thanks("carol", "bob", "Bob")
+        self.assertIsNone(self.committed_total("bob"))
+        time.sleep(0.2)
+        self.assertEqual(self.committed_total("bob"), 2)
+
+    def test_committed_inline_without_scheduler(self):
+        self.module.scheduler.shutdown()
+        self.module.record_thanks("alice", "bob", "Bob")
+        self.assertEqual(self.committed_total("bob"), 1)
+
+    def test_committed_on_stop(self):
+        self.module.record_thanks("alice", "bob", "Bob")
+        self.module.stop()
+        self.assertEqual(self.committed_total("bob"), 1)
@@ -0,0 +1,105 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+__author__ = 'ondra'
+
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in a separate interpreter, as the runner does: the main thread sets everything up, then hands
+# over to wait_until_stopped while the HTTP requests arrive on other threads
+bot_script = """
+import base64
+import http.client
+import json
+import os
+import signal
+import threading
+import time
+import urllib.parse
+
+import vbcbbot.modules.http_interface as hi
+import vbcbbot.runner as runner
+
+
+class FakeConnector:
+    def __init__(self):
+        self.username = "Bot"
+        self.base_url = "http://forum.example.com/"
+        self.smiley_codes_to_urls = {}
+        self.smiley_version = 0
+        self.sent = []
+        self.wakeup = threading.Event()
+        self.reading_thread = threading.Thread(None, self.wakeup.wait, "fake reading")
+
+    def subscribe_to_message_updates(self, subscriber):
+        pass
+
+    def send_message(self, message, **kwargs):
+        self.sent.append(message)
+
+    def start(self):
+        self.reading_thread.start()
+
+    def stop(self):
+        self.wakeup.set()
+
+
+def drive(conn, port):
+    # give the main thread time to settle in wait_until_stopped
+    time.sleep(0.3)
+    result = {}
+    headers = {"Authorization": "Basic " + base64.b64encode(b"user:pass").decode()}
+    try:
+        client = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        client.request("GET", "/messages", headers=headers)
+        response = client.getresponse()
+        response.read()
+        result["get"] = response.status
+
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        client.request("POST", "/postmessage", urllib.parse.urlencode({"message": "hello"}), headers)
+        response = client.getresponse()
+        response.read()
+        result["post"] = response.status
+        client.close()
+    except Exception as exc:
+        result["error"] = repr(exc)
+
+    time.sleep(0.3)
+    result["sent"] = conn.sent
+    print(json.dumps(result), flush=True)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+conn = FakeConnector()
+module = hi.HttpInterface(conn, {
+    "port": "0", "username": "user", "password": "pass",
+    "page template": "http_templates/page.html",
+    "post template": "http_templates/post.html",
+    "editor template": "http_templates/editor.html",
+})
+module.start()
+signal.signal(signal.SIGTERM, runner.exit_on_signal)
+conn.start()
+threading.Thread(None, drive, "driver", (conn, module.server.server_address[1])).start()
+runner.wait_until_stopped(conn, [module])
+"""
+
+
+class TestRunnerLifetime(unittest.TestCase):
+    def test_requests_after_setup(self):
+        process = subprocess.run(
+            [sys.executable, "-c", bot_script], cwd=package_root, timeout=30,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertNotIn("Traceback", process.stderr)
+        self.assertNotIn("Exception", process.stderr)
+
+        result = json.loads(process.stdout.strip().split("\n")[-1])
+        self.assertEqual(result.get("get"), 200, result)
+        self.assertIn(result.get("post"), (200, 302, 303), result)
+        self.assertEqual(result["sent"], ["hello"])
@@ -0,0 +1,92 @@
+import vbcbbot.scheduler as s
+import threading
+import time
+import unittest
+
+__author__ = 'ondra'
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = s.Scheduler()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def record(self, what):
+        def action():
+            with self.lock:
+                self.calls.append(what)
+        return action
+
+    def test_order(self):
+        self.scheduler.call_later(0.06, self.record("c"))
+        self.scheduler.call_later(0.02, self.record("a"))
+        self.scheduler.call_later(0.04, self.record("b"))
+        time.sleep(0.2)
+        self.assertEqual(self.calls, ["a", "b", "c"])
+
+    def test_key_coalesces(self):
+        first = self.scheduler.call_later(0.05, self.record("first"), key="k")
+        second = self.scheduler.call_later(0.01, self.record("second"), key="k")
+        self.assertIs(first, second)
+        time.sleep(0.15)
+        self.assertEqual(self.calls, ["first"])
+
+        # once it has run, the key may be used again
+        self.scheduler.call_later(0.01, self.record("again"), key="k")
+        time.sleep(0.1)
+        self.assertEqual(self.calls, ["first", "again"])
+
+    def test_debounce(self):
+        for i in range(5):
+            self.scheduler.debounce("k", 0.05, self.record(i))
+            time.sleep(0.01)
+        time.sleep(0.15)
+        self.assertEqual(self.calls, [4])
+
+    def test_cancel(self):
+        action = self.scheduler.call_later(0.05, self.record("a"))
+        self.scheduler.call_later(0.05, self.record("b"), key="k")
+        action.cancel()
+        self.scheduler.cancel_key("k")
+        time.sleep(0.15)
+        self.assertEqual(self.calls, [])
+
+    def test_blocking_does_not_delay_others(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait(1)
+            self.record("slow")()
+
+        self.scheduler.call_later(0.01, slow, blocking=True)
+        self.scheduler.call_later(0.03, self.record("quick"))
+        time.sleep(0.1)
+        self.assertEqual(self.calls, ["quick"])
+        release.set()
+        time.sleep(0.05)
+        self.assertEqual(self.calls, ["quick", "slow"])
+
+    def test_blocking_then_plain(self):
+        self.scheduler.call_later(0.01, self.record("blocking"), blocking=True)
+        self.scheduler.call_later(0.03, self.record("plain"))
+        self.scheduler.call_later(0.05, self.record("blocking again"), blocking=True)
+        time.sleep(0.15)
+        self.assertEqual(self.calls, ["blocking", "plain", "blocking again"])
+        self.assertTrue(self.scheduler.thread.is_alive())
+
+    def test_shutdown(self):
+        self.scheduler.call_later(0.01, self.record("a"))
+        time.sleep(0.1)
+        self.scheduler.call_later(0.05, self.record("b"))
+        start = time.monotonic()
+        self.scheduler.shutdown()
+        self.assertLess(time.monotonic() - start, 0.04)
+        self.assertFalse(self.scheduler.thread.is_alive())
+        time.sleep(0.1)
+        self.assertEqual(self.calls, ["a"])
+        with self.assertRaises(RuntimeError):
+            self.scheduler.call_later(0.01, self.record("c"))